@@ -7,7 +7,30 @@ def read_env():
         LOG_DB_SQL=(bool, False),
         SECRET_KEY=(str, 'secret'),
         DATABASE_URL=(str, ''),
+        DATABASE_REPLICA_URLS=(list, []),
+        REPLICA_PIN_SECONDS=(int, 5),
         ADMIN_URL_SUFFIX=(str, 'unsafe'),
+        CACHE_URL=(str, 'locmemcache://'),
+        SHARED_CACHE=(bool, None),
+        SEARCH_BACKEND=(str, ''),
+        SEARCH_RESULT_CACHE_BACKEND=(str, 'mall.tiered_cache.TieredCache'),
+        SEARCH_RESULT_CACHE_TIMEOUT=(int, 60),
+        SEARCH_RESULT_CACHE_MAX_ENTRIES=(int, 1000),
+        SEARCH_INDEX_SNAPSHOT_DIR=(str, ''),
+        SEARCH_INDEX_REFRESH_SECONDS=(int, 5),
+        SEARCH_INDEX_WARM_UP=(bool, True),
+        ORDER_ID_LOCK_DIR=(str, ''),
+        ORDER_ID_MACHINE_ID=(int, None),
+        MERCHANT_CATALOG_CACHE_TIMEOUT=(int, 300),
+        TIERED_CACHE_LOCAL_TIMEOUT=(int, 10),
+        TIERED_CACHE_STALE_TIMEOUT=(int, 30),
+        TOKEN_AUTH_CACHE_TIMEOUT=(int, 300),
+        TOKEN_AUTH_LOCAL_CACHE_TIMEOUT=(int, 5),
+        JWT_ACCESS_TOKEN_MINUTES=(int, 15),
+        JWT_REFRESH_TOKEN_DAYS=(int, 7),
+        QUERY_BUDGET_ENABLED=(bool, True),
+        QUERY_BUDGET_REPEAT_THRESHOLD=(int, 3),
+        QUERY_BUDGET_MAX_QUERIES=(int, 20),
     )
 
     env.read_env()
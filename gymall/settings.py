@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 import sys
+from importlib.util import find_spec
+from datetime import timedelta
 from pathlib import Path
 from .read_env import read_env
 
@@ -45,6 +47,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'mall.query_budget.QueryBudgetMiddleware',
+    'mall.db_router.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     # 'django.middleware.csrf.CsrfViewMiddleware',
@@ -76,6 +80,31 @@ WSGI_APPLICATION = 'gymall.wsgi.application'
 DATABASES = {
     'default': env.db("DATABASE_URL")
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
+    # FULLTEXT ngram 索引不用停用词表 (否则拼音里含 a / i 的 gram 都进不了索引), 见 mall/migrations/0009;
+    # MySQL 服务端 (主库和副本) 也要配置 innodb_ft_enable_stopword = OFF
+    DATABASES['default'].setdefault('OPTIONS', {}).setdefault('init_command', 'SET SESSION innodb_ft_enable_stopword = OFF')
+
+# 只读副本, 多个用逗号分隔; 商户/商品/搜索的读请求走副本, 见 mall/db_router.py. 测试时副本指向测试主库
+for i, url in enumerate(env('DATABASE_REPLICA_URLS')):
+    DATABASES[f'replica{i}'] = {**env.db_url_config(url), 'TEST': {'MIRROR': 'default'}}
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['mall.db_router.ReplicaRouter']
+
+# 有写入的用户在 PIN_SECONDS 秒内只读主库 (read-your-writes); PIN_SECONDS 同时是副本的最大延迟,
+# 目录变更后这段时间内从副本读出的数据不缓存、不返回 ETag
+REPLICA_ROUTING = {
+    'CACHE_ALIAS': 'default',
+    'PIN_SECONDS': env('REPLICA_PIN_SECONDS'),
+}
+
+# 本地默认 locmem, 多 worker 部署时配置成 redis 等共享缓存 (CACHE_URL=redis://redis:6379/1), 否则各进程的版本号互不可见
+CACHES = {
+    'default': env.cache('CACHE_URL'),
+}
+# 缓存是否跨进程共享, 为 None 时按 backend 判断 (locmem / dummy 不是). 不共享时目录/商户版本号不可靠,
+# 依赖版本号的搜索结果缓存、商户页面缓存、token 缓存、副本读都关闭, ETag 改用 MAX(update_at) / COUNT; 见 mall/search_cache.py
+SHARED_CACHE = env('SHARED_CACHE')
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -125,11 +154,91 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    # 见 mall/renderers.py: 装了 orjson 时用 orjson 编解码 JSON, 装了 msgpack 时支持 application/msgpack
+    'DEFAULT_RENDERER_CLASSES': [
+        'mall.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        *(['mall.renderers.MessagePackRenderer'] if find_spec('msgpack') else []),
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'mall.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+        *(['mall.renderers.MessagePackParser'] if find_spec('msgpack') else []),
+    ],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
     ],
 }
 
+# 搜索后端的 dotted path, 为空时 MySQL 使用 FULLTEXT(ngram), 其它数据库使用 icontains
+# 可选: mall.search_backends.IContainsSearchBackend / MySQLFulltextSearchBackend / NGramIndexSearchBackend
+SEARCH_BACKEND = env('SEARCH_BACKEND')
+
+# 搜索结果缓存, 按全局商品目录版本号失效
+# BACKEND 可选: mall.search_cache.LocMemLRUResultCache(进程内 LRU) / mall.search_cache.SharedResultCache(django cache)
+#   / mall.tiered_cache.TieredCache(两级缓存, 防击穿)
+SEARCH_RESULT_CACHE = {
+    'BACKEND': env('SEARCH_RESULT_CACHE_BACKEND'),
+    'TIMEOUT': env('SEARCH_RESULT_CACHE_TIMEOUT'),
+    'OPTIONS': {
+        'max_entries': env('SEARCH_RESULT_CACHE_MAX_ENTRIES'),
+        'cache_alias': 'default',
+    },
+}
+CATALOG_VERSION_CACHE_ALIAS = 'default'
+
+# 商户商品/类目接口的响应缓存, 按商户版本号失效, 见 mall/merchant_cache.py
+MERCHANT_CATALOG_CACHE_ALIAS = 'default'
+MERCHANT_CATALOG_CACHE_TIMEOUT = env('MERCHANT_CATALOG_CACHE_TIMEOUT')
+
+# 两级缓存 (进程内 LRU + 共享缓存) 的默认参数, 见 mall/tiered_cache.py
+# STALE_TIMEOUT: 过期后还能返回旧值的秒数 (其它请求重算期间); LOCK_TIMEOUT 要大于重算耗时
+TIERED_CACHE = {
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 60,
+    'LOCAL_TIMEOUT': env('TIERED_CACHE_LOCAL_TIMEOUT'),
+    'LOCAL_MAX_ENTRIES': 1000,
+    'STALE_TIMEOUT': env('TIERED_CACHE_STALE_TIMEOUT'),
+    'LOCK_TIMEOUT': 10,
+    'WAIT_TIMEOUT': 5,
+}
+
+# CachedTokenAuthentication: token -> user 的进程内 TTL 缓存 + 共享缓存
+TOKEN_AUTH_CACHE = {
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': env('TOKEN_AUTH_CACHE_TIMEOUT'),
+    'LOCAL_TIMEOUT': env('TOKEN_AUTH_LOCAL_CACHE_TIMEOUT'),
+    'LOCAL_MAX_ENTRIES': 10000,
+}
+
+# JWT (Authorization: Bearer ...), access token 无状态校验, 有效期要短
+SIMPLE_JWT = {
+    'ACCESS_TOKEN_LIFETIME': timedelta(minutes=env('JWT_ACCESS_TOKEN_MINUTES')),
+    'REFRESH_TOKEN_LIFETIME': timedelta(days=env('JWT_REFRESH_TOKEN_DAYS')),
+    'AUTH_HEADER_TYPES': ('Bearer',),
+}
+
+# 进程内搜索索引: 快照目录(为空则每次启动从数据库构建), 跨进程增量同步间隔, worker 启动时是否预热 (见 gymall/wsgi.py)
+SEARCH_INDEX_SNAPSHOT_DIR = env('SEARCH_INDEX_SNAPSHOT_DIR')
+SEARCH_INDEX_REFRESH_SECONDS = env('SEARCH_INDEX_REFRESH_SECONDS')
+SEARCH_INDEX_WARM_UP = env('SEARCH_INDEX_WARM_UP')
+
+# 订单号 worker id 的文件锁目录, 同一台机器上的所有 worker 必须一致; 为空则使用系统临时目录下的 gymall-order-id
+ORDER_ID_LOCK_DIR = env('ORDER_ID_LOCK_DIR')
+# 订单号里的机器号 (0-99), 多台机器部署时每台必须不同; 不配置时订单号里没有机器号, 只能单机部署
+ORDER_ID_MACHINE_ID = env('ORDER_ID_MACHINE_ID')
+
+# 每个请求的查询次数 / SQL 耗时 / N+1 检测, 见 mall/query_budget.py
+# DEBUG 时返回 Server-Timing 头, 指标写到 mall.query_budget 日志; 同一查询出现 REPEAT_THRESHOLD 次以上记为 N+1
+QUERY_BUDGET = {
+    'ENABLED': env('QUERY_BUDGET_ENABLED'),
+    'SERVER_TIMING': DEBUG,
+    'REPEAT_THRESHOLD': env('QUERY_BUDGET_REPEAT_THRESHOLD'),
+    # 单个请求超过这么多次查询时打 warning, 其余请求的指标只在 DEBUG 级别输出
+    'MAX_QUERIES': env('QUERY_BUDGET_MAX_QUERIES'),
+}
+
 log_dir = BASE_DIR / "logs"
 if not log_dir.exists():
     log_dir.mkdir()
@@ -7,10 +7,29 @@ For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/wsgi/
 """
 
+import logging
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gymall.settings')
 
 application = get_wsgi_application()
+
+if not settings.DEBUG:
+    from mall.search_cache import catalog_versions_enabled
+
+    if not catalog_versions_enabled():
+        logging.getLogger('mall').warning(
+            'CACHE_URL is not a shared cache, catalog version caches are disabled; set CACHE_URL=redis://... for multi-worker deployments'
+        )
+
+from mall.order_id import order_id_generator
+
+order_id_generator.reserve()
+
+if settings.SEARCH_INDEX_WARM_UP:
+    from mall.search_engine import warm_up_indexes
+
+    warm_up_indexes()
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class MallConfig(AppConfig):
     name = 'mall'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -1,7 +1,102 @@
-from rest_framework.authentication import SessionAuthentication
+import hashlib
+from typing import Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import SessionAuthentication, TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework_simplejwt.authentication import JWTTokenUserAuthentication
+
+from .search_cache import LocMemLRUResultCache, SharedResultCache, is_shared_cache
 
 
 class MySessionAuthentication(SessionAuthentication):
 
     def enforce_csrf(self, request):
         return None
+
+
+# 缓存的 user 字段: 认证和权限检查用到的; 密码哈希等其它字段不放进共享缓存, 用到时再从库里取 (deferred)
+TOKEN_USER_FIELDS = ('id', 'username', 'is_active', 'is_staff', 'is_superuser')
+
+
+def token_cache_key(key: str) -> str:
+    return 'mall:auth-token:%s' % hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+_local_token_cache: Optional[LocMemLRUResultCache] = None
+_shared_token_cache: Optional[SharedResultCache] = None
+
+
+def get_token_caches():
+    """
+    (进程内 TTL 缓存, 共享缓存); 进程内缓存无法跨进程失效, TTL 要短
+    """
+    global _local_token_cache, _shared_token_cache
+    if _local_token_cache is None:
+        conf = settings.TOKEN_AUTH_CACHE
+        _local_token_cache = LocMemLRUResultCache(timeout=conf['LOCAL_TIMEOUT'], max_entries=conf['LOCAL_MAX_ENTRIES'])
+        _shared_token_cache = SharedResultCache(timeout=conf['TIMEOUT'], cache_alias=conf['CACHE_ALIAS'])
+    return _local_token_cache, _shared_token_cache
+
+
+@receiver(setting_changed)
+def reset_token_caches(setting=None, **kwargs):
+    global _local_token_cache, _shared_token_cache
+    if setting in (None, 'TOKEN_AUTH_CACHE'):
+        _local_token_cache = _shared_token_cache = None
+
+
+def invalidate_token(key: str):
+    cache_key = token_cache_key(key)
+    for cache in get_token_caches():
+        cache.delete(cache_key)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication 每个请求都要 join 一次 token + user 表, 这里把 user 的 TOKEN_USER_FIELDS 缓存起来:
+    先查进程内 TTL 缓存, 再查共享缓存, 都没有才查库. request.user 上的其它字段是 deferred 的,
+    访问时逐个查库, 需要完整 User 的视图 (如 about-me) 自己查一次.
+
+    token 删除、user 保存 (停用、改密码等) 时由 signals 失效, 其它进程的进程内缓存最多滞后 LOCAL_TIMEOUT 秒.
+    CACHE_ALIAS 不是共享缓存时其它进程的失效通知不到, 不缓存
+    """
+
+    def authenticate_credentials(self, key):
+        if not is_shared_cache(settings.TOKEN_AUTH_CACHE['CACHE_ALIAS']):
+            return super().authenticate_credentials(key)
+        local_cache, shared_cache = get_token_caches()
+        cache_key = token_cache_key(key)
+
+        values = local_cache.get(cache_key)
+        if values is None:
+            values = shared_cache.get(cache_key)
+            if values is None:
+                user, token = super().authenticate_credentials(key)
+                values = {name: getattr(user, name) for name in TOKEN_USER_FIELDS}
+                shared_cache.set(cache_key, values)
+                local_cache.set(cache_key, values)
+                return user, token
+            local_cache.set(cache_key, values)
+
+        user_model = get_user_model()
+        # from_db 要求按 concrete_fields 的顺序; 每次构造新的实例, 请求之间不共享可变对象; 没有缓存的字段是 deferred 的
+        names = [f.attname for f in user_model._meta.concrete_fields if f.attname in values]
+        user = user_model.from_db(None, names, [values[name] for name in names])
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return user, Token(key=key, user=user)
+
+
+class StatelessJWTAuthentication(JWTTokenUserAuthentication):
+    """
+    Authorization: Bearer <access token>, request.user 是由 token 里的 claims 构造的 TokenUser, 不查库.
+
+    TokenUser 不是 User 的实例, 视图里按 request.user.id 过滤 (user_id=...), 需要完整 User 时自己查.
+    用户停用后已签发的 access token 在过期前仍然有效, 所以 access token 的有效期要短
+    """
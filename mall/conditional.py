@@ -0,0 +1,111 @@
+"""
+条件请求 (ETag / Last-Modified, 304)
+
+list / retrieve 在序列化之前先算校验值, 与客户端的 If-None-Match / If-Modified-Since 一致时直接返回 304:
+
+- 一般的视图对同一个 queryset 查一次 SELECT MAX(update_at), COUNT(*):
+  修改时 update_at 变大 (auto_now), 删除时 COUNT 变小, 新增时两者都变.
+  嵌套输出的关联对象的变更不会改主表的 update_at, 它们的 update_at 列在 conditional_related_timestamps 里,
+  在同一条查询里一并取 MAX (如订单的收货地址)
+- 商品目录 (商户/商品/类目/图片) 的任何变更都会递增全局目录版本号 (见 search_cache), 输出里含目录数据时
+  conditional_catalog_version = True 把版本号也算进去. 商品、商户列表只依赖目录,
+  conditional_version_only = True 时只用版本号不再查库: 对整张商品表 COUNT(*) 比它省下的序列化还贵
+- 版本号只有存在共享缓存里才能反映其它 worker 的写入 (search_cache.catalog_versions_enabled),
+  否则不使用版本号, 一律按 MAX(update_at), COUNT(*) 算校验值
+- 版本号由 signals 递增. queryset.update() / bulk_update() / bulk_create() 不发 signals,
+  批量修改商品目录之后必须调用 signals.catalog_bulk_changed(受影响的商户), 否则客户端会一直拿到 304
+
+ETag 由这些值加上查询参数、返回格式、host (返回值里有绝对地址)、当前用户算出.
+Last-Modified 只在不依赖版本号时参与 If-Modified-Since 的判断, 版本号的变化没有对应的时间.
+"""
+import hashlib
+from typing import Optional, Tuple
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from .db_router import replica_lagging
+from .search_cache import catalog_versions_enabled, get_catalog_version
+
+
+class ConditionalGetMixin:
+    """
+    放在 FastReadMixin 之前
+    """
+    conditional_timestamp_field: Optional[str] = 'update_at'
+    # 嵌套输出的关联对象的 update_at, 如 ('address__update_at',)
+    conditional_related_timestamps: Tuple[str, ...] = ()
+    # 输出里包含商品目录的数据 (商户/商品/类目/图片) 时为 True
+    conditional_catalog_version = False
+    # 输出只依赖商品目录: 版本号可靠时只用版本号, 不查库
+    conditional_version_only = False
+
+    def list(self, request, *args, **kwargs):
+        qs = self.filter_queryset(self.get_queryset())
+        return self.conditional_response(qs, lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        qs = self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        return self.conditional_response(qs, lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs))
+
+    def get_validators(self, qs) -> Optional[Tuple[str, Optional[int]]]:
+        """
+        (etag, last_modified 时间戳), 查不到数据时返回 None
+        """
+        request = self.request
+        parts = [
+            type(self).__name__,
+            self.action,
+            *(f'{k}={v}' for k, v in sorted(self.kwargs.items())),
+            *(f'{k}={v}' for k, v in sorted(request.query_params.lists())),
+            request.accepted_media_type,
+            request.build_absolute_uri('/'),
+            str(request.user.id),
+        ]
+        versioned = self.conditional_catalog_version and catalog_versions_enabled()
+        if versioned:
+            version = get_catalog_version()
+            if replica_lagging(lambda: version):
+                # 读出的可能是变更之前的数据, 不能给它新版本号的 ETag
+                return None
+            parts.append(str(version))
+
+        last_modified = None
+        if self.conditional_timestamp_field is not None and not (versioned and self.conditional_version_only):
+            fields = (self.conditional_timestamp_field, *self.conditional_related_timestamps)
+            row = qs.order_by().aggregate(
+                count=Count('pk'),
+                **{f'max{i}': Max(field) for i, field in enumerate(fields)},
+            )
+            if not row['count']:
+                return None
+            timestamps = [row[f'max{i}'] for i in range(len(fields))]
+            parts.append(str(row['count']))
+            parts.extend(t.isoformat() if t is not None else '' for t in timestamps)
+            last_modified = max((t for t in timestamps if t is not None), default=None)
+
+        etag = quote_etag(hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest())
+        return etag, int(last_modified.timestamp()) if last_modified is not None else None
+
+    def conditional_response(self, qs, respond):
+        if self.request.method not in ('GET', 'HEAD'):
+            return respond()
+        validators = self.get_validators(qs)
+        if validators is None:
+            return respond()
+        etag, last_modified = validators
+
+        # 版本号的变化没有对应的时间, 用了版本号就不能按 If-Modified-Since 判断
+        versioned = self.conditional_catalog_version and catalog_versions_enabled()
+        response = get_conditional_response(
+            self.request, etag=etag, last_modified=None if versioned else last_modified,
+        )
+        if response is None:
+            response = respond()
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
@@ -0,0 +1,160 @@
+"""
+只读副本路由
+
+settings.DATABASE_REPLICAS 为空, 或者 REPLICA_ROUTING 的缓存不是共享缓存 (钉住的标记其它进程看不到) 时所有读写都走 default.
+配置了副本 (DATABASE_REPLICA_URLS) 时:
+
+- ReplicaReadMixin 的视图 (商户、商品、搜索) 的读请求, 在认证和权限检查之后随机选定一个副本,
+  这个请求内的读查询都走它, 一个请求里的多次查询看到的是同一个副本的数据; 其它视图和写请求都读主库
+- 写入都走主库; transaction.atomic() 块内 (如 create_order 的 deferred_totals) 的读、同一请求内写入之后的读也走主库
+- 从副本读出的对象, 再取关联对象时读同一个副本
+- read-your-writes: ReplicaRoutingMiddleware 发现请求里有写入时, 只把当前用户钉在主库上 PIN_SECONDS 秒
+- 副本落后于目录变更: 目录/商户版本号是最近一次变更的毫秒时间戳 (见 search_cache.advance_version),
+  读副本时版本号在 PIN_SECONDS (副本的最大延迟) 以内的, 读出的数据可能是变更之前的, 不按这个版本号写缓存、不返回 ETag
+  (replica_lagging), 以免旧数据挂在新版本号下面一直不失效
+
+本地用两个 SQLite 文件模拟: DATABASE_REPLICA_URLS=sqlite:////tmp/gymall-replica.db,
+python manage.py sync_sqlite_replicas 把主库复制到副本, 相当于一次同步
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework import permissions
+
+from .search_cache import is_shared_cache
+
+PIN_KEY = 'mall:db-pin:%s'
+
+_local = threading.local()
+
+
+def user_pin(user) -> str:
+    return f'user:{user.pk}'
+
+
+def pin_to_primary(name: str):
+    if not settings.DATABASE_REPLICAS:
+        return
+    conf = settings.REPLICA_ROUTING
+    caches[conf['CACHE_ALIAS']].set(PIN_KEY % name, 1, timeout=conf['PIN_SECONDS'])
+
+
+def is_pinned(*names: str) -> bool:
+    conf = settings.REPLICA_ROUTING
+    return bool(caches[conf['CACHE_ALIAS']].get_many([PIN_KEY % name for name in names]))
+
+
+def choose_replica() -> str:
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+@contextmanager
+def replica_reads():
+    """
+    块内的读查询都走同一个随机选定的副本; 块内有写入时, 之后的读回到主库
+    """
+    replica, wrote = getattr(_local, 'replica', None), getattr(_local, 'wrote', False)
+    _local.replica, _local.wrote = choose_replica() if settings.DATABASE_REPLICAS else None, False
+    try:
+        yield
+    finally:
+        _local.replica, _local.wrote = replica, wrote or _local.wrote
+
+
+def replica_lagging(get_version: Callable[[], int]) -> bool:
+    """
+    当前请求在读副本, 且版本号 get_version() 是 PIN_SECONDS 之内的变更, 副本可能还没有同步到;
+    不读副本时不调用 get_version
+    """
+    if getattr(_local, 'replica', None) is None or getattr(_local, 'wrote', False):
+        return False
+    return time.time() * 1000 - get_version() < settings.REPLICA_ROUTING['PIN_SECONDS'] * 1000
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db is not None:
+            return instance._state.db
+        # 当前请求选定的副本, 见 ReplicaReadMixin
+        replica = getattr(_local, 'replica', None)
+        if (
+                replica is None
+                or getattr(_local, 'wrote', False)
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        _local.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 副本和主库是同一份数据
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaRoutingMiddleware:
+    """
+    请求里有写入时, 把当前用户钉在主库上; 放在 SessionMiddleware 之前, session 的写入也算
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.wrote = False
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote, _local.wrote = _local.wrote, False
+        if wrote and settings.DATABASE_REPLICAS:
+            # DRF 认证后的用户也会设置到 request.user 上
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                pin_to_primary(user_pin(user))
+        return response
+
+
+class ReplicaReadMixin:
+    """
+    视图用, 放在最前面: 读请求在认证、权限检查之后选定一个副本, 之后的读都走它
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if (
+                request.method not in permissions.SAFE_METHODS
+                or not settings.DATABASE_REPLICAS
+                or not is_shared_cache(settings.REPLICA_ROUTING['CACHE_ALIAS'])
+        ):
+            return
+        if not request.user.is_authenticated or not is_pinned(user_pin(request.user)):
+            _local.replica = choose_replica()
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            _local.replica = None
+
+
+def copy_sqlite_database(source: str, target: str):
+    """
+    本地/测试用: 用 SQLite 的 backup API 把 source 整个复制到 target
+    """
+    src, dst = connections[source], connections[target]
+    src.ensure_connection()
+    dst.ensure_connection()
+    src.connection.backup(dst.connection)
@@ -0,0 +1,295 @@
+"""
+列表/详情接口的只读快速序列化
+
+HyperlinkedModelSerializer 每行每个字段都要走 get_attribute / to_representation, 外键链接每次都 reverse 一遍,
+嵌套的 AppImageSerializer 每行也要重新走一遍字段. 这里把 serializer 按当前请求编译成 (列, 转换函数):
+
+- 数据用 values_list() 直接取元组, 不构造 model 实例; 嵌套的 serializer 展开成 join 的列 (img__id, merchant__img__img ...)
+- 外键链接每个请求只 reverse 一次得到 URL 模板, 每行只做字符串拼接; 图片地址的 MEDIA_URL 前缀同理
+- 反向外键 (订单的 items) 每页一次查询
+- 已经查出来的 model 实例也可以按同样的列取值 (搜索接口)
+
+输出与 DRF 的 .data 相同. SerializerMethodField / property 需要在 serializer 的 fast_fields 里登记基于列的等价写法,
+编译不了的 serializer 抛 NotCompilable, FastReadMixin 回退到 DRF 的序列化.
+"""
+import copy
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Sequence, Set
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.files.storage import FileSystemStorage
+from django.db.models.fields.files import FieldFile
+from django.http import Http404
+from django.utils.encoding import filepath_to_uri
+from rest_framework import permissions, serializers
+from rest_framework.relations import PKOnlyObject
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from .sparse_fields import known_sparse_fieldsets
+
+# 生成 URL 模板时代替主键的占位值
+_PK_PLACEHOLDER = '7310473104731'
+
+
+class NotCompilable(Exception):
+    pass
+
+
+class ValuesField(serializers.Field):
+    """
+    只在 fast_fields 中使用: 由 sources 这几列 (用 . 分隔的路径) 的值经 func 算出
+    """
+
+    def __init__(self, func: Callable, sources: Sequence[str], **kwargs):
+        self.func = func
+        self.sources = list(sources)
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+
+class CompiledSerializer:
+    def __init__(self, serializer: serializers.BaseSerializer):
+        if isinstance(serializer, serializers.ListSerializer):
+            serializer = serializer.child
+        self.model = serializer.Meta.model
+        self.columns: List[str] = []
+        self._column_index: Dict[str, int] = {}
+        self._pk_index = self._column(self.model._meta.pk.name)
+        # (反向外键, 子 CompiledSerializer, 当前这一批的 父主键 -> 子数据)
+        self._children = []
+        self._ops = self._compile(serializer, '', self.model)
+
+    def _column(self, lookup: str) -> int:
+        index = self._column_index.get(lookup)
+        if index is None:
+            index = self._column_index[lookup] = len(self.columns)
+            self.columns.append(lookup)
+        return index
+
+    @staticmethod
+    def _resolve(model, attrs):
+        """
+        沿 source 路径找到最后一个字段
+        """
+        field = None
+        for attr in attrs:
+            if field is not None:
+                if not field.is_relation:
+                    raise NotCompilable(f'{model.__name__}.{attr}')
+                model = field.related_model
+            try:
+                field = model._meta.get_field(model._meta.pk.name if attr == 'pk' else attr)
+            except FieldDoesNotExist:
+                raise NotCompilable(f'{model.__name__}.{attr}')
+        return field
+
+    def _compile(self, serializer, prefix: str, model):
+        ops = []
+        fast_fields = {}
+        for klass in reversed(type(serializer).__mro__):
+            fast_fields.update(getattr(klass, 'fast_fields', None) or {})
+
+        for field in serializer._readable_fields:
+            name = field.field_name
+            if name in fast_fields:
+                field = copy.deepcopy(fast_fields[name])
+                field.bind(name, serializer)
+            ops.append((name, self._compile_field(field, prefix, model)))
+        return ops
+
+    def _compile_field(self, field, prefix: str, model):
+        if isinstance(field, ValuesField):
+            indexes = [self._column(prefix + source.replace('.', '__')) for source in field.sources]
+            func = field.func
+            return lambda row: func(*(row[i] for i in indexes))
+        if field.source == '*' or isinstance(field, serializers.SerializerMethodField):
+            raise NotCompilable(field.field_name)
+
+        lookup = prefix + '__'.join(field.source_attrs)
+        model_field = self._resolve(model, field.source_attrs)
+
+        if isinstance(field, serializers.ListSerializer):
+            if prefix or not (model_field.one_to_many and model_field.auto_created):
+                raise NotCompilable(field.field_name)
+            child = CompiledSerializer(field.child)
+            children = {}
+            self._children.append((model_field, child, children))
+            pk_index = self._pk_index
+            return lambda row: children.get(row[pk_index], [])
+
+        if isinstance(field, serializers.BaseSerializer):
+            if not (model_field.many_to_one or model_field.one_to_one) or not model_field.concrete:
+                raise NotCompilable(field.field_name)
+            related_model = model_field.related_model
+            sub_ops = self._compile(field, lookup + '__', related_model)
+            pk_index = self._column(f'{lookup}__{related_model._meta.pk.name}')
+            return lambda row: None if row[pk_index] is None else {name: op(row) for name, op in sub_ops}
+
+        index = self._column(lookup)
+
+        if isinstance(field, serializers.HyperlinkedRelatedField):
+            if field.lookup_field != 'pk':
+                raise NotCompilable(field.field_name)
+            url = field.to_representation(PKOnlyObject(pk=_PK_PLACEHOLDER))
+            if url is None or url.count(_PK_PLACEHOLDER) != 1:
+                raise NotCompilable(field.field_name)
+            head, tail = url.split(_PK_PLACEHOLDER)
+            return lambda row: None if row[index] is None else f'{head}{row[index]}{tail}'
+        if isinstance(field, serializers.RelatedField):
+            raise NotCompilable(field.field_name)
+
+        if isinstance(field, serializers.FileField):
+            to_url = self._file_url(field, model_field.storage)
+            return lambda row: to_url(row[index]) if row[index] else None
+
+        if type(field) is serializers.IntegerField:
+            convert = int
+        elif type(field) is serializers.CharField:
+            convert = str
+        elif type(field) is serializers.ReadOnlyField:
+            return lambda row: row[index]
+        else:
+            convert = field.to_representation
+        return lambda row: None if row[index] is None else convert(row[index])
+
+    @staticmethod
+    def _file_url(field, storage) -> Callable[[str], str]:
+        """
+        与 rest_framework.fields.FileField.to_representation 相同, 但 FileSystemStorage 的前缀只算一次
+        """
+        if not getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL):
+            return lambda name: name
+        request = field.context.get('request')
+        if isinstance(storage, FileSystemStorage):
+            prefix = request.build_absolute_uri(storage.base_url) if request is not None else storage.base_url
+            return lambda name: prefix + filepath_to_uri(name).lstrip('/')
+        if request is not None:
+            return lambda name: request.build_absolute_uri(storage.url(name))
+        return storage.url
+
+    def values(self, qs, extra_fields: Sequence[str] = ()):
+        """
+        qs -> values() queryset, extra_fields 为分页游标等额外需要的列
+        """
+        columns = [*self.columns, *(f for f in extra_fields if f not in self._column_index)]
+        return qs.prefetch_related(None).values(*columns)
+
+    def to_representation(self, rows) -> List[dict]:
+        """
+        rows 为 values() 的 dict 或按 self.columns 排列的元组
+        """
+        rows = [tuple(row[c] for c in self.columns) if isinstance(row, dict) else row for row in rows]
+        if self._children:
+            pks = [row[self._pk_index] for row in rows]
+            for rel, child, children in self._children:
+                fk = rel.field
+                children.clear()
+                if not pks:
+                    continue
+                child_rows = list(
+                    child.model._default_manager.filter(**{f'{fk.name}__in': pks}).values_list(fk.attname, *child.columns)
+                )
+                grouped = defaultdict(list)
+                for parent_pk, data in zip((r[0] for r in child_rows), child.to_representation([r[1:] for r in child_rows])):
+                    grouped[parent_pk].append(data)
+                children.update(grouped)
+        ops = self._ops
+        return [{name: op(row) for name, op in ops} for row in rows]
+
+    def to_representation_instances(self, instances) -> List[dict]:
+        """
+        已经查出来的 model 实例, 关联对象需要提前 select_related / prefetch_related, 否则会逐行查库
+        """
+        rows = [tuple(self._get_path(obj, c) for c in self.columns) for obj in instances]
+        if not self._children:
+            return self.to_representation(rows)
+        ops = self._ops
+        result = []
+        for obj, row in zip(instances, rows):
+            for rel, child, children in self._children:
+                children.clear()
+                children[row[self._pk_index]] = child.to_representation_instances(getattr(obj, rel.get_accessor_name()).all())
+            result.append({name: op(row) for name, op in ops})
+        return result
+
+    @staticmethod
+    def _get_path(obj, lookup: str):
+        *relations, last = lookup.split('__')
+        for attr in relations:
+            obj = getattr(obj, attr)
+            if obj is None:
+                return None
+        if last == 'pk':
+            return obj.pk
+        # 外键取 attname (merchant -> merchant_id), 文件取 name, 与 values() 一致
+        value = getattr(obj, obj._meta.get_field(last).attname)
+        return value.name if isinstance(value, FieldFile) else value
+
+
+# (serializer_class, 裁剪后的字段), 与 query_planner.build_plan 的 key 相同:
+# 能否编译取决于实际输出的字段, ?fields= 去掉编译不了的字段之后就能编译
+_not_compilable: Set[tuple] = set()
+
+
+def compile_serializer(serializer_class, context) -> Optional[CompiledSerializer]:
+    """
+    编译不了时返回 None; 结果与请求相关 (链接的 host), 不跨请求复用
+    """
+    key = (serializer_class, known_sparse_fieldsets(serializer_class, context.get('sparse_fieldsets')))
+    if key in _not_compilable:
+        return None
+    try:
+        return CompiledSerializer(serializer_class(context=context))
+    except NotCompilable:
+        _not_compilable.add(key)
+        return None
+
+
+def serialize_instances(serializer_class, instances, context) -> list:
+    """
+    已经查出来的实例, 编译不了时用 DRF 序列化
+    """
+    compiled = compile_serializer(serializer_class, context)
+    if compiled is None:
+        return serializer_class(instance=instances, many=True, context=context).data
+    return compiled.to_representation_instances(instances)
+
+
+class FastReadMixin:
+    """
+    GET list / retrieve 走 CompiledSerializer, 其它请求以及编译不了的 serializer 仍然走 DRF
+    """
+
+    def get_compiled_serializer(self) -> Optional[CompiledSerializer]:
+        return compile_serializer(self.get_serializer_class(), self.get_serializer_context())
+
+    def list(self, request, *args, **kwargs):
+        compiled = self.get_compiled_serializer()
+        if compiled is None:
+            return super().list(request, *args, **kwargs)
+
+        ordering = getattr(self.paginator, 'ordering', None) or ()
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        qs = compiled.values(self.filter_queryset(self.get_queryset()), [o.lstrip('-') for o in ordering])
+        page = self.paginate_queryset(qs)
+        if page is not None:
+            return self.get_paginated_response(compiled.to_representation(page))
+        return Response(compiled.to_representation(qs))
+
+    def retrieve(self, request, *args, **kwargs):
+        compiled = self.get_compiled_serializer()
+        # 有对象级权限时需要 model 实例, 走 DRF
+        if compiled is None or any(
+            type(p).has_object_permission is not permissions.BasePermission.has_object_permission
+            for p in self.get_permissions()
+        ):
+            return super().retrieve(request, *args, **kwargs)
+
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        qs = self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        rows = list(compiled.values(qs)[:2])
+        if len(rows) != 1:
+            raise Http404
+        return Response(compiled.to_representation(rows)[0])
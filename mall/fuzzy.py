@@ -0,0 +1,221 @@
+"""
+拼音容错搜索 (SymSpell 风格的删除索引)
+
+商品/商户名按字转成全拼, 取连续 1~3 个字的拼音拼起来作为 token (如 "fan" "fanqie" "qiechaodan"),
+对每个 token 的前 PREFIX_LENGTH 个字符预先生成删除最多 MAX_DISTANCE 个字符的所有变体. 查询时对查询词做同样的删除,
+查表得到候选 token, 再用 OSA 编辑距离 (相邻换位算 1 次) 校验, 代价与词表大小无关.
+
+只在精确搜索 0 命中时使用, 见 SearchSerializer.
+"""
+import re
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from .models import Merchant, Product
+from .pinyin_service import name_syllables
+from .ranking import RANK_CANDIDATES
+from .search_engine import SyncedCatalogIndex, BUILD_CHUNK_SIZE
+
+MAX_DISTANCE = 2
+PREFIX_LENGTH = 7
+MIN_TOKEN_LENGTH = 3
+MAX_TOKEN_LENGTH = 20
+TOKEN_WINDOW = 3
+
+RE_WORD = re.compile(r'[a-z0-9]+')
+RE_HANS = re.compile(r'[㐀-鿿]')
+
+
+def to_pinyin_words(s: str) -> List[str]:
+    words = []
+    for item in name_syllables(s):
+        words.extend(RE_WORD.findall(item.lower()))
+    return words
+
+
+def name_tokens(name: str) -> Set[str]:
+    words = to_pinyin_words(name)
+    tokens = set()
+    for i in range(len(words)):
+        for j in range(i + 1, min(i + TOKEN_WINDOW, len(words)) + 1):
+            token = ''.join(words[i:j])
+            if MIN_TOKEN_LENGTH <= len(token) <= MAX_TOKEN_LENGTH:
+                tokens.add(token)
+    return tokens
+
+
+def normalize_query(s: str) -> str:
+    s = s.strip().lower()
+    if RE_HANS.search(s):
+        # 中文输入转成拼音, 同音错别字也能命中
+        return ''.join(to_pinyin_words(s))
+    return ''.join(RE_WORD.findall(s))
+
+
+def allowed_distance(q: str) -> int:
+    return 1 if len(q) <= 4 else MAX_DISTANCE
+
+
+def deletes(word: str, max_distance: int) -> Set[str]:
+    out = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        next_frontier = set()
+        for w in frontier:
+            for i in range(len(w)):
+                next_frontier.add(w[:i] + w[i + 1:])
+        out |= next_frontier
+        frontier = next_frontier
+    return out
+
+
+def osa_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    optimal string alignment 距离, 超过 max_distance 时提前返回 max_distance + 1
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > max_distance:
+            return max_distance + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+class DeletionIndex:
+    def __init__(self):
+        self._token_docs: Dict[str, Set[int]] = defaultdict(set)
+        self._deletes: Dict[str, Set[str]] = defaultdict(set)
+        self._docs: Dict[int, Tuple[Optional[int], Set[str]]] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, doc_id: int, tokens: Set[str], group: Optional[int] = None):
+        with self._lock:
+            old = self._docs.get(doc_id)
+            if old is not None:
+                if old == (group, tokens):
+                    return
+                self.remove(doc_id)
+            self._docs[doc_id] = (group, tokens)
+            for token in tokens:
+                docs = self._token_docs[token]
+                if not docs:
+                    for variant in deletes(token[:PREFIX_LENGTH], MAX_DISTANCE):
+                        self._deletes[variant].add(token)
+                docs.add(doc_id)
+
+    def remove(self, doc_id: int):
+        with self._lock:
+            old = self._docs.pop(doc_id, None)
+            if old is None:
+                return
+            for token in old[1]:
+                docs = self._token_docs.get(token)
+                if docs is None:
+                    continue
+                docs.discard(doc_id)
+                if docs:
+                    continue
+                del self._token_docs[token]
+                for variant in deletes(token[:PREFIX_LENGTH], MAX_DISTANCE):
+                    tokens = self._deletes.get(variant)
+                    if tokens is not None:
+                        tokens.discard(token)
+                        if not tokens:
+                            del self._deletes[variant]
+
+    def lookup(self, q: str, max_distance: int) -> Dict[str, int]:
+        """
+        返回 编辑距离 <= max_distance 的 token -> 距离
+        """
+        candidates = set()
+        with self._lock:
+            for variant in deletes(q[:PREFIX_LENGTH], max_distance):
+                candidates |= self._deletes.get(variant, set())
+        out = {}
+        for token in candidates:
+            d = osa_distance(q, token, max_distance)
+            if d <= max_distance:
+                out[token] = d
+        return out
+
+    def search(self, s: str, group: Optional[int] = None) -> Dict[int, int]:
+        """
+        返回 doc_id -> 最小编辑距离
+        """
+        q = normalize_query(s)
+        if len(q) < MIN_TOKEN_LENGTH:
+            return {}
+        ret = {}
+        for token, d in self.lookup(q, allowed_distance(q)).items():
+            with self._lock:
+                doc_ids = list(self._token_docs.get(token, ()))
+            for doc_id in doc_ids:
+                if group is not None and self._docs.get(doc_id, (None,))[0] != group:
+                    continue
+                if doc_id not in ret or d < ret[doc_id]:
+                    ret[doc_id] = d
+        return ret
+
+
+class CatalogFuzzyIndex(SyncedCatalogIndex):
+    def __init__(self, model, group_field: Optional[str] = None):
+        super().__init__()
+        self.model = model
+        self.group_field = group_field
+        self.index = DeletionIndex()
+
+    @property
+    def name(self):
+        return f'fuzzy-{self.model._meta.model_name}'
+
+    def load(self, since=None):
+        qs = self.model.objects.all()
+        if since is not None:
+            qs = qs.filter(update_at__gte=since)
+        fields = ('id', 'name', self.group_field) if self.group_field else ('id', 'name')
+        for row in qs.values_list(*fields).iterator(chunk_size=BUILD_CHUNK_SIZE):
+            self.index.add(row[0], name_tokens(row[1]), row[2] if self.group_field else None)
+
+    def on_saved(self, instance):
+        if self._ready:
+            group = getattr(instance, self.group_field) if self.group_field else None
+            self.index.add(instance.pk, name_tokens(instance.name), group)
+
+    def on_deleted(self, instance):
+        if self._ready:
+            self.index.remove(instance.pk)
+
+    def search(self, s: str, group: Optional[int] = None) -> Dict[int, int]:
+        self.ensure_ready()
+        return self.index.search(s, group=group)
+
+
+product_fuzzy_index = CatalogFuzzyIndex(Product, group_field='merchant_id')
+merchant_fuzzy_index = CatalogFuzzyIndex(Merchant)
+
+
+def fuzzy_ranked(qs, fuzzy_index: CatalogFuzzyIndex, s: str, limit: int, group: Optional[int] = None) -> list:
+    """
+    按 (编辑距离, 静态分) 排序取前 limit 个
+    """
+    distances = fuzzy_index.search(s, group=group)
+    if not distances:
+        return []
+    candidates = sorted(distances, key=distances.get)[:RANK_CANDIDATES]
+    rows = qs.filter(pk__in=candidates).values_list('pk', 'search_score')
+    ids = [pk for _, _, pk in sorted((distances[pk], -(score or 0.0), pk) for pk, score in rows)[:limit]]
+    objs = qs.in_bulk(ids)
+    return [objs[pk] for pk in ids if pk in objs]
@@ -0,0 +1,89 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from rest_framework.request import Request
+
+from .bench_search import Command as BenchSearchCommand, git_commit, peak_rss_mb, percentile
+from .bench_serializers import Command as BenchSerializersCommand
+
+
+class Command(BaseCommand):
+    help = '用 OrderSerializer 的分页数据对比 DRF JSONRenderer / FastJSONRenderer / MessagePackRenderer 的编码耗时和字节数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=2000, help='订单数量, 每个订单 5 个订单项')
+        parser.add_argument('--page-sizes', type=str, default='20,100,1000', help='每次编码的订单数, 逗号分隔')
+        parser.add_argument('--seed', type=int, default=20220213)
+        parser.add_argument('--rounds', type=int, default=50)
+        parser.add_argument('--current-db', action='store_true', help='直接写入当前数据库, 默认使用临时的测试数据库')
+        parser.add_argument('--output', type=str, default='', help='结果写入文件, 默认输出到 stdout')
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['current_db']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            report = self.run(options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        out = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(out)
+        else:
+            self.stdout.write(out)
+
+    def run(self, options):
+        from rest_framework.renderers import JSONRenderer
+        from mall import renderers
+        from mall.fast_serializers import compile_serializer
+        from mall.models import Order
+        from mall.serializers import OrderSerializer
+
+        BenchSearchCommand().generate_catalog(max(options['orders'], 1000), options['seed'])
+        BenchSerializersCommand().generate_images_and_orders(options['orders'], options['seed'])
+
+        request = Request(RequestFactory().get('/api/v1/orders/'))
+        compiled = compile_serializer(OrderSerializer, {'request': request})
+        qs = Order.objects.order_by('-create_at', '-id')
+
+        candidates = [('drf_json', JSONRenderer()), ('fast_json', renderers.FastJSONRenderer())]
+        if renderers.msgpack is not None:
+            candidates.append(('msgpack', renderers.MessagePackRenderer()))
+
+        results = {}
+        for page_size in (int(n) for n in options['page_sizes'].split(',') if n.strip()):
+            data = {'next': None, 'previous': None, 'results': compiled.to_representation(compiled.values(qs)[:page_size])}
+            results[str(page_size)] = result = {}
+            for name, renderer in candidates:
+                body = renderer.render(data, renderer.media_type)
+                latencies = []
+                for _ in range(options['rounds']):
+                    t0 = time.perf_counter()
+                    renderer.render(data, renderer.media_type)
+                    latencies.append(time.perf_counter() - t0)
+                latencies.sort()
+                result[name] = {
+                    'bytes': len(body),
+                    'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+                    'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+                    'mb_per_second': round(len(body) / (sum(latencies) / len(latencies)) / 1024 / 1024, 1),
+                }
+            result['fast_json_identical'] = (
+                renderers.FastJSONRenderer().render(data, 'application/json') == JSONRenderer().render(data, 'application/json')
+            )
+        return {
+            'commit': git_commit(),
+            'orders': options['orders'],
+            'seed': options['seed'],
+            'orjson': renderers.orjson is not None,
+            'msgpack': renderers.msgpack is not None,
+            'results': results,
+            'peak_rss_mb': peak_rss_mb(),
+        }
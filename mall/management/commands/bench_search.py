@@ -0,0 +1,199 @@
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework.request import Request
+
+# 前缀/品类/后缀互相组合, 拼音上有大量重叠 (fanqie / fanshu / fangzheng, xiangjiao / xiangcai ...)
+NAME_PREFIXES = ('新鲜', '进口', '有机', '精选', '特级', '山东', '海南', '云南', '冷冻', '现摘', '')
+NAME_ITEMS = (
+    '番茄', '番薯', '番石榴', '西红柿', '车厘子', '樱桃', '橙子', '橘子', '香蕉', '香菜', '香菇', '苹果', '平菇',
+    '葡萄', '蓝莓', '草莓', '牛肉', '牛奶', '鸡蛋', '鸡胸肉', '大米', '大虾', '螃蟹', '土豆', '黄瓜', '西瓜',
+    '游戏机', '手柄', '耳机', '充电器', '数据线', '方便面', '方糖', '饭团',
+)
+NAME_SUFFIXES = ('', '礼盒', '500g', '1kg', '家庭装', '组合装', 'Pro', 'Max', '特惠装')
+MERCHANT_WORDS = ('沃尔玛', '山姆', '盒马', '永辉', '华润', '物美', '家乐福', '大润发', '世纪联华', '便利蜂')
+
+# 固定的查询组合: 中文完整/前缀、全拼、首字母、单字符、未命中、拼写错误
+QUERY_MIX = (
+    '番茄', '番', '香', '车厘子', '游戏机', 'fanqie', 'fan', 'xiangjiao', 'niunai', 'fq', 'cl', 'yxj',
+    's', 'a', 'pro', 'max', '山姆', 'shanmu', 'hema', 'zzzzzz', 'fanqei', 'xiangjoa',
+)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, query_counts):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'queries_per_request': round(sum(query_counts) / len(query_counts), 2),
+    }
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux 单位是 KB, macOS 是 byte
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = '生成确定性的合成商品库, 跑固定的查询组合, 以 JSON 输出搜索的延迟分位数/查询次数/峰值内存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=10000, help='商品数量, 如 10000 / 100000 / 1000000')
+        parser.add_argument('--seed', type=int, default=20220213)
+        parser.add_argument('--rounds', type=int, default=5, help='查询组合重复的轮数')
+        parser.add_argument('--with-cache', action='store_true', help='走 do_search (含结果缓存), 默认直接测搜索本身')
+        parser.add_argument('--current-db', action='store_true', help='直接写入当前数据库, 默认使用临时的测试数据库')
+        parser.add_argument('--output', type=str, default='', help='结果写入文件, 默认输出到 stdout')
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['current_db']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            report = self.run(options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        out = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(out)
+        else:
+            self.stdout.write(out)
+
+    def run(self, options):
+        from mall.search_backends import get_search_backend
+
+        started = time.monotonic()
+        self.generate_catalog(options['size'], options['seed'])
+        build_seconds = time.monotonic() - started
+
+        request = Request(RequestFactory().get('/api/v1/search/'))
+        search = self.bench(
+            'search', request, options,
+            lambda s: {'s': s, 'type': 'all'},
+        )
+        search_merchant = self.bench(
+            'search-merchant', request, options,
+            lambda s: {'s': s},
+        )
+        return {
+            'commit': git_commit(),
+            'size': options['size'],
+            'seed': options['seed'],
+            'backend': type(get_search_backend()).__name__,
+            'database': connection.vendor,
+            'with_cache': options['with_cache'],
+            'catalog_build_seconds': round(build_seconds, 2),
+            'search': search,
+            'search_merchant': search_merchant,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    def bench(self, kind, request, options, make_params):
+        from mall.serializers import SearchSerializer, MerchantSearchSerializer
+
+        serializer_class = SearchSerializer if kind == 'search' else MerchantSearchSerializer
+        latencies = []
+        query_counts = []
+        # 先跑一轮预热 (进程内索引懒加载等), 不计入结果
+        for round_idx in range(options['rounds'] + 1):
+            for s in QUERY_MIX:
+                with CaptureQueriesContext(connection) as ctx:
+                    t0 = time.perf_counter()
+                    serializer = serializer_class(data=make_params(s), context={'request': request})
+                    serializer.is_valid(raise_exception=True)
+                    if options['with_cache']:
+                        serializer.do_search(serializer.validated_data)
+                    else:
+                        # 跳过 @cached
+                        serializer_class._do_search.__wrapped__(serializer, serializer.validated_data)
+                    elapsed = time.perf_counter() - t0
+                if round_idx > 0:
+                    latencies.append(elapsed)
+                    query_counts.append(len(ctx.captured_queries))
+        return summarize(latencies, query_counts)
+
+    def generate_catalog(self, size, seed, chunk_size=5000):
+        from mall.models import Merchant, MerchantProductsTab, Product
+        from mall.pinyin_service import batch_generate_keywords, build_keywords
+        from mall.ranking import product_search_score, merchant_search_score
+        from mall.signals import catalog_bulk_changed
+
+        rnd = random.Random(seed)
+
+        merchant_cnt = max(size // 1000, 2)
+        merchant_names = [f'{MERCHANT_WORDS[i % len(MERCHANT_WORDS)]}{i // len(MERCHANT_WORDS) + 1}号店' for i in range(merchant_cnt)]
+        merchants = []
+        for name in merchant_names:
+            sales = rnd.randint(0, 100000)
+            rank = rnd.randint(0, 999)
+            pinyin_keywords, search_keywords = build_keywords(name)
+            merchants.append(Merchant(
+                name=name, sales=sales, rank=rank, pinyin_keywords=pinyin_keywords, search_keywords=search_keywords,
+                search_score=merchant_search_score(sales, rank),
+            ))
+        merchants = Merchant.objects.bulk_create(merchants)
+        if connection.features.can_return_rows_from_bulk_insert:
+            merchant_ids = [m.pk for m in merchants]
+        else:
+            merchant_ids = list(Merchant.objects.order_by('pk').values_list('pk', flat=True))
+        MerchantProductsTab.objects.bulk_create([
+            MerchantProductsTab(merchant_id=m_id, name='全部', slug='all', rank=9999) for m_id in merchant_ids
+        ])
+        tab_ids = dict(MerchantProductsTab.objects.values_list('merchant_id', 'pk'))
+
+        created = 0
+        while created < size:
+            n = min(chunk_size, size - created)
+            names = [
+                f'{rnd.choice(NAME_PREFIXES)}{rnd.choice(NAME_ITEMS)}{rnd.choice(NAME_SUFFIXES)}'
+                for _ in range(n)
+            ]
+            objs = []
+            for name, pinyin_keywords in zip(names, batch_generate_keywords(names)):
+                merchant_id = rnd.choice(merchant_ids)
+                sales = int(rnd.paretovariate(1.2)) - 1
+                price = Decimal(rnd.randint(100, 100000)) / 100
+                objs.append(Product(
+                    merchant_id=merchant_id, tab_id=tab_ids[merchant_id], name=name,
+                    pinyin_keywords=pinyin_keywords[:191], search_keywords=f'{name},{pinyin_keywords}'[:191],
+                    price=price, old_price=price, sales=sales, search_score=product_search_score(sales),
+                ))
+            Product.objects.bulk_create(objs, batch_size=1000)
+            created += n
+        catalog_bulk_changed(merchant_ids)
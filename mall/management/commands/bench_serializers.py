@@ -0,0 +1,150 @@
+import json
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from rest_framework.request import Request
+
+from .bench_search import Command as BenchSearchCommand, git_commit, peak_rss_mb, percentile
+
+
+class Command(BaseCommand):
+    help = '对比列表序列化的 DRF 路径和 fast_serializers 路径 (取数 + 序列化), 以 JSON 输出每秒行数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=10000, help='商品数量')
+        parser.add_argument('--orders', type=int, default=2000, help='订单数量, 每个订单 5 个订单项')
+        parser.add_argument('--page-size', type=int, default=100, help='每次序列化的行数')
+        parser.add_argument('--seed', type=int, default=20220213)
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--current-db', action='store_true', help='直接写入当前数据库, 默认使用临时的测试数据库')
+        parser.add_argument('--output', type=str, default='', help='结果写入文件, 默认输出到 stdout')
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['current_db']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            report = self.run(options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        out = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(out)
+        else:
+            self.stdout.write(out)
+
+    def run(self, options):
+        from mall.models import Merchant, Order, Product
+        from mall.serializers import MerchantSerializer, OrderSerializer, ProductSerializer, ProductWithMerchantSerializer
+
+        BenchSearchCommand().generate_catalog(options['size'], options['seed'])
+        self.generate_images_and_orders(options['orders'], options['seed'])
+
+        request = Request(RequestFactory().get('/api/v1/products/'))
+        results = {}
+        for serializer_class, qs in (
+                (ProductSerializer, Product.objects.order_by('id')),
+                (ProductWithMerchantSerializer, Product.objects.order_by('id')),
+                (MerchantSerializer, Merchant.objects.order_by('-rank', 'id')),
+                (OrderSerializer, Order.objects.order_by('-create_at', '-id')),
+        ):
+            results[serializer_class.__name__] = self.bench(serializer_class, qs, request, options)
+        return {
+            'commit': git_commit(),
+            'size': options['size'],
+            'orders': options['orders'],
+            'page_size': options['page_size'],
+            'seed': options['seed'],
+            'database': connection.vendor,
+            'results': results,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    def bench(self, serializer_class, qs, request, options):
+        from mall.fast_serializers import compile_serializer
+        from mall.query_planner import plan_queryset
+
+        page_size = options['page_size']
+        total = qs.count()
+        offsets = [(i * page_size) % max(total - page_size, 1) for i in range(options['rounds'])]
+        context = {'request': request}
+
+        def drf(offset):
+            page = list(plan_queryset(qs, serializer_class)[offset:offset + page_size])
+            return serializer_class(instance=page, many=True, context=context).data
+
+        def fast(offset):
+            compiled = compile_serializer(serializer_class, context)
+            return compiled.to_representation(compiled.values(qs)[offset:offset + page_size])
+
+        report = {}
+        for name, func in (('drf', drf), ('fast', fast)):
+            # 第一次不计入 (url 解析等缓存)
+            func(0)
+            latencies = []
+            rows = 0
+            for offset in offsets:
+                t0 = time.perf_counter()
+                rows += len(func(offset))
+                latencies.append(time.perf_counter() - t0)
+            latencies.sort()
+            report[name] = {
+                'rows_per_second': round(rows / sum(latencies)),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            }
+        report['speedup'] = round(report['fast']['rows_per_second'] / report['drf']['rows_per_second'], 2)
+        return report
+
+    def generate_images_and_orders(self, order_cnt, seed):
+        """
+        图片只写记录不写文件; 订单直接 bulk_create, 不走总价重算
+        """
+        from mall.models import AppImage, Merchant, Order, OrderItem, OrderStatus, Product, User, UserExpressAddress
+        from mall.signals import catalog_bulk_changed
+
+        rnd = random.Random(seed)
+        AppImage.objects.bulk_create([
+            AppImage(img=f'bench/{i}.png', width=200, height=200, desc=f'bench {i}') for i in range(100)
+        ])
+        image_ids = list(AppImage.objects.values_list('pk', flat=True))
+        for merchant in Merchant.objects.all():
+            merchant.img_id = rnd.choice(image_ids)
+            merchant.save(update_fields=['img'])
+        product_ids = list(Product.objects.values_list('pk', flat=True))
+        # 约 80% 的商品有图
+        by_image = {}
+        for pk in product_ids:
+            if rnd.random() < 0.8:
+                by_image.setdefault(rnd.choice(image_ids), []).append(pk)
+        for image_id, pks in by_image.items():
+            for i in range(0, len(pks), 500):
+                Product.objects.filter(pk__in=pks[i:i + 500]).update(img_id=image_id)
+        catalog_bulk_changed(Product.objects.filter(pk__in=product_ids).values_list('merchant_id', flat=True).distinct())
+
+        user = User.objects.create(username='bench-serializers')
+        address = UserExpressAddress.objects.create(
+            creator=user, name='bench', phone_number='13800000000', address_full_txt='bench',
+        )
+        products = dict(Product.objects.values_list('pk', 'merchant_id'))
+        orders = []
+        items = []
+        for i in range(order_cnt):
+            order_products = rnd.sample(product_ids, 5)
+            order = Order(
+                id=f'bench{i:016d}', user=user, address=address, merchant_id=products[order_products[0]],
+                status=OrderStatus.STATUS_WAITING_TO_PAY, price_total=Decimal('0'),
+            )
+            orders.append(order)
+            items.extend(OrderItem(order=order, product_id=pk, price=Decimal('9.90'), quantity=rnd.randint(1, 5))
+                         for pk in order_products)
+        Order.objects.bulk_create(orders, batch_size=1000)
+        OrderItem.objects.bulk_create(items, batch_size=1000)
@@ -1,12 +1,112 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from mall.pinyin_service import build_keywords
+
+
+def compute_chunk(rows, force=False):
+    """
+    在子进程中执行, rows: [(id, name, pinyin_keywords, search_keywords), ...]
+    """
+    out = []
+    for pk, name, pinyin_keywords, search_keywords in rows:
+        if force:
+            pinyin_keywords = search_keywords = None
+        out.append((pk, *build_keywords(name, pinyin_keywords, search_keywords)))
+    return out
 
 
 class Command(BaseCommand):
+    help = '生成商品/商户的拼音及搜索关键字; 默认只补全为空的行, --force 重新生成全部'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='忽略已有关键字, 全部重新生成')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='进程数, 1 表示不使用进程池')
+
     def handle(self, *args, **options):
         from mall.models import Product, Merchant
-        for p in Product.objects.all():
-            p.init_keywords()
-            p.save(init_keywords_called=True)
-        for m in Merchant.objects.all():
-            m.init_keywords()
-            m.save(init_keywords_called=True)
+        from mall.signals import catalog_bulk_changed
+
+        force = options['force']
+        chunk_size = options['chunk_size']
+        self.workers = workers = options['workers']
+
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        # bulk_update 不发 signals, 写完之后统一递增版本号
+        self.merchant_ids = set()
+        try:
+            for model in (Product, Merchant):
+                started = time.monotonic()
+                cnt = self.init_model_keywords(model, executor, force, chunk_size)
+                self.stdout.write(f'{model._meta.model_name}: {cnt} rows updated, {time.monotonic() - started:.1f}s')
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if self.merchant_ids:
+                catalog_bulk_changed(self.merchant_ids)
+
+    @staticmethod
+    def iter_chunks(model, force, chunk_size):
+        """
+        按主键分段读取; 不用 iterator(), MySQL 驱动会把整个结果集读进内存, 且边读边写同一张表不安全
+        """
+        qs = model.objects.order_by('pk')
+        if not force:
+            qs = qs.filter(
+                Q(pinyin_keywords__isnull=True) | Q(pinyin_keywords='') |
+                Q(search_keywords__isnull=True) | Q(search_keywords='')
+            )
+        last_pk = 0
+        while True:
+            rows = list(
+                qs.filter(pk__gt=last_pk).values_list('id', 'name', 'pinyin_keywords', 'search_keywords')[:chunk_size]
+            )
+            if not rows:
+                return
+            last_pk = rows[-1][0]
+            yield rows
+
+    def init_model_keywords(self, model, executor, force, chunk_size):
+        from mall.models import Merchant
+
+        chunks = self.iter_chunks(model, force, chunk_size)
+        if executor is None:
+            results = (compute_chunk(rows, force) for rows in chunks)
+        else:
+            results = self.map_bounded(executor, chunks, force, max_pending=2 * self.workers)
+
+        cnt = 0
+        for result in results:
+            now = timezone.now()
+            objs = [
+                model(id=pk, pinyin_keywords=pinyin_keywords, search_keywords=search_keywords, update_at=now)
+                for pk, pinyin_keywords, search_keywords in result
+            ]
+            model.objects.bulk_update(objs, ['pinyin_keywords', 'search_keywords', 'update_at'], batch_size=chunk_size)
+            pks = [obj.pk for obj in objs]
+            if model is Merchant:
+                self.merchant_ids.update(pks)
+            else:
+                self.merchant_ids.update(model.objects.filter(pk__in=pks).values_list('merchant_id', flat=True).distinct())
+            cnt += len(objs)
+        return cnt
+
+    @staticmethod
+    def map_bounded(executor, chunks, force, max_pending):
+        """
+        executor.map 会一次性把所有 chunk 提交出去, 这里最多同时挂 2 * 进程数 个, 内存占用与表大小无关
+        """
+        pending = deque()
+        for rows in chunks:
+            pending.append(executor.submit(compute_chunk, rows, force))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from mall.db_router import copy_sqlite_database
+
+
+class Command(BaseCommand):
+    help = '本地用 SQLite 模拟只读副本: 把 default 库整个复制到 DATABASE_REPLICA_URLS 配置的各个 SQLite 库'
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('没有配置 DATABASE_REPLICA_URLS')
+        for alias in (DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS):
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f'{alias} 不是 SQLite 数据库')
+        for alias in settings.DATABASE_REPLICAS:
+            copy_sqlite_database(DEFAULT_DB_ALIAS, alias)
+            self.stdout.write(f'{DEFAULT_DB_ALIAS} -> {alias} ({connections[alias].settings_dict["NAME"]})')
@@ -0,0 +1,77 @@
+"""
+商户商品/类目接口的响应缓存
+
+/merchants/{id}/products/ 和 /merchants/{id}/tabs/ 渲染好的 JSON / MessagePack bytes 按 (商户, 查询参数) 缓存在
+两级缓存 (见 tiered_cache) 里. 每个商户有自己的版本号, 该商户的 Product / MerchantProductsTab / 商品图片变更时由 signals 递增,
+只失效这一个商户的缓存, 代价 O(1); 失效后只有一个请求重算, 其余请求在 STALE_TIMEOUT 内拿到旧的页面.
+
+ETag 由同样的 (商户, 版本号, 查询参数) 算出, 客户端带 If-None-Match 命中时直接返回 304, 不查库也不序列化.
+"""
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .db_router import replica_lagging
+from .search_cache import advance_version, catalog_versions_enabled, get_catalog_version
+from .streaming import is_stream_request
+from .tiered_cache import TieredCache, cached_response, request_cache_key
+
+MERCHANT_VERSION_KEY = 'mall:merchant-version:%s'
+
+
+def get_merchant_version(merchant_id) -> int:
+    cache = caches[settings.CATALOG_VERSION_CACHE_ALIAS]
+    key = MERCHANT_VERSION_KEY % merchant_id
+    version = cache.get(key)
+    if version is None:
+        # 和全局版本号一样以时间戳起步, 缓存被清空后不会撞上旧版本
+        cache.add(key, get_catalog_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_merchant_version(merchant_id) -> int:
+    cache = caches[settings.CATALOG_VERSION_CACHE_ALIAS]
+    key = MERCHANT_VERSION_KEY % merchant_id
+    try:
+        return advance_version(cache, key, get_merchant_version(merchant_id))
+    except ValueError:
+        return advance_version(cache, key, get_merchant_version(merchant_id))
+
+
+_page_cache: Optional[TieredCache] = None
+
+
+def get_merchant_page_cache() -> TieredCache:
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = TieredCache(timeout=settings.MERCHANT_CATALOG_CACHE_TIMEOUT, cache_alias=settings.MERCHANT_CATALOG_CACHE_ALIAS)
+    return _page_cache
+
+
+@receiver(setting_changed)
+def reset_merchant_page_cache(setting=None, **kwargs):
+    global _page_cache
+    if setting in (None, 'TIERED_CACHE', 'MERCHANT_CATALOG_CACHE_ALIAS', 'MERCHANT_CATALOG_CACHE_TIMEOUT'):
+        _page_cache = None
+
+
+def cached_merchant_action(kind: str):
+    """
+    MerchantViewSet 的 detail action 用, 放在 @action 之下; ?stream= 的流式输出、版本号不可靠、
+    读的副本可能还没同步到这个商户最近的变更时不缓存
+    """
+    return cached_response(
+        key=lambda view, request, pk=None, **kwargs: (
+            None if (
+                is_stream_request(request)
+                or not catalog_versions_enabled()
+                or replica_lagging(lambda: get_merchant_version(pk))
+            ) else request_cache_key(f'mall:merchant:{pk}:{kind}', request)
+        ),
+        version=lambda view, request, pk=None, **kwargs: get_merchant_version(pk),
+        backend=get_merchant_page_cache,
+    )
@@ -3,6 +3,8 @@
 from django.db import migrations, models
 from django.db.models import Q
 
+KEYWORD_FIELDS = ['name', 'pinyin_keywords', 'search_keywords']
+
 
 def init_keyword(apps, schema_editor):
     try:
@@ -17,13 +19,14 @@ def init_keyword(apps, schema_editor):
     db_alias = schema_editor.connection.alias
 
     if Product is not None:
-        for product in Product.objects.using(db_alias).filter(Q(pinyin_keywords__isnull=True) | Q(search_keywords__isnull=True)):
+        # 这里用的是当前的 model, 只读写本次迁移存在的字段, 以免后续迁移新增的列还不存在
+        for product in Product.objects.using(db_alias).filter(Q(pinyin_keywords__isnull=True) | Q(search_keywords__isnull=True)).only(*KEYWORD_FIELDS):
             product.init_keywords()
-            product.save(init_keywords_called=True)
+            product.save(init_keywords_called=True, update_fields=KEYWORD_FIELDS)
     if Merchant is not None:
-        for merchant in Merchant.objects.using(db_alias).filter(Q(pinyin_keywords__isnull=True) | Q(search_keywords__isnull=True)):
+        for merchant in Merchant.objects.using(db_alias).filter(Q(pinyin_keywords__isnull=True) | Q(search_keywords__isnull=True)).only(*KEYWORD_FIELDS):
             merchant.init_keywords()
-            merchant.save(init_keywords_called=True)
+            merchant.save(init_keywords_called=True, update_fields=KEYWORD_FIELDS)
 
 
 class Migration(migrations.Migration):
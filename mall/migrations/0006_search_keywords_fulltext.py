@@ -0,0 +1,33 @@
+from django.db import migrations
+
+FULLTEXT_INDEXES = (
+    ('mall_product', 'mall_product_search_keywords_ft'),
+    ('mall_merchant', 'mall_merchant_search_keywords_ft'),
+)
+
+
+def create_fulltext_index(apps, schema_editor):
+    # 只有 MySQL 支持 ngram parser, 其它数据库继续使用 icontains
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    for table, index_name in FULLTEXT_INDEXES:
+        schema_editor.execute(
+            f'ALTER TABLE `{table}` ADD FULLTEXT INDEX `{index_name}` (`search_keywords`) WITH PARSER ngram'
+        )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    for table, index_name in FULLTEXT_INDEXES:
+        schema_editor.execute(f'ALTER TABLE `{table}` DROP INDEX `{index_name}`')
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('mall', '0005_auto_20220213_1357'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.11 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+def init_search_score(apps, schema_editor):
+    from mall.ranking import product_search_score_expression, merchant_search_score_expression
+
+    db_alias = schema_editor.connection.alias
+    apps.get_model('mall', 'Product').objects.using(db_alias).update(search_score=product_search_score_expression())
+    apps.get_model('mall', 'Merchant').objects.using(db_alias).update(search_score=merchant_search_score_expression())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mall', '0006_search_keywords_fulltext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='merchant',
+            name='search_score',
+            field=models.FloatField(db_index=True, default=0, editable=False, verbose_name='搜索静态分'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='search_score',
+            field=models.FloatField(db_index=True, default=0, editable=False, verbose_name='搜索静态分'),
+        ),
+        migrations.RunPython(init_search_score, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.11 on 2026-10-18 12:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mall', '0007_search_score'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='merchant',
+            index=models.Index(fields=['rank', 'id'], name='mall_merchant_rank_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'create_at', 'id'], name='mall_order_user_create_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ordercollection',
+            index=models.Index(fields=['create_at', 'id'], name='mall_ordercoll_create_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+"""
+重建 0006 的 FULLTEXT ngram 索引, 不使用 InnoDB 默认的停用词表
+
+默认停用词表里有 a / i 等单字母, ngram parser 会丢掉所有包含停用词的 gram, 拼音里的 fa / an / qi / ie / ai
+都不会进索引, 按拼音搜索 (如 ai、fanqie) 查不到. 停用词表在建索引时确定, 这里在当前会话关掉后重建.
+
+副本、以及之后手工重建索引 (OPTIMIZE / ALTER TABLE) 时用的是服务端的设置, MySQL 配置里也要设置
+innodb_ft_enable_stopword = OFF, 主库和副本都要.
+"""
+from django.db import migrations
+
+FULLTEXT_INDEXES = (
+    ('mall_product', 'mall_product_search_keywords_ft'),
+    ('mall_merchant', 'mall_merchant_search_keywords_ft'),
+)
+
+
+def rebuild_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    schema_editor.execute('SET SESSION innodb_ft_enable_stopword = OFF')
+    for table, index_name in FULLTEXT_INDEXES:
+        schema_editor.execute(f'ALTER TABLE `{table}` DROP INDEX `{index_name}`')
+        schema_editor.execute(
+            f'ALTER TABLE `{table}` ADD FULLTEXT INDEX `{index_name}` (`search_keywords`) WITH PARSER ngram'
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('mall', '0008_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_fulltext_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mall', '0009_fulltext_without_stopwords'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='merchant',
+            name='update_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='update_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
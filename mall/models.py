@@ -4,19 +4,11 @@ from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 import uuid
-from random import randint
-import pypinyin
 
-
-def generate_keywords(name):
-    pinyin_result1 = ''.join(pypinyin.lazy_pinyin(name, style=pypinyin.STYLE_INITIALS))
-    pinyin_result2 = ''.join(pypinyin.lazy_pinyin(name, style=pypinyin.STYLE_NORMAL))
-    out = []
-    if pinyin_result1:
-        out.append(pinyin_result1)
-    if pinyin_result2:
-        out.append(pinyin_result2)
-    return ','.join(out)
+from . import order_id
+from .order_totals import mark_order_dirty, mark_collection_dirty
+from .pinyin_service import generate_keywords, build_keywords  # noqa: F401
+from .ranking import product_search_score, merchant_search_score
 
 
 class AppImage(models.Model):
@@ -81,22 +73,23 @@ class Merchant(models.Model):
     express_price = models.IntegerField(verbose_name='基础运费', default=0)
 
     sales = models.IntegerField(verbose_name='销量', default=0)
+    search_score = models.FloatField(verbose_name='搜索静态分', default=0, db_index=True, editable=False)
 
     slogan = models.CharField(max_length=191, blank=True, verbose_name='促销文字说明')
 
     rank = models.IntegerField(verbose_name='排序(大->小)', default=999, db_index=True)
     create_at = models.DateTimeField(auto_now_add=True)
-    update_at = models.DateTimeField(auto_now=True)
+    update_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def init_keywords(self):
-        if self.pinyin_keywords is None or self.pinyin_keywords == "":
-            self.pinyin_keywords = limit_char_191(generate_keywords(self.name))
-        if self.search_keywords is None or self.search_keywords == "":
-            self.search_keywords = limit_char_191(f"{self.name},{self.pinyin_keywords}")
+        self.pinyin_keywords, self.search_keywords = build_keywords(self.name, self.pinyin_keywords, self.search_keywords)
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None, init_keywords_called=False):
         if not init_keywords_called:
             self.init_keywords()
+        self.search_score = merchant_search_score(self.sales, self.rank)
+        if update_fields is not None and ('sales' in update_fields or 'rank' in update_fields):
+            update_fields = {*update_fields, 'search_score'}
         super().save(force_insert, force_update, using, update_fields)
 
         tab_all = self.tabs.filter(slug='all').first()
@@ -115,6 +108,10 @@ class Merchant(models.Model):
     class Meta:
         ordering = ('-rank',)
         verbose_name = verbose_name_plural = "商户"
+        indexes = [
+            # 游标分页, 见 pagination.RankKeysetPagination
+            models.Index(fields=['rank', 'id'], name='mall_merchant_rank_id_idx'),
+        ]
 
 
 class MerchantProductsTab(models.Model):
@@ -151,19 +148,20 @@ class Product(models.Model):
     old_price = models.DecimalField(max_digits=12, decimal_places=2, verbose_name="初始单价")
     price = models.DecimalField(max_digits=12, decimal_places=2, verbose_name="当前单价")
     sales = models.IntegerField(verbose_name='销量', default=0)
+    search_score = models.FloatField(verbose_name='搜索静态分', default=0, db_index=True, editable=False)
 
     create_at = models.DateTimeField(auto_now_add=True)
-    update_at = models.DateTimeField(auto_now=True)
+    update_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def init_keywords(self):
-        if self.pinyin_keywords is None or self.pinyin_keywords == "":
-            self.pinyin_keywords = limit_char_191(generate_keywords(self.name))
-        if self.search_keywords is None or self.search_keywords == "":
-            self.search_keywords = limit_char_191(f"{self.name},{self.pinyin_keywords}")
+        self.pinyin_keywords, self.search_keywords = build_keywords(self.name, self.pinyin_keywords, self.search_keywords)
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None, init_keywords_called=False):
         if not init_keywords_called:
             self.init_keywords()
+        self.search_score = product_search_score(self.sales)
+        if update_fields is not None and 'sales' in update_fields:
+            update_fields = {*update_fields, 'search_score'}
         super().save(force_insert, force_update, using, update_fields)
 
     def __str__(self):
@@ -176,27 +174,11 @@ class Product(models.Model):
         verbose_name = verbose_name_plural = "商品"
 
 
-ID_GENERATE_RETRY_CNT = 10
-local_order_id_set = set()
-
-
 def get_order_id():
-    # TODO: 跨进程主键冲突检测
-
-    if len(local_order_id_set) >= 10000:  # 防一手内存泄漏
-        local_order_id_set.clear()
-
-    for i in range(ID_GENERATE_RETRY_CNT):
-        dt_now = timezone.localtime(timezone.now())
-        rand_int = randint(1000, 9999)
-        dt_str = dt_now.strftime('%Y%m%d%H%M%S%f')[:-3]
-        candidate = '%s%04d' % (dt_str, rand_int)
-        if candidate in local_order_id_set:
-            continue
-        else:
-            local_order_id_set.add(candidate)
-            return candidate
-    raise RuntimeError(f"get_order_id fail, retry more than {ID_GENERATE_RETRY_CNT} times")
+    """
+    订单号, 见 order_id.py; 迁移文件里引用了 mall.models.get_order_id, 不能删
+    """
+    return order_id.get_order_id()
 
 
 class OrderStatus:
@@ -238,13 +220,25 @@ class OrderCollection(models.Model):
         return OrderStatus.STATUS_CHOICES_DICT[self.status]
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        acc = decimal.Decimal(0.0)
-        for order in self.orders.all():
-            acc = acc + order.price_total
-        self.price_total = acc
+        """
+        只改状态时传 update_fields=['status', 'update_at'], 不会触发总价重算
+        """
+        adding = self._state.adding
+        if self.price_total is None:
+            self.price_total = decimal.Decimal(0)
 
         super().save(force_insert, force_update, using, update_fields)
-        self.orders.update(status=self.status)
+
+        if not adding and (update_fields is None or 'status' in update_fields):
+            self.orders.update(status=self.status, update_at=timezone.now())
+        if update_fields is None or 'price_total' in update_fields:
+            mark_collection_dirty(self)
+
+    class Meta:
+        indexes = [
+            # 游标分页, 见 pagination.CreateAtKeysetPagination
+            models.Index(fields=['create_at', 'id'], name='mall_ordercoll_create_idx'),
+        ]
 
 
 class Order(models.Model):
@@ -266,17 +260,19 @@ class Order(models.Model):
     def status_txt(self):
         return OrderStatus.STATUS_CHOICES_DICT[self.status]
 
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        # 重新计算总价
-        acc = decimal.Decimal(0.0)
-        for item in self.items.all():
-            acc = acc + (item.price * item.quantity)
-        self.price_total = acc
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None, recompute=True):
+        """
+        recompute=False 时调用方自己负责 price_total 和 order_collection 的更新, 见 OrderSerializer.create_order;
+        只改状态时传 update_fields=['status', 'update_at'], 不会触发总价重算
+        """
+        if self.price_total is None:
+            self.price_total = decimal.Decimal(0)
 
         super().save(force_insert, force_update, using, update_fields)
 
-        if self.order_collection is not None:
-            self.order_collection.save()
+        # 重新计算总价 (连带所属的订单集合), 见 order_totals
+        if recompute and (update_fields is None or 'price_total' in update_fields):
+            mark_order_dirty(self)
 
     def __str__(self):
         return f"订单号: {self.id}"
@@ -284,6 +280,10 @@ class Order(models.Model):
     class Meta:
         verbose_name = verbose_name_plural = "订单"
         ordering = ("-create_at",)
+        indexes = [
+            # 游标分页, 见 pagination.CreateAtKeysetPagination
+            models.Index(fields=['user', 'create_at', 'id'], name='mall_order_user_create_idx'),
+        ]
 
 
 class OrderItem(models.Model):
@@ -294,7 +294,7 @@ class OrderItem(models.Model):
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         """
-        注意: 为了避免order_item创建时反复触发order的save, order创建时order_item应该采用 object.create 的方式
+        注意: 批量创建订单项请用 bulk_create 或放在 order_totals.deferred_totals() 块内, 订单总价只重算一次
         """
         if self.price is None:
             self.price = self.product.price
@@ -302,7 +302,7 @@ class OrderItem(models.Model):
         super().save(force_insert, force_update, using, update_fields)
 
         # 触发order重新计算总价
-        self.order.save()
+        mark_order_dirty(self.order)
 
     class Meta:
         verbose_name = verbose_name_plural = "订单项"
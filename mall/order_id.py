@@ -0,0 +1,165 @@
+"""
+订单号生成 (Snowflake 风格)
+
+17 位本地时间 (年月日时分秒毫秒) + [2 位机器号] + 2 位 worker id + 2 位毫秒内序号
+
+- 机器号取 ORDER_ID_MACHINE_ID, 多台机器部署时每台配置不同的值; 不配置时没有这一段, 与原来的 21 位格式一致
+- worker id 在 worker 启动时分配 (gymall/wsgi.py 调用 reserve): 对 ORDER_ID_LOCK_DIR 下的 worker-NN.lock 依次尝试 flock,
+  抢到哪个就用哪个, 文件句柄一直持有到进程退出 (崩溃时由内核释放). 占着 worker id 的进程 fork 出的子进程立即重新分配,
+  没有空闲的 worker id 时启动失败, 而不是等到第一次下单才报错
+- 同一进程内的多个线程共用 worker id, 序号在锁内递增; 同一毫秒内超过 MAX_SEQUENCE 个时借用下一毫秒,
+  时钟回拨时沿用上一次的毫秒数, 都不在锁内等待. 借用的毫秒数在流量回落、时钟追上之后自然归位
+
+机器号不同或同一台机器上 worker id 不同的进程之间不会冲突, 不需要重试, 也没有随时间增长的内存占用.
+"""
+import datetime
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+TIMESTAMP_LENGTH = 17
+MACHINE_ID_DIGITS = 2
+WORKER_ID_DIGITS = 2
+SEQUENCE_DIGITS = 2
+MAX_MACHINE_ID = 10 ** MACHINE_ID_DIGITS - 1
+MAX_WORKER_ID = 10 ** WORKER_ID_DIGITS - 1
+MAX_SEQUENCE = 10 ** SEQUENCE_DIGITS - 1
+
+
+class OrderIdParts(NamedTuple):
+    timestamp: str
+    machine_id: Optional[int]
+    worker_id: int
+    sequence: int
+
+
+def get_lock_dir() -> Path:
+    lock_dir = getattr(settings, 'ORDER_ID_LOCK_DIR', '')
+    return Path(lock_dir) if lock_dir else Path(tempfile.gettempdir()) / 'gymall-order-id'
+
+
+def get_machine_prefix() -> str:
+    machine_id = getattr(settings, 'ORDER_ID_MACHINE_ID', None)
+    if machine_id is None:
+        return ''
+    if not 0 <= machine_id <= MAX_MACHINE_ID:
+        raise ImproperlyConfigured(f'ORDER_ID_MACHINE_ID must be between 0 and {MAX_MACHINE_ID}, got {machine_id}')
+    return f'{machine_id:0{MACHINE_ID_DIGITS}d}'
+
+
+def _now_ms() -> int:
+    return time.time_ns() // 1000000
+
+
+def format_timestamp(ms: int) -> str:
+    dt = datetime.datetime.fromtimestamp(ms // 1000, tz=datetime.timezone.utc).replace(microsecond=(ms % 1000) * 1000)
+    return timezone.localtime(dt).strftime(TIMESTAMP_FORMAT)[:TIMESTAMP_LENGTH]
+
+
+def parse_order_id(order_id: str) -> OrderIdParts:
+    """
+    按长度区分有没有机器号
+    """
+    machine_id = None
+    worker_start = TIMESTAMP_LENGTH
+    if len(order_id) == TIMESTAMP_LENGTH + MACHINE_ID_DIGITS + WORKER_ID_DIGITS + SEQUENCE_DIGITS:
+        worker_start += MACHINE_ID_DIGITS
+        machine_id = int(order_id[TIMESTAMP_LENGTH:worker_start])
+    worker_end = worker_start + WORKER_ID_DIGITS
+    return OrderIdParts(
+        order_id[:TIMESTAMP_LENGTH], machine_id, int(order_id[worker_start:worker_end]), int(order_id[worker_end:]),
+    )
+
+
+class OrderIdGenerator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # fork 时别的线程可能正持有锁, 子进程里换一把新的
+        self._lock = threading.Lock()
+        reserved = self._worker_id is not None
+        self._reset()
+        if reserved:
+            self.reserve()
+
+    def _reset(self):
+        # 子进程里继承来的 fd 仍指向父进程持有的锁, 只丢弃不 close, 由父进程负责释放
+        self._pid = os.getpid()
+        self._lock_file = None
+        self._worker_id = None
+        self._last_ms = -1
+        self._sequence = 0
+
+    @property
+    def worker_id(self) -> int:
+        with self._lock:
+            return self._ensure_worker_id()
+
+    def reserve(self) -> int:
+        """
+        启动时分配 worker id, 没有空闲的就直接失败
+        """
+        return self.worker_id
+
+    def _ensure_worker_id(self) -> int:
+        if self._pid != os.getpid():
+            self._reset()
+        if self._worker_id is not None:
+            return self._worker_id
+
+        lock_dir = get_lock_dir()
+        lock_dir.mkdir(parents=True, exist_ok=True)
+        for worker_id in range(MAX_WORKER_ID + 1):
+            f = open(lock_dir / f'worker-{worker_id:0{WORKER_ID_DIGITS}d}.lock', 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            self._lock_file = f
+            self._worker_id = worker_id
+            return worker_id
+        raise RuntimeError(f'no free order id worker slot in {lock_dir}, all {MAX_WORKER_ID + 1} are taken')
+
+    def release(self):
+        with self._lock:
+            if self._lock_file is not None and self._pid == os.getpid():
+                self._lock_file.close()
+            self._reset()
+
+    def next_id(self) -> str:
+        machine_prefix = get_machine_prefix()
+        with self._lock:
+            worker_id = self._ensure_worker_id()
+            ms = max(_now_ms(), self._last_ms)
+            if ms == self._last_ms:
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    # 借用下一毫秒
+                    ms += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last_ms = ms
+            sequence = self._sequence
+        return f'{format_timestamp(ms)}{machine_prefix}{worker_id:0{WORKER_ID_DIGITS}d}{sequence:0{SEQUENCE_DIGITS}d}'
+
+
+order_id_generator = OrderIdGenerator()
+
+
+def get_order_id() -> str:
+    return order_id_generator.next_id()
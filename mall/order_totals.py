@@ -0,0 +1,130 @@
+"""
+订单/订单集合总价的延迟重算
+
+Order / OrderCollection / OrderItem 的 save() 不再各自在 Python 里累加一遍再层层触发上级的 save,
+只是把受影响的订单和订单集合标记为 dirty:
+
+- 在 deferred_totals() 块内, 标记会累积起来, 最外层块结束时 (仍在同一个事务内, 提交之前) 统一重算一次
+- 不在 deferred_totals() 块内时立即重算, 效果和以前逐次 save 相同
+
+重算用 SQL 聚合 SUM(price * quantity) / SUM(price_total) 直接 UPDATE, 再把新值回填到标记时传入的实例上.
+"""
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+_local = threading.local()
+
+
+class _DirtySet:
+    def __init__(self):
+        self.depth = 0
+        self.orders = {}
+        self.collections = {}
+
+    def clear(self):
+        self.orders = {}
+        self.collections = {}
+
+
+def _state() -> _DirtySet:
+    state = getattr(_local, 'state', None)
+    if state is None:
+        state = _local.state = _DirtySet()
+    return state
+
+
+def _total_field():
+    return DecimalField(max_digits=14, decimal_places=2)
+
+
+def _sum_subquery(qs, outer_field, expression):
+    return Coalesce(
+        Subquery(
+            qs.filter(**{outer_field: OuterRef('pk')}).order_by().values(outer_field)
+            .annotate(total=Sum(ExpressionWrapper(expression, output_field=_total_field())))
+            .values('total')[:1]
+        ),
+        Value(Decimal(0)),
+        output_field=_total_field(),
+    )
+
+
+def mark_order_dirty(order):
+    state = _state()
+    state.orders.setdefault(order.pk, []).append(order)
+    if order.order_collection_id is not None:
+        state.collections.setdefault(order.order_collection_id, [])
+    if state.depth == 0:
+        flush()
+
+
+def mark_collection_dirty(order_collection):
+    state = _state()
+    state.collections.setdefault(order_collection.pk, []).append(order_collection)
+    if state.depth == 0:
+        flush()
+
+
+def _refresh(model, instances_by_pk):
+    instances_by_pk = {pk: objs for pk, objs in instances_by_pk.items() if objs}
+    if not instances_by_pk:
+        return
+    for pk, price_total, update_at in model.objects.filter(pk__in=instances_by_pk).values_list('pk', 'price_total', 'update_at'):
+        for obj in instances_by_pk[pk]:
+            obj.price_total = price_total
+            obj.update_at = update_at
+
+
+def flush():
+    """
+    立即重算所有 dirty 的订单和订单集合
+    """
+    Order = apps.get_model('mall', 'Order')
+    OrderItem = apps.get_model('mall', 'OrderItem')
+    OrderCollection = apps.get_model('mall', 'OrderCollection')
+
+    state = _state()
+    orders, collections = state.orders, state.collections
+    state.clear()
+    now = timezone.now()
+
+    # 先订单后订单集合, 集合的总价依赖订单的总价
+    if orders:
+        Order.objects.filter(pk__in=orders).update(
+            price_total=_sum_subquery(OrderItem.objects.all(), 'order', F('price') * F('quantity')),
+            update_at=now,
+        )
+    if collections:
+        OrderCollection.objects.filter(pk__in=collections).update(
+            price_total=_sum_subquery(Order.objects.all(), 'order_collection', F('price_total')),
+            update_at=now,
+        )
+    _refresh(Order, orders)
+    _refresh(OrderCollection, collections)
+
+
+@contextmanager
+def deferred_totals(using=None):
+    """
+    块内的 save() 只做标记, 最外层块结束时在同一事务内统一重算一次; 出现异常时事务回滚, 标记丢弃
+    """
+    state = _state()
+    with transaction.atomic(using=using):
+        state.depth += 1
+        try:
+            yield
+        except BaseException:
+            state.depth -= 1
+            if state.depth == 0:
+                state.clear()
+            raise
+        state.depth -= 1
+        if state.depth == 0:
+            flush()
@@ -0,0 +1,131 @@
+"""
+多列 keyset (游标) 分页
+
+DRF 自带的 CursorPagination 只按第一个排序字段定位, 排序值重复时 (商户的 rank 默认都是 999) 要靠 OFFSET 跳过,
+这里按 ordering 的全部字段组成元组定位: WHERE (a, b) > (x, y) ORDER BY a, b LIMIT n+1, 不做 COUNT(*),
+翻到第几页代价都一样. ordering 最后一个字段必须唯一 (一般是 id), 需要有对应的联合索引.
+各字段的排序方向要一致 (全升序或全降序), 升序的联合索引可以倒着扫; 方向混合时索引用不上, 会退化成 filesort.
+
+游标里记录的是当前页第一条/最后一条的排序值, 支持上一页/下一页.
+"""
+import datetime
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, Cursor
+
+
+def keyset_after(ordering, values, reverse: bool = False) -> Q:
+    """
+    按 ordering 严格排在 values 之后的行: (a > x) or (a = x and b > y) or ...; reverse 时反过来
+    """
+    q = Q()
+    equal = {}
+    for name, value in zip(ordering, values):
+        field = name.lstrip('-')
+        descending = name.startswith('-') != reverse
+        q |= Q(**equal, **{f'{field}__{"lt" if descending else "gt"}': value})
+        equal[field] = value
+    return q
+
+
+class KeysetPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-id',)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.model = queryset.model
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        if reverse:
+            queryset = queryset.order_by(*(self._flip(name) for name in self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if self.cursor is not None:
+            queryset = queryset.filter(keyset_after(self.ordering, self._decode_position(self.cursor.position), reverse))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    @staticmethod
+    def _flip(name: str) -> str:
+        return name[1:] if name.startswith('-') else f'-{name}'
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for name in ordering:
+            # values() 的行是 dict, 见 fast_serializers.FastReadMixin
+            value = instance[name.lstrip('-')] if isinstance(instance, dict) else getattr(instance, name.lstrip('-'))
+            values.append(value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else str(value))
+        return json.dumps(values)
+
+    def _decode_position(self, position):
+        try:
+            values = json.loads(position)
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+            return [
+                self.model._meta.get_field(name.lstrip('-')).to_python(value)
+                for name, value in zip(self.ordering, values)
+            ]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[-1], self.ordering)
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[0], self.ordering)
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+
+class CreateAtKeysetPagination(KeysetPagination):
+    """
+    订单 / 订单集合: 最新的在前
+    """
+    ordering = ('-create_at', '-id')
+
+
+class RankKeysetPagination(KeysetPagination):
+    """
+    商户: rank 大的在前, rank 相同时新的在前
+    """
+    ordering = ('-rank', '-id')
+
+
+class IdKeysetPagination(KeysetPagination):
+    """
+    商品没有 rank 字段, 按主键
+    """
+    ordering = ('id',)
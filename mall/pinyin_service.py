@@ -0,0 +1,124 @@
+"""
+拼音关键字生成
+
+pypinyin.lazy_pinyin 每次都要做分词和多音字短语匹配, 商品名重复度又很高, 这里加两层缓存:
+
+- 整个名字 -> 关键字的 LRU 缓存
+- 单字 -> (首字母, 全拼) 的缓存, 只用于非多音字; 含多音字的汉字片段仍整体交给 lazy_pinyin 处理,
+  以保证结果和直接调用 lazy_pinyin 完全一致
+
+本模块不依赖 django, 可以在 init_search_keywords 的进程池里直接使用.
+"""
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+import pypinyin
+from pypinyin.constants import RE_HANS
+from pypinyin.pinyin_dict import pinyin_dict
+
+NAME_CACHE_SIZE = 100000
+CHAR_CACHE_SIZE = 30000
+
+STYLES = (pypinyin.STYLE_INITIALS, pypinyin.STYLE_NORMAL)
+
+
+def _is_monophonic(ch: str) -> bool:
+    readings = pinyin_dict.get(ord(ch))
+    return readings is not None and ',' not in readings
+
+
+@lru_cache(maxsize=CHAR_CACHE_SIZE)
+def char_pinyin(ch: str) -> Tuple[str, str]:
+    """
+    单字的 (首字母, 全拼)
+    """
+    return tuple(''.join(pypinyin.lazy_pinyin(ch, style=style)) for style in STYLES)
+
+
+def _iter_runs(name: str):
+    """
+    把名字切成连续的 汉字 / 非汉字 片段
+    """
+    start = 0
+    is_han = None
+    for i, ch in enumerate(name):
+        ch_is_han = RE_HANS.match(ch) is not None
+        if is_han is None:
+            is_han = ch_is_han
+        elif ch_is_han != is_han:
+            yield is_han, name[start:i]
+            start, is_han = i, ch_is_han
+    if start < len(name):
+        yield is_han, name[start:]
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def name_pinyin(name: str) -> Tuple[str, str]:
+    """
+    名字的 (首字母, 全拼), 与 ''.join(lazy_pinyin(name, style)) 的结果一致
+    """
+    initials = []
+    normal = []
+    for is_han, run in _iter_runs(name):
+        if not is_han:
+            initials.append(run)
+            normal.append(run)
+        elif all(_is_monophonic(ch) for ch in run):
+            for ch in run:
+                i, n = char_pinyin(ch)
+                initials.append(i)
+                normal.append(n)
+        else:
+            i, n = (''.join(pypinyin.lazy_pinyin(run, style=style)) for style in STYLES)
+            initials.append(i)
+            normal.append(n)
+    return ''.join(initials), ''.join(normal)
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def name_syllables(name: str) -> Tuple[str, ...]:
+    """
+    逐字的全拼, 非汉字片段保持原样作为一项, 同 lazy_pinyin(name)
+    """
+    return tuple(pypinyin.lazy_pinyin(name))
+
+
+def generate_keywords(name):
+    out = []
+    for pinyin_result in name_pinyin(name):
+        if pinyin_result:
+            out.append(pinyin_result)
+    return ','.join(out)
+
+
+def batch_generate_keywords(names: Iterable[str]) -> List[str]:
+    """
+    批量生成, 重复的名字只计算一次
+    """
+    names = list(names)
+    computed = {name: generate_keywords(name) for name in set(names)}
+    return [computed[name] for name in names]
+
+
+def _limit_chars(s: str, max_length: int):
+    return s if len(s) <= max_length else s[:max_length]
+
+
+def build_keywords(name: str, pinyin_keywords: Optional[str] = None, search_keywords: Optional[str] = None,
+                   max_length: int = 191) -> Tuple[str, str]:
+    """
+    补全 (pinyin_keywords, search_keywords), 已有的值保持不变
+    """
+    if not pinyin_keywords:
+        pinyin_keywords = _limit_chars(generate_keywords(name), max_length)
+    if not search_keywords:
+        search_keywords = _limit_chars(f"{name},{pinyin_keywords}", max_length)
+    return pinyin_keywords, search_keywords
+
+
+def cache_info():
+    return {
+        'name': name_pinyin.cache_info()._asdict(),
+        'char': char_pinyin.cache_info()._asdict(),
+        'syllables': name_syllables.cache_info()._asdict(),
+    }
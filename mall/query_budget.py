@@ -0,0 +1,156 @@
+"""
+每个请求的 SQL 预算: 查询次数、SQL 总耗时、重复出现的查询 (N+1)
+
+- QueryRecorder: 通过 connection.execute_wrapper 记录当前线程在所有数据库连接上执行的 SQL
+- QueryBudgetMiddleware: DEBUG 时加 Server-Timing 头; 每个请求的指标日志 (logger mall.query_budget) 为 DEBUG 级别,
+  查询次数超过 MAX_QUERIES 或发现 N+1 时打 warning
+- assert_query_budget: 测试用, 超出预算时抛 AssertionError 并列出重复的查询
+
+指纹把参数、字面量和 IN (...) 的长度都抹掉, 同一个指纹在一个请求里出现多次基本就是在循环里查库.
+"""
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_RE = re.compile(r'\bIN \((?:\s*(?:%s|\?|\$\d+)\s*,?)+\)', re.IGNORECASE)
+_SPACE_RE = re.compile(r'\s+')
+
+
+def fingerprint(sql: str) -> str:
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _IN_RE.sub('IN (...)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+class QueryRecorder:
+    """
+    with QueryRecorder() as recorder: ...
+
+    只记录当前线程; StreamingHttpResponse 在中间件返回之后才迭代, 迭代中的查询不会被记录
+    """
+
+    def __init__(self, using=None):
+        self.using = using
+        self.queries: List[Tuple[str, float]] = []
+        self._stack: Optional[ExitStack] = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        aliases = [self.using] if self.using else list(connections)
+        for alias in aliases:
+            self._stack.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+        self._stack = None
+
+    @property
+    def count(self) -> int:
+        return len(self.queries)
+
+    @property
+    def duration(self) -> float:
+        return sum(d for _, d in self.queries)
+
+    def repeated(self, threshold: int = 2) -> List[Tuple[str, int]]:
+        """
+        出现次数 >= threshold 的 (指纹, 次数), 按次数倒序
+        """
+        counter = Counter(fingerprint(sql) for sql, _ in self.queries)
+        return [(fp, n) for fp, n in counter.most_common() if n >= threshold]
+
+    def report(self) -> str:
+        lines = [f'{self.count} queries, {self.duration * 1000:.2f}ms']
+        for fp, n in self.repeated():
+            lines.append(f'  x{n}: {fp}')
+        return '\n'.join(lines)
+
+
+class QueryBudgetMiddleware:
+    """
+    放在 MIDDLEWARE 靠前的位置, session / 认证的查询也算在内
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        conf = settings.QUERY_BUDGET
+        if not conf['ENABLED']:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+
+        repeated = recorder.repeated(conf['REPEAT_THRESHOLD'])
+        if conf['SERVER_TIMING']:
+            timing = [
+                f'db;dur={recorder.duration * 1000:.2f};desc="{recorder.count} queries"',
+                f'app;dur={total * 1000:.2f}',
+            ]
+            if repeated:
+                timing.append(f'n1;desc="{len(repeated)} repeated"')
+            response['Server-Timing'] = ', '.join(timing)
+
+        extra = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': recorder.count,
+            'sql_ms': round(recorder.duration * 1000, 2),
+            'total_ms': round(total * 1000, 2),
+            'repeated': len(repeated),
+        }
+        metrics = ' '.join(f'{k}={v}' for k, v in extra.items())
+        if recorder.count > conf['MAX_QUERIES']:
+            logger.warning('query-budget exceeded %s', metrics, extra={'query_budget': extra})
+        else:
+            logger.debug('query-budget %s', metrics, extra={'query_budget': extra})
+        if repeated:
+            logger.warning('possible N+1 on %s %s:\n%s', request.method, request.path,
+                           '\n'.join(f'  x{n}: {fp}' for fp, n in repeated))
+        return response
+
+
+@contextmanager
+def assert_query_budget(queries: int, repeated: int = 1, using=None):
+    """
+    测试用:
+
+        with assert_query_budget(4):
+            self.client.get(...)
+
+    queries: 允许的最多查询次数; repeated: 同一指纹允许出现的最多次数, 默认 1 即不允许任何重复
+    """
+    with QueryRecorder(using=using) as recorder:
+        yield recorder
+    errors = []
+    if recorder.count > queries:
+        errors.append(f'expected at most {queries} queries, got {recorder.count}')
+    if any(n > repeated for _, n in recorder.repeated()):
+        errors.append(f'same query executed more than {repeated} time(s)')
+    if errors:
+        raise AssertionError('; '.join(errors) + '\n' + recorder.report() + '\n' +
+                             '\n'.join(f'  {sql}' for sql, _ in recorder.queries))
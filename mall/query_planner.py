@@ -0,0 +1,215 @@
+"""
+根据 serializer 自动生成 select_related / prefetch_related / only()
+
+把 serializer 会读取的属性整理成一组访问链 (如 ['product', 'merchant', 'name']), 再对照 model 的字段解析:
+
+- 普通字段 / 嵌套 serializer: 按 source 展开
+- HyperlinkedRelatedField / PrimaryKeyRelatedField: 只需要外键列, 不 join
+- SerializerMethodField 和 model 上的 property: 解析源码的 AST, 找出从 obj / self 出发的属性链,
+  例如 get_tab_slug 里的 obj.tab.slug
+- 属性链停在关联对象本身 (如 str(obj.product)) 时, 认为用到了整个对象: 取全部字段, 并同样解析它的 __str__
+
+正向外键/一对一走 select_related, 反向外键/多对多走 Prefetch (子查询集同样按这里的规则生成),
+列表接口的查询次数与行数无关.
+
+only() 只在读请求 (GET/HEAD/OPTIONS) 上使用: 写请求会 save(), 带 deferred 字段的 save 只写回已加载的字段.
+"""
+import ast
+import inspect
+import textwrap
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from django.utils.functional import cached_property
+from rest_framework import permissions, serializers
+
+from .sparse_fields import known_sparse_fieldsets
+
+Chain = List[str]
+
+
+@lru_cache(maxsize=None)
+def _function_chains(func, param_index: int):
+    """
+    func 中以第 param_index 个参数开头的最长属性链
+    """
+    try:
+        tree = ast.parse(textwrap.dedent(inspect.getsource(func)))
+    except (OSError, TypeError, SyntaxError):
+        return None
+    func_def = tree.body[0]
+    if not isinstance(func_def, (ast.FunctionDef, ast.AsyncFunctionDef)) or len(func_def.args.args) <= param_index:
+        return None
+    param = func_def.args.args[param_index].arg
+
+    chains = []
+
+    class Visitor(ast.NodeVisitor):
+        def visit_Attribute(self, node):
+            names = []
+            cur = node
+            while isinstance(cur, ast.Attribute):
+                names.append(cur.attr)
+                cur = cur.value
+            if isinstance(cur, ast.Name) and cur.id == param:
+                chains.append(tuple(reversed(names)))
+            else:
+                self.generic_visit(node)
+
+        def visit_Name(self, node):
+            # 整个对象被传出去 (如 str(obj))
+            if node.id == param:
+                chains.append(())
+
+    Visitor().visit(func_def)
+    return tuple(chains)
+
+
+def serializer_chains(serializer) -> List[Chain]:
+    chains = []
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if isinstance(field, serializers.SerializerMethodField):
+            method = getattr(serializer, field.method_name)
+            found = _function_chains(getattr(method, '__func__', method), 1)
+            chains.extend([list(c) for c in found] if found is not None else [[]])
+            continue
+
+        prefix = [] if field.source == '*' else list(field.source_attrs)
+        if isinstance(field, serializers.ListSerializer):
+            field = field.child
+        if isinstance(field, serializers.BaseSerializer):
+            chains.extend(prefix + c for c in (serializer_chains(field) or [[]]))
+        elif isinstance(field, (serializers.RelatedField, serializers.ManyRelatedField)):
+            chains.append(prefix + ['pk'])
+        else:
+            chains.append(prefix)
+    return chains
+
+
+class _Node:
+    def __init__(self, model):
+        self.model = model
+        self.fields = set()
+        self.whole = False
+        self.single: Dict[str, _Node] = {}
+        self.many: Dict[str, _Node] = {}
+
+    def resolve(self, chain: Chain):
+        opts = self.model._meta
+        if not chain:
+            if not self.whole:
+                self.whole = True
+                for c in _function_chains(self.model.__str__, 0) or ():
+                    if c:
+                        self.resolve(list(c))
+            return
+
+        name = opts.pk.name if chain[0] == 'pk' else chain[0]
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            attr = getattr(self.model, name, None)
+            fget = attr.fget if isinstance(attr, property) else attr.func if isinstance(attr, cached_property) else None
+            found = _function_chains(fget, 0) if fget is not None else None
+            if found is None:
+                # 方法等无法分析的属性, 按整个对象处理
+                self.resolve([])
+            else:
+                for c in found:
+                    self.resolve(list(c))
+            return
+
+        if not field.is_relation or (field.concrete and field.attname == name != field.name):
+            # 普通字段, 或者外键列本身 (如 user_id)
+            self.fields.add(field.name)
+            return
+        if field.concrete and (field.many_to_one or field.one_to_one):
+            self.fields.add(field.name)
+            if len(chain) > 1 and chain[1] in ('pk', field.target_field.name):
+                return
+            self.single.setdefault(field.name, _Node(field.related_model)).resolve(chain[1:])
+            return
+        if field.auto_created and not field.concrete and field.one_to_many:
+            child = self.many.setdefault(field.get_accessor_name(), _Node(field.related_model))
+            child.fields.add(field.field.name)
+            child.resolve(chain[1:])
+            return
+        # 多对多及其它, 由 prefetch 整体加载
+        self.many.setdefault(name, _Node(field.related_model)).resolve([])
+
+    def apply(self, qs, use_only: bool, extra_fields=()):
+        # only() 不能叠加调用, 后一次会覆盖前一次, 额外字段要一起传
+        select, only, prefetch = [], list(extra_fields), []
+
+        def walk(node: _Node, prefix: str):
+            opts = node.model._meta
+            names = {f.name for f in opts.concrete_fields} if node.whole else node.fields | {opts.pk.name}
+            only.extend(prefix + name for name in names)
+            for name, child in node.single.items():
+                select.append(prefix + name)
+                only.append(prefix + name)
+                walk(child, f'{prefix}{name}__')
+            for name, child in node.many.items():
+                prefetch.append(Prefetch(prefix + name, queryset=child.apply(child.model._default_manager.all(), use_only)))
+
+        walk(self, '')
+        if select:
+            qs = qs.select_related(*select)
+        if prefetch:
+            qs = qs.prefetch_related(*prefetch)
+        if use_only:
+            qs = qs.only(*sorted(set(only)))
+        return qs
+
+
+@lru_cache(maxsize=512)
+def build_plan(serializer_class, sparse_fieldsets=None) -> Optional[_Node]:
+    """
+    sparse_fieldsets: 见 sparse_fields, 只按裁剪后的字段生成查询; 要先经过 known_sparse_fieldsets
+    """
+    model = getattr(getattr(serializer_class, 'Meta', None), 'model', None)
+    if model is None:
+        return None
+    node = _Node(model)
+    for chain in serializer_chains(serializer_class(context={'sparse_fieldsets': sparse_fieldsets})):
+        node.resolve(chain)
+    return node
+
+
+def plan_queryset(qs, serializer_class, use_only: bool = True, extra_fields=(), sparse_fieldsets=None):
+    """
+    extra_fields: serializer 之外还会读取的字段, 如分页游标用到的排序字段
+    """
+    node = build_plan(serializer_class, known_sparse_fieldsets(serializer_class, sparse_fieldsets))
+    if node is None or node.model is not qs.model:
+        return qs
+    return node.apply(qs, use_only, extra_fields)
+
+
+class QueryPlannerMixin:
+    """
+    按当前 serializer 给 get_queryset() 加上 select_related / prefetch_related / only()
+    """
+
+    def get_queryset(self):
+        qs = super().get_queryset()
+        # 游标分页要从最后一行取排序字段生成 next 链接
+        ordering = getattr(self.paginator, 'ordering', None) or ()
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        return plan_queryset(
+            qs, self.get_serializer_class(),
+            use_only=self.request.method in permissions.SAFE_METHODS,
+            extra_fields=[o.lstrip('-') for o in ordering],
+            sparse_fieldsets=self.get_serializer_context().get('sparse_fieldsets'),
+        )
+
+    def get_planned_object(self, instance):
+        """
+        按当前 serializer 的计划重新取一次 instance, 写接口返回前使用, 返回值里的关联对象不再逐个查库
+        """
+        return self.get_queryset().get(pk=instance.pk)
@@ -0,0 +1,136 @@
+"""
+搜索排序
+
+最终得分 = 匹配档位 * TIER_WEIGHT + 静态分
+
+- 匹配档位在查询时计算: 名字完全相同 > 名字/全拼前缀 > 拼音首字母前缀 > 其它子串命中
+- 静态分 search_score 只和行本身有关 (销量、商户排序值), 随 save() 写入数据库并建了索引
+- 数据库按 (近似的匹配档位, 静态分) 取前 RANK_CANDIDATES 个候选, 再在 Python 里按精确的档位用堆取 top-k.
+  档位必须参与取候选: 只按静态分截断时, 命中超过 RANK_CANDIDATES 行后销量低的完全匹配会被截掉.
+  SQL 里的档位由名字和 pinyin_keywords ("首字母,全拼") 算出, 每一档的条件都不比 match_tier 严格
+"""
+import heapq
+import math
+from typing import Iterable, List, Optional, Tuple
+
+from django.db.models import Case, F, FloatField, IntegerField, Q, Value, When, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast, Greatest, Ln, RowNumber
+
+from .pinyin_service import name_pinyin
+
+MATCH_EXACT = 3
+MATCH_PREFIX = 2
+MATCH_INITIALS = 1
+MATCH_SUBSTRING = 0
+
+# 静态分在 0 ~ 20 左右, 保证档位优先
+TIER_WEIGHT = 100
+
+# 商户 rank 默认 999, 每 100 相当于销量翻 e 倍
+MERCHANT_RANK_WEIGHT = 0.01
+
+RANK_CANDIDATES = 200
+
+
+def product_search_score(sales: int) -> float:
+    return math.log1p(max(sales, 0))
+
+
+def merchant_search_score(sales: int, rank: int) -> float:
+    return math.log1p(max(sales, 0)) + rank * MERCHANT_RANK_WEIGHT
+
+
+def product_search_score_expression():
+    """
+    与 product_search_score 等价的 SQL 表达式, 用于批量回填
+    """
+    return Ln(Cast(Greatest(F('sales'), 0), FloatField()) + Value(1.0))
+
+
+def merchant_search_score_expression():
+    return product_search_score_expression() + Cast(F('rank'), FloatField()) * Value(MERCHANT_RANK_WEIGHT)
+
+
+def match_tier(q: str, name: str) -> int:
+    """
+    q 已经 normalize (strip + lower)
+    """
+    initials, full = (x.lower() for x in name_pinyin(name))
+    name = name.lower()
+    if q == name or q == full:
+        return MATCH_EXACT
+    if name.startswith(q) or full.startswith(q):
+        return MATCH_PREFIX
+    if initials.startswith(q):
+        return MATCH_INITIALS
+    return MATCH_SUBSTRING
+
+
+def top_k(s: str, rows: Iterable[Tuple[int, str, float]], limit: int) -> List[int]:
+    """
+    rows: (id, name, search_score), 返回得分最高的 limit 个 id
+    """
+    q = s.strip().lower()
+    scored = (
+        (match_tier(q, name) * TIER_WEIGHT + (search_score or 0.0), -pk, pk)
+        for pk, name, search_score in rows
+    )
+    return [pk for _, _, pk in heapq.nlargest(limit, scored)]
+
+
+def keywords_match_tier(q: str, keywords: str) -> int:
+    """
+    match_tier 在 search_keywords ("名字,首字母,全拼", 已 normalize) 上的近似, 条件同 match_tier_expression,
+    供进程内索引使用, 不用再算拼音
+    """
+    name, _, pinyin_keywords = keywords.partition(',')
+    initials, _, full = pinyin_keywords.partition(',')
+    if q == name or q == full:
+        return MATCH_EXACT
+    if name.startswith(q) or full.startswith(q):
+        return MATCH_PREFIX
+    if initials.startswith(q):
+        return MATCH_INITIALS
+    return MATCH_SUBSTRING
+
+
+def match_tier_expression(s: str):
+    """
+    match_tier 在 SQL 里的近似
+    """
+    q = s.strip().lower()
+    return Case(
+        When(Q(name__iexact=q) | Q(pinyin_keywords__iexact=q) | Q(pinyin_keywords__iendswith=f',{q}'), then=Value(MATCH_EXACT)),
+        When(Q(name__istartswith=q) | Q(pinyin_keywords__icontains=f',{q}'), then=Value(MATCH_PREFIX)),
+        When(pinyin_keywords__istartswith=q, then=Value(MATCH_INITIALS)),
+        default=Value(MATCH_SUBSTRING),
+        output_field=IntegerField(),
+    )
+
+
+def ranked(qs, s: str, limit: int, candidates: int = RANK_CANDIDATES) -> list:
+    """
+    qs 为已经按关键字过滤过的 queryset, 返回排好序的前 limit 个对象
+    """
+    rows = qs.annotate(match_tier=match_tier_expression(s)).order_by('-match_tier', '-search_score', 'pk') \
+        .values_list('pk', 'name', 'search_score')[:candidates]
+    ids = top_k(s, rows, limit)
+    objs = qs.in_bulk(ids)
+    return [objs[pk] for pk in ids if pk in objs]
+
+
+def top_n_per_group(qs, matched, partition_field: str, n: int, s: Optional[str] = None):
+    """
+    matched 中每个 partition_field 分组按 (匹配档位, 静态分) 取前 n 行, 返回 qs.filter(pk__in=...); 不传 s 时只按静态分
+
+    django 3.2 还不能直接 filter 窗口函数, 这里把 ROW_NUMBER() 的查询作为子查询嵌进去, 仍然只有一次查询
+    """
+    numbered = matched.order_by().annotate(
+        rn=Window(RowNumber(), partition_by=[F(partition_field)], order_by=[
+            *([match_tier_expression(s).desc()] if s is not None else []), F('search_score').desc(), F('pk').asc(),
+        ]),
+    ).values('pk', 'rn')
+    sql, params = numbered.query.sql_with_params()
+    pk_column = qs.model._meta.pk.column
+    return qs.filter(pk__in=RawSQL(f'SELECT numbered.{pk_column} FROM ({sql}) numbered WHERE numbered.rn <= %s', (*params, n)))
@@ -0,0 +1,103 @@
+"""
+JSON / MessagePack 渲染与解析
+
+- FastJSONRenderer / FastJSONParser: 装了 orjson 就用 orjson, 否则 (以及 orjson 处理不了的数据, 如超过 64 位的整数、
+  需要缩进的输出) 回退到 DRF 自带的实现. 输出与 DRF 的 JSONRenderer 相同: Decimal / UUID / datetime 等
+  orjson 不按 DRF 格式处理的类型都交给 DRF 的 JSONEncoder.default
+- MessagePackRenderer / MessagePackParser: application/msgpack, 需要 msgpack, 类型转换与 JSON 相同
+
+orjson / msgpack 都是可选依赖, 没装时 settings 不会启用 MessagePack
+"""
+import json
+
+from django.conf import settings
+from rest_framework import renderers
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_default = JSONEncoder().default
+
+if orjson is not None:
+    # datetime / date / time 交给 DRF 的格式 (UTC 用 Z 结尾), dict/list 的子类 (ReturnDict 等) 仍按原生类型处理
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+def dumps(data) -> bytes:
+    """
+    紧凑、不转义非 ASCII 字符的 JSON, 与 DRF 默认设置 (COMPACT_JSON / UNICODE_JSON) 下的 JSONRenderer 输出相同
+    """
+    if orjson is not None:
+        try:
+            ret = orjson.dumps(data, default=_default, option=_ORJSON_OPTIONS)
+        except TypeError:
+            # orjson.JSONEncodeError, 如整数超出 64 位
+            pass
+        else:
+            # 同 JSONRenderer: U+2028 / U+2029 在 JSON 里合法, 但在 JavaScript 字符串里不合法
+            return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    ret = json.dumps(data, cls=JSONEncoder, ensure_ascii=False, allow_nan=False, separators=(',', ':'))
+    return ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029').encode('utf-8')
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if (
+                type(self).encoder_class is not renderers.JSONRenderer.encoder_class
+                or not (api_settings.COMPACT_JSON and api_settings.UNICODE_JSON and api_settings.STRICT_JSON)
+                or self.get_indent(accepted_media_type or '', renderer_context or {})
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+class FastJSONParser(JSONParser):
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if orjson is None or not self.strict:
+            return super().parse(stream, media_type, parser_context)
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            raw = stream.read()
+            if encoding.lower().replace('-', '') != 'utf8':
+                raw = raw.decode(encoding)
+            return orjson.loads(raw)
+        except (ValueError, UnicodeDecodeError) as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class MessagePackRenderer(renderers.BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False, strict_map_key=False)
+        except (ValueError, msgpack.UnpackException) as exc:
+            raise ParseError('MessagePack parse error - %s' % str(exc))
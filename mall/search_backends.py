@@ -0,0 +1,142 @@
+"""
+搜索后端
+
+所有后端都只负责把 queryset 过滤成 "search_keywords 包含 s" 的结果集, 排序、limit、select_related 由调用方决定.
+
+- IContainsSearchBackend: search_keywords__icontains, 即 LIKE '%s%', SQLite/测试环境的兜底
+- MySQLFulltextSearchBackend: FULLTEXT(search_keywords) WITH PARSER ngram, 走 MATCH ... AGAINST
+- NGramIndexSearchBackend: 进程内 n-gram 倒排索引 (见 search_engine.py)
+
+通过 settings.SEARCH_BACKEND 指定后端的 dotted path, 为空时 MySQL 用 FULLTEXT, 其它数据库用 icontains.
+"""
+from typing import Optional
+
+from django.conf import settings
+from django.db import connections, router
+from django.core.signals import setting_changed
+from django.db.models import CharField, Lookup
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import Product
+from .search_engine import product_index, merchant_index
+
+
+@CharField.register_lookup
+class NgramMatch(Lookup):
+    """
+    search_keywords__ngram_match='...'  =>  MATCH (search_keywords) AGAINST ('"..."' IN BOOLEAN MODE)
+    """
+    lookup_name = 'ngram_match'
+
+    def get_db_prep_lookup(self, value, connection):
+        # 短语查询: ngram 分词后要求 token 连续出现, 语义接近子串匹配
+        value = '"%s"' % value.replace('"', ' ').strip()
+        return super().get_db_prep_lookup(value, connection)
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'MATCH ({lhs}) AGAINST ({rhs} IN BOOLEAN MODE)', lhs_params + rhs_params
+
+
+class BaseSearchBackend:
+    # 用到的进程内索引, worker 启动时预热, 见 search_engine.warm_up_indexes
+    indexes = ()
+
+    def filter_products(self, qs, s: str, merchant_id: Optional[int] = None):
+        raise NotImplementedError
+
+    def filter_merchants(self, qs, s: str):
+        raise NotImplementedError
+
+
+class IContainsSearchBackend(BaseSearchBackend):
+    def filter_products(self, qs, s: str, merchant_id: Optional[int] = None):
+        qs = qs.filter(search_keywords__icontains=s)
+        if merchant_id is not None:
+            qs = qs.filter(merchant_id=merchant_id)
+        return qs
+
+    def filter_merchants(self, qs, s: str):
+        return qs.filter(search_keywords__icontains=s)
+
+
+class MySQLFulltextSearchBackend(IContainsSearchBackend):
+    """
+    索引由 migrations/0006 创建, 需要 MySQL >= 5.7.6 (内置 ngram parser).
+    索引不能用 InnoDB 默认的停用词表 (migrations/0009), MySQL 要配置 innodb_ft_enable_stopword = OFF,
+    否则含 a / i 的拼音 gram 不进索引, ai、fanqie 等都查不到
+    """
+
+    # 对应 MySQL 的 ngram_token_size, 比它短的查询词 FULLTEXT 查不到, 回退到 icontains
+    ngram_token_size = 2
+
+    def _use_fulltext(self, qs, s: str):
+        if len(s.strip()) < self.ngram_token_size:
+            return False
+        connection = connections[qs.db]
+        if connection.vendor != 'mysql':
+            return False
+        # InnoDB 的 FULLTEXT 索引在事务提交后才更新, 事务内看不到自己刚写入的行
+        return not connection.in_atomic_block
+
+    def filter_products(self, qs, s: str, merchant_id: Optional[int] = None):
+        if not self._use_fulltext(qs, s):
+            return super().filter_products(qs, s, merchant_id)
+        qs = qs.filter(search_keywords__ngram_match=s)
+        if merchant_id is not None:
+            qs = qs.filter(merchant_id=merchant_id)
+        return qs
+
+    def filter_merchants(self, qs, s: str):
+        if not self._use_fulltext(qs, s):
+            return super().filter_merchants(qs, s)
+        return qs.filter(search_keywords__ngram_match=s)
+
+
+class NGramIndexSearchBackend(BaseSearchBackend):
+    """
+    候选 id 由进程内索引给出, 数据库只按主键取行; 附带的 icontains 只作用于这批主键, 用来剔除索引中的过期数据.
+
+    命中超过 max_candidates 个时, 在索引里按 匹配档位 + 静态分 取前 max_candidates 个作为候选
+    (索引里的顺序和排序无关, 直接截断可能截掉完全匹配), 不会退回全表扫描
+    """
+
+    max_candidates = 1000
+    indexes = (product_index, merchant_index)
+
+    def filter_products(self, qs, s: str, merchant_id: Optional[int] = None):
+        ids = product_index.search(s, group=merchant_id, limit=self.max_candidates + 1)
+        if len(ids) > self.max_candidates:
+            ids = product_index.top(s, self.max_candidates, group=merchant_id)
+        return qs.filter(pk__in=ids, search_keywords__icontains=s)
+
+    def filter_merchants(self, qs, s: str):
+        ids = merchant_index.search(s, limit=self.max_candidates + 1)
+        if len(ids) > self.max_candidates:
+            ids = merchant_index.top(s, self.max_candidates)
+        return qs.filter(pk__in=ids, search_keywords__icontains=s)
+
+
+_backend: Optional[BaseSearchBackend] = None
+
+
+def get_search_backend() -> BaseSearchBackend:
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'SEARCH_BACKEND', '')
+        if not path:
+            vendor = connections[router.db_for_read(Product)].vendor
+            path = 'mall.search_backends.MySQLFulltextSearchBackend' if vendor == 'mysql' \
+                else 'mall.search_backends.IContainsSearchBackend'
+        _backend = import_string(path)()
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_search_backend(setting=None, **kwargs):
+    global _backend
+    if setting in (None, 'SEARCH_BACKEND', 'DATABASES'):
+        _backend = None
+
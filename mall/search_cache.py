@@ -0,0 +1,210 @@
+"""
+搜索结果缓存
+
+缓存的是已经序列化好的返回值, key 为搜索参数, 版本号为全局商品目录版本号. Product / Merchant / AppImage / 类目
+有任何变更时递增版本号, 旧的缓存项自然失效, 不需要扫描删除. 批量修改 (不发 signals) 之后要调用 signals.catalog_bulk_changed.
+
+版本号存在 CATALOG_VERSION_CACHE_ALIAS 缓存里, 只有它跨进程共享 (redis / memcached) 时, 一个 worker 的写入才能让
+其它 worker 的缓存失效. catalog_versions_enabled() 为 False 时 (默认的 locmem) 依赖版本号的缓存都不启用.
+
+- LocMemLRUResultCache: 进程内 LRU
+- SharedResultCache: 走 django cache (生产环境配置成 redis, 本地默认 locmem)
+- mall.tiered_cache.TieredCache: 进程内 LRU + 共享缓存, 防击穿 (默认)
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+CATALOG_VERSION_KEY = 'mall:catalog-version'
+
+# 只在当前进程内可见的缓存 backend
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def is_shared_cache(alias: str) -> bool:
+    """
+    settings.SHARED_CACHE 为 None 时按 backend 判断
+    """
+    shared = getattr(settings, 'SHARED_CACHE', None)
+    if shared is not None:
+        return shared
+    return settings.CACHES[alias]['BACKEND'] not in LOCAL_CACHE_BACKENDS
+
+
+def catalog_versions_enabled() -> bool:
+    """
+    版本号所在的缓存跨进程共享时, 版本号才能反映其它 worker 的写入
+    """
+    return is_shared_cache(settings.CATALOG_VERSION_CACHE_ALIAS)
+
+
+def get_catalog_version() -> int:
+    cache = caches[settings.CATALOG_VERSION_CACHE_ALIAS]
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # 以时间戳起步, 缓存被清空后也不会和之前的版本号撞上
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def advance_version(cache, key: str, current: int) -> int:
+    """
+    版本号递增到当前的毫秒时间戳 (至少 +1), 所以版本号也是最近一次变更的时间, 见 db_router.replica_lagging.
+    并发递增时可能超过当前时间, 仍然单调递增
+    """
+    return cache.incr(key, max(1, int(time.time() * 1000) - current))
+
+
+def bump_catalog_version() -> int:
+    cache = caches[settings.CATALOG_VERSION_CACHE_ALIAS]
+    try:
+        return advance_version(cache, CATALOG_VERSION_KEY, get_catalog_version())
+    except ValueError:
+        # 读完之后刚好被清掉
+        return advance_version(cache, CATALOG_VERSION_KEY, get_catalog_version())
+
+
+class BaseResultCache:
+    def __init__(self, timeout=60, **kwargs):
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def get_or_set(self, key, compute: Callable, version=None):
+        """
+        这里版本号直接拼进 key; TieredCache 把版本号存在缓存项里, 以便版本号递增后仍能返回旧值
+        """
+        if version is not None:
+            key = f'{key}:{version}'
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = compute()
+        self.set(key, value)
+        return value
+
+    def stats(self):
+        return {
+            'backend': type(self).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class LocMemLRUResultCache(BaseResultCache):
+    def __init__(self, timeout=60, max_entries=1000, **kwargs):
+        super().__init__(timeout, **kwargs)
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expire_at, value = item
+            if expire_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        ret = super().stats()
+        ret['size'] = len(self._data)
+        return ret
+
+
+class SharedResultCache(BaseResultCache):
+    def __init__(self, timeout=60, cache_alias='default', **kwargs):
+        super().__init__(timeout, **kwargs)
+        self.cache_alias = cache_alias
+
+    def get(self, key):
+        return caches[self.cache_alias].get(key)
+
+    def set(self, key, value):
+        caches[self.cache_alias].set(key, value, timeout=self.timeout)
+
+    def delete(self, key):
+        caches[self.cache_alias].delete(key)
+
+    def clear(self):
+        caches[self.cache_alias].clear()
+
+
+def make_search_cache_key(kind: str, s: str, request=None, **params) -> Optional[str]:
+    """
+    返回值里的链接是绝对地址, 所以 host/scheme 也是 key 的一部分.
+    版本号不可靠, 或者读的副本可能还没同步到最近的变更时返回 None, 不缓存
+    """
+    from .db_router import replica_lagging
+
+    if not catalog_versions_enabled() or replica_lagging(get_catalog_version):
+        return None
+    base_url = request.build_absolute_uri('/') if request is not None else ''
+    raw = '|'.join([
+        kind,
+        s.strip().lower(),
+        *(f'{k}={params[k]}' for k in sorted(params)),
+        base_url,
+    ])
+    digest = hashlib.md5(raw.encode('utf-8')).hexdigest()
+    return f'mall:search:{digest}'
+
+
+_result_cache: Optional[BaseResultCache] = None
+
+
+def get_search_result_cache() -> BaseResultCache:
+    global _result_cache
+    if _result_cache is None:
+        conf = settings.SEARCH_RESULT_CACHE
+        _result_cache = import_string(conf['BACKEND'])(timeout=conf.get('TIMEOUT', 60), **conf.get('OPTIONS', {}))
+    return _result_cache
+
+
+@receiver(setting_changed)
+def reset_search_result_cache(setting=None, **kwargs):
+    global _result_cache
+    if setting in (None, 'SEARCH_RESULT_CACHE'):
+        _result_cache = None
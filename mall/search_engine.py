@@ -0,0 +1,323 @@
+"""
+进程内的 n-gram 倒排索引, 替代 search_keywords__icontains 的全表扫描
+
+索引内容为 search_keywords (中文名 + 拼音首字母 + 全拼), 按字符切 1-gram / 2-gram,
+查询时取 posting 最短的 gram 做候选集, 其余 gram 求交, 最后用子串匹配校验, 语义等同 icontains.
+
+- 启动时由 warm_up_indexes 从数据库(或快照文件)构建 (没有预热时在首次查询时构建), 之后由 signals 增量更新
+- 其它 worker 进程的写入通过定期按 update_at 增量同步获得
+- 被其它进程删除的行在按主键取行时自然被过滤掉
+"""
+import heapq
+import logging
+import pickle
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Merchant, Product
+from .ranking import TIER_WEIGHT, keywords_match_tier
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZE = 2
+SNAPSHOT_VERSION = 2
+BUILD_CHUNK_SIZE = 2000
+
+
+def normalize(s: str) -> str:
+    return s.strip().lower()
+
+
+def iter_grams(text: str) -> Iterable[str]:
+    """
+    text 已经 normalize 过; 同时产出 1-gram 和 2-gram, 单字符查询直接走 1-gram
+    """
+    for i in range(len(text)):
+        yield text[i]
+        if i + NGRAM_SIZE <= len(text):
+            yield text[i:i + NGRAM_SIZE]
+
+
+class NGramIndex:
+    """
+    doc_id -> (group, keywords, score) 的倒排索引, group 用于按商户过滤/分组商品, score 为静态分 search_score
+    """
+
+    def __init__(self):
+        self._docs: Dict[int, Tuple[Optional[int], str, float]] = {}
+        self._postings: Dict[str, set] = defaultdict(set)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, doc_id: int, keywords: Optional[str], group: Optional[int] = None, score: Optional[float] = None):
+        text = normalize(keywords or '')
+        doc = (group, text, score or 0.0)
+        with self._lock:
+            old = self._docs.get(doc_id)
+            if old is not None:
+                if old == doc:
+                    return
+                if old[1] == text:
+                    self._docs[doc_id] = doc
+                    return
+                self._discard_postings(doc_id, old[1])
+            self._docs[doc_id] = doc
+            for gram in set(iter_grams(text)):
+                self._postings[gram].add(doc_id)
+
+    def remove(self, doc_id: int):
+        with self._lock:
+            old = self._docs.pop(doc_id, None)
+            if old is not None:
+                self._discard_postings(doc_id, old[1])
+
+    def _discard_postings(self, doc_id, text):
+        for gram in set(iter_grams(text)):
+            posting = self._postings.get(gram)
+            if posting is None:
+                continue
+            posting.discard(doc_id)
+            if not posting:
+                del self._postings[gram]
+
+    def _candidates(self, q: str) -> Tuple[set, List[set]]:
+        if len(q) < NGRAM_SIZE:
+            return self._postings.get(q, set()), []
+        postings = []
+        for gram in {q[i:i + NGRAM_SIZE] for i in range(len(q) - NGRAM_SIZE + 1)}:
+            posting = self._postings.get(gram)
+            if not posting:
+                return set(), []
+            postings.append(posting)
+        postings.sort(key=len)
+        return postings[0], postings[1:]
+
+    def _iter_hits(self, s: str, group: Optional[int] = None):
+        """
+        逐个产出 (doc_id, group), 顺序不保证. 边遍历 posting 边校验, 调用方够数即可停止;
+        遍历期间 posting 不能被修改, 调用方需持有 self._lock
+        """
+        q = normalize(s)
+        if not q:
+            return
+        smallest, others = self._candidates(q)
+        for doc_id in smallest:
+            if not all(doc_id in p for p in others):
+                continue
+            doc_group, text, _ = self._docs[doc_id]
+            if group is not None and doc_group != group:
+                continue
+            # n-gram 求交有假阳性, 最终以子串匹配为准
+            if q in text:
+                yield doc_id, doc_group
+
+    def search(self, s: str, group: Optional[int] = None, limit: Optional[int] = None) -> List[int]:
+        out = []
+        with self._lock:
+            for doc_id, _ in self._iter_hits(s, group=group):
+                out.append(doc_id)
+                if limit is not None and len(out) >= limit:
+                    break
+        return out
+
+    def top(self, s: str, limit: int, group: Optional[int] = None) -> List[int]:
+        """
+        按 匹配档位 * TIER_WEIGHT + 静态分 (同 ranking.top_k, 档位为近似) 取前 limit 个命中, 需要遍历全部命中
+        """
+        q = normalize(s)
+        with self._lock:
+            scored = heapq.nlargest(limit, (
+                (keywords_match_tier(q, self._docs[doc_id][1]) * TIER_WEIGHT + self._docs[doc_id][2], -doc_id, doc_id)
+                for doc_id, _ in self._iter_hits(s, group=group)
+            ))
+        return [doc_id for _, _, doc_id in scored]
+
+    def search_grouped(self, s: str, group_limit: Optional[int] = None) -> Dict[Optional[int], List[int]]:
+        """
+        按 group 聚合命中的 doc_id, 最多 group_limit 个 group
+        """
+        ret = defaultdict(list)
+        with self._lock:
+            for doc_id, doc_group in self._iter_hits(s):
+                if doc_group not in ret and group_limit is not None and len(ret) >= group_limit:
+                    continue
+                ret[doc_group].append(doc_id)
+        return ret
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'version': SNAPSHOT_VERSION,
+                'docs': [(doc_id, *doc) for doc_id, doc in self._docs.items()],
+            }
+
+    def load_snapshot(self, snapshot: dict):
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported search index snapshot version: {snapshot.get('version')}")
+        with self._lock:
+            self._docs.clear()
+            self._postings.clear()
+            for doc_id, group, text, score in snapshot['docs']:
+                self.add(doc_id, text, group, score)
+
+
+class SyncedCatalogIndex:
+    """
+    进程内索引的公共部分: 预热或首次使用时构建, 之后每隔 SEARCH_INDEX_REFRESH_SECONDS 按 update_at 增量同步其它进程的写入;
+    子类实现 load(since), since 为 None 时表示全量构建
+    """
+    name = ''
+
+    def __init__(self):
+        self._ready = False
+        self._synced_at = None
+        self._last_refresh = 0.0
+        self._build_lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def load(self, since=None):
+        raise NotImplementedError
+
+    def load_initial(self, synced_at):
+        self.load()
+
+    def ensure_ready(self):
+        if self._ready:
+            self.maybe_refresh()
+            return
+        with self._build_lock:
+            if self._ready:
+                return
+            started = time.monotonic()
+            synced_at = timezone.now()
+            self.load_initial(synced_at)
+            self._synced_at = synced_at
+            self._last_refresh = time.monotonic()
+            self._ready = True
+            logger.info('index %s ready, %.3fs', self.name, time.monotonic() - started)
+
+    def maybe_refresh(self):
+        interval = getattr(settings, 'SEARCH_INDEX_REFRESH_SECONDS', 5)
+        if time.monotonic() - self._last_refresh < interval:
+            return
+        if not self._build_lock.acquire(blocking=False):
+            return
+        try:
+            synced_at = timezone.now()
+            self.load(since=self._synced_at)
+            self._synced_at = synced_at
+            self._last_refresh = time.monotonic()
+        finally:
+            self._build_lock.release()
+
+
+class CatalogSearchIndex(SyncedCatalogIndex):
+    """
+    绑定到某个 model 的 NGramIndex, 支持快照
+    """
+
+    def __init__(self, model, group_field: Optional[str] = None):
+        super().__init__()
+        self.model = model
+        self.group_field = group_field
+        self.index = NGramIndex()
+
+    @property
+    def name(self):
+        return self.model._meta.model_name
+
+    def load(self, since=None):
+        qs = self.model.objects.all()
+        if since is not None:
+            qs = qs.filter(update_at__gte=since)
+        fields = ['id', 'search_keywords', 'search_score']
+        if self.group_field:
+            fields.append(self.group_field)
+        for doc_id, keywords, score, *group in qs.values_list(*fields).iterator(chunk_size=BUILD_CHUNK_SIZE):
+            self.index.add(doc_id, keywords, group[0] if group else None, score)
+
+    def _snapshot_path(self) -> Optional[Path]:
+        snapshot_dir = getattr(settings, 'SEARCH_INDEX_SNAPSHOT_DIR', None)
+        if not snapshot_dir:
+            return None
+        return Path(snapshot_dir) / f'search-index-{self.name}.pickle'
+
+    def load_initial(self, synced_at):
+        path = self._snapshot_path()
+        payload = None
+        if path is not None and path.exists():
+            with path.open('rb') as f:
+                payload = pickle.load(f)
+            # 旧版本的快照直接重建
+            if payload['index'].get('version') != SNAPSHOT_VERSION:
+                payload = None
+        if payload is not None:
+            self.index.load_snapshot(payload['index'])
+            # 补上快照之后的变更
+            self.load(since=payload['synced_at'])
+        else:
+            self.load()
+            if path is not None:
+                self.dump_snapshot(path, synced_at)
+
+    def dump_snapshot(self, path: Path, synced_at=None):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with tmp_path.open('wb') as f:
+            pickle.dump({
+                'synced_at': synced_at or self._synced_at or timezone.now(),
+                'index': self.index.snapshot(),
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(path)
+
+    def on_saved(self, instance):
+        if not self._ready:
+            return
+        group = getattr(instance, self.group_field) if self.group_field else None
+        self.index.add(instance.pk, instance.search_keywords, group, instance.search_score)
+
+    def on_deleted(self, instance):
+        if not self._ready:
+            return
+        self.index.remove(instance.pk)
+
+    def search(self, s: str, group: Optional[int] = None, limit: Optional[int] = None) -> List[int]:
+        self.ensure_ready()
+        return self.index.search(s, group=group, limit=limit)
+
+    def top(self, s: str, limit: int, group: Optional[int] = None) -> List[int]:
+        self.ensure_ready()
+        return self.index.top(s, limit, group=group)
+
+    def search_grouped(self, s: str, group_limit: Optional[int] = None):
+        self.ensure_ready()
+        return self.index.search_grouped(s, group_limit=group_limit)
+
+
+product_index = CatalogSearchIndex(Product, group_field='merchant_id')
+merchant_index = CatalogSearchIndex(Merchant)
+
+
+def warm_up_indexes():
+    """
+    构建会用到的进程内索引, 避免第一个请求等待构建: 当前搜索 backend 用到的 (见 BaseSearchBackend.indexes),
+    以及模糊搜索、联想. 没有用到的索引不构建, 也就不会定期同步. gymall/wsgi.py 在 worker 启动时调用,
+    gunicorn 不带 --preload 时每个 worker 各自构建, 带 --preload 时在 master 构建一次后 fork
+    """
+    from .fuzzy import merchant_fuzzy_index, product_fuzzy_index
+    from .search_backends import get_search_backend
+    from .suggest import suggest_index
+
+    for index in (*get_search_backend().indexes, product_fuzzy_index, merchant_fuzzy_index, suggest_index):
+        index.ensure_ready()
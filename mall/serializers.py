@@ -2,13 +2,24 @@ import decimal
 from collections import defaultdict
 from typing import Optional
 
-import django.db.transaction
+from django.db.models import Max
 
 from .models import Merchant, Product, MerchantProductsTab, AppImage, Order, OrderItem, UserExpressAddress, OrderStatus, OrderCollection, User
+from .fast_serializers import ValuesField, serialize_instances
+from .fuzzy import fuzzy_ranked, product_fuzzy_index, merchant_fuzzy_index
+from .order_totals import deferred_totals
+from .query_planner import plan_queryset
+from .ranking import match_tier_expression, ranked, top_n_per_group
+from .search_backends import get_search_backend
+from .sparse_fields import SparseFieldsMixin
+from .search_cache import make_search_cache_key, get_search_result_cache, get_catalog_version
+from .tiered_cache import cached
+from .suggest import suggest_index
 from rest_framework import serializers, exceptions
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
 
-class AppImageSerializer(serializers.ModelSerializer):
+class AppImageSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = AppImage
         fields = (
@@ -25,7 +36,7 @@ class AppImageSerializer(serializers.ModelSerializer):
         )
 
 
-class MerchantSerializer(serializers.HyperlinkedModelSerializer):
+class MerchantSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     img = AppImageSerializer()
 
     class Meta:
@@ -35,7 +46,11 @@ class MerchantSerializer(serializers.HyperlinkedModelSerializer):
         )
 
 
-class MerchantProductsTabSerializer(serializers.HyperlinkedModelSerializer):
+class MerchantProductsTabSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    expandable_fields = {
+        'merchant': MerchantSerializer,
+    }
+
     class Meta:
         model = MerchantProductsTab
         fields = (
@@ -43,11 +58,21 @@ class MerchantProductsTabSerializer(serializers.HyperlinkedModelSerializer):
         )
 
 
-class ProductSerializer(serializers.HyperlinkedModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     img = AppImageSerializer()
 
     tab_slug = serializers.SerializerMethodField()
 
+    expandable_fields = {
+        'merchant': MerchantSerializer,
+        'tab': MerchantProductsTabSerializer,
+    }
+
+    # fast_serializers 里从 values() 行取值时的等价写法, 改动方法时同步修改
+    fast_fields = {
+        'tab_slug': serializers.CharField(source='tab.slug'),
+    }
+
     def get_tab_slug(self, obj: Product):
         return obj.tab.slug
 
@@ -74,13 +99,13 @@ class ProductWithMerchantSerializer(ProductSerializer):
     merchant = MerchantSerializer(read_only=True)
 
 
-class UserExpressAddressSerializer(serializers.HyperlinkedModelSerializer):
+class UserExpressAddressSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     city = serializers.CharField(required=False)
 
     def create(self, validated_data):
         creator = self.context['request'].user
         address = UserExpressAddress(
-            creator=creator,
+            creator_id=creator.id,
             name=validated_data['name'],
             phone_number=validated_data['phone_number'],
             city=validated_data.get('city', None),
@@ -115,13 +140,24 @@ class OrderCollectionUpdateStatusSerializer(serializers.Serializer):
     status = serializers.ChoiceField(OrderStatus.STATUS_CHOICES)
 
 
-class OrderItemSerializer(serializers.HyperlinkedModelSerializer):
+class OrderItemSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     product_id = serializers.IntegerField()
     product_desc = serializers.SerializerMethodField()
     product_merchant_id = serializers.SerializerMethodField()
     product_merchant_name = serializers.SerializerMethodField()
     product_img = serializers.SerializerMethodField()
 
+    fast_fields = {
+        'product_merchant_id': serializers.IntegerField(source='product.merchant_id'),
+        'product_merchant_name': serializers.CharField(source='product.merchant.name'),
+        'product_img': AppImageSerializer(source='product.img'),
+        # 同 Product.__str__
+        'product_desc': ValuesField(
+            lambda name, unit_desc: f'{name} {unit_desc}' if unit_desc else name,
+            sources=['product.name', 'product.unit_desc'],
+        ),
+    }
+
     def get_product_desc(self, obj: OrderItem):
         return str(obj.product)
 
@@ -155,15 +191,27 @@ class OrderItemSerializer(serializers.HyperlinkedModelSerializer):
         )
 
 
-class OrderSerializer(serializers.HyperlinkedModelSerializer):
+class OrderSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     items = OrderItemSerializer(many=True)
     merchant = MerchantSerializer(read_only=True)
     merchant_id = serializers.IntegerField(required=True)
     address = UserExpressAddressSerializer(read_only=True)
     address_id = serializers.IntegerField(required=True)
 
+    fast_fields = {
+        # 同 Order.status_txt
+        'status_txt': ValuesField(OrderStatus.STATUS_CHOICES_DICT.__getitem__, sources=['status']),
+    }
+
     @classmethod
-    def create_order(cls, current_user: User, validated_data, order_collection: Optional[OrderCollection] = None):
+    def create_order(cls, current_user: User, validated_data, order_collection: Optional[OrderCollection] = None,
+                     save_collection=True):
+        """
+        商品一次 in_bulk 取出, 总价在内存里算好, 订单只写一次, 订单项 bulk_create,
+        结果与逐条 OrderItem.objects.create 触发的 save 链一致.
+
+        save_collection=False 时由调用方在全部订单创建完后自己 order_collection.save()
+        """
         if current_user.is_anonymous:
             raise exceptions.PermissionDenied
 
@@ -180,24 +228,34 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
         except Merchant.DoesNotExist:
             raise serializers.ValidationError(f"merchant_id = {merchant_id} does not exist!")
 
-        with django.db.transaction.atomic():
-            order = Order.objects.create(
-                user=current_user,
+        products = Product.objects.in_bulk({item['product_id'] for item in validated_data['items']})
+        missing = sorted({item['product_id'] for item in validated_data['items']} - products.keys())
+        if missing:
+            raise serializers.ValidationError(f"product_id = {missing} does not exist!")
+
+        items = []
+        price_total = decimal.Decimal(0.0)
+        for item in validated_data['items']:
+            product = products[item['product_id']]
+            items.append(OrderItem(product=product, price=product.price, quantity=item['quantity']))
+            price_total = price_total + (product.price * item['quantity'])
+
+        with deferred_totals():
+            order = Order(
+                user_id=current_user.id,
                 address=address,
                 merchant=merchant,
                 status=OrderStatus.STATUS_WAITING_TO_PAY,
-                price_total=decimal.Decimal('-1'),
+                price_total=price_total,
                 order_collection=order_collection,
             )
-            for item in validated_data['items']:
-                product = Product.objects.get(pk=item['product_id'])
-                OrderItem.objects.create(
-                    order=order,
-                    product=product,
-                    price=product.price,
-                    quantity=item['quantity']
-                )
-            order.save()
+            order.save(force_insert=True, recompute=False)
+            for item in items:
+                item.order = order
+            OrderItem.objects.bulk_create(items)
+
+            if order_collection is not None and save_collection:
+                order_collection.save()
 
             return order
 
@@ -234,7 +292,7 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
         )
 
 
-class OrderCollectionSerializer(serializers.ModelSerializer):
+class OrderCollectionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     orders = OrderSerializer(many=True)
 
     class Meta:
@@ -258,25 +316,27 @@ class OrderCollectionSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         user = self.context['request'].user
 
-        order_collection = OrderCollection.objects.create(
-            user=user,
-            status=OrderStatus.STATUS_WAITING_TO_PAY,
-            price_total=decimal.Decimal('-1'),
-        )
-
-        for _order in validated_data['orders']:
-            order = OrderSerializer.create_order(
-                current_user=user,
-                validated_data=_order,
-                order_collection=order_collection
+        with deferred_totals():
+            order_collection = OrderCollection.objects.create(
+                user_id=user.id,
+                status=OrderStatus.STATUS_WAITING_TO_PAY,
+                price_total=decimal.Decimal('-1'),
             )
 
-        order_collection.save()
+            for _order in validated_data['orders']:
+                order = OrderSerializer.create_order(
+                    current_user=user,
+                    validated_data=_order,
+                    order_collection=order_collection,
+                    save_collection=False,
+                )
+
+            order_collection.save()
 
         return order_collection
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     username = serializers.CharField(min_length=5, max_length=20, required=True)
     avatar_id = serializers.CharField(required=False)
     email = serializers.EmailField(required=True)
@@ -334,6 +394,23 @@ class UserSerializer(serializers.ModelSerializer):
         )
 
 
+class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    access token 里带上 username / is_staff, StatelessJWTAuthentication 的 TokenUser 直接从中读取
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['username'] = user.username
+        token['is_staff'] = user.is_staff
+        return token
+
+
+def _catalog_version(*args, **kwargs):
+    return get_catalog_version()
+
+
 class SearchSerializer(serializers.Serializer):
     s = serializers.CharField(min_length=1, max_length=191)
     merchant_id = serializers.IntegerField(required=False)
@@ -343,6 +420,8 @@ class SearchSerializer(serializers.Serializer):
         ('merchant', '商户'),
         ('product', '商品'),
     ))
+    # 精确搜索 0 命中时, 是否退化为拼音容错搜索
+    fuzzy = serializers.BooleanField(default=True, required=False)
 
     def create(self, validated_data):
         pass
@@ -351,36 +430,60 @@ class SearchSerializer(serializers.Serializer):
         pass
 
     def do_search(self, validated_data):
+        # key 中的 s 经过了归一化, 回显用户原始输入
+        return {**self._do_search(validated_data), 's': validated_data['s']}
+
+    @cached(
+        key=lambda self, validated_data: make_search_cache_key(
+            'search', validated_data['s'], self.context.get('request'),
+            type=validated_data['type'], merchant_id=validated_data.get('merchant_id'), limit=validated_data['limit'],
+            fuzzy=validated_data['fuzzy'],
+        ),
+        version=_catalog_version,
+        backend=get_search_result_cache,
+    )
+    def _do_search(self, validated_data):
         _type = validated_data['type']
         s = validated_data['s']
         merchant_id = validated_data.get('merchant_id')
         limit = validated_data['limit']
+        backend = get_search_backend()
+
+        merchant_id = merchant_id if isinstance(merchant_id, int) else None
 
         products = []
         merchants = []
+        fuzzy = False
 
         if _type == 'merchant' or _type == 'all':
-            for m in Merchant.objects.select_related('img').filter(search_keywords__icontains=s)[:limit]:
-                merchants.append(m)
+            qs = plan_queryset(Merchant.objects.all(), MerchantSerializer)
+            merchants = ranked(backend.filter_merchants(qs, s), s, limit)
+            if not merchants and validated_data['fuzzy']:
+                merchants = fuzzy_ranked(qs, merchant_fuzzy_index, s, limit)
+                fuzzy = fuzzy or bool(merchants)
         if _type == 'product' or _type == 'all':
-            qs = Product.objects.select_related('merchant', 'img').filter(search_keywords__icontains=s)
-            if isinstance(merchant_id, int):
-                qs = qs.filter(merchant_id=merchant_id)
-            for p in qs[:limit]:
-                products.append(p)
+            qs = plan_queryset(Product.objects.all(), ProductWithMerchantSerializer)
+            products = ranked(backend.filter_products(qs, s, merchant_id=merchant_id), s, limit)
+            if not products and validated_data['fuzzy']:
+                if merchant_id is not None:
+                    qs = qs.filter(merchant_id=merchant_id)
+                products = fuzzy_ranked(qs, product_fuzzy_index, s, limit, group=merchant_id)
+                fuzzy = fuzzy or bool(products)
 
         return {
             's': s,
             'type': _type,
             'limit': limit,
-            'products': ProductWithMerchantSerializer(instance=products, many=True, context=self.context).data,
-            'merchants': MerchantSerializer(instance=merchants, many=True, context=self.context).data,
+            'fuzzy': fuzzy,
+            'products': serialize_instances(ProductWithMerchantSerializer, products, self.context),
+            'merchants': serialize_instances(MerchantSerializer, merchants, self.context),
         }
 
 
 class MerchantSearchSerializer(serializers.Serializer):
     s = serializers.CharField(min_length=1, max_length=191)
     limit = serializers.IntegerField(default=10, min_value=1, max_value=50, required=False)
+    product_limit = serializers.IntegerField(default=10, min_value=1, max_value=50, required=False)
 
     def create(self, validated_data):
         pass
@@ -389,62 +492,93 @@ class MerchantSearchSerializer(serializers.Serializer):
         pass
 
     def do_search(self, validated_data):
+        return {**self._do_search(validated_data), 's': validated_data['s']}
+
+    @cached(
+        key=lambda self, validated_data: make_search_cache_key(
+            'search-merchant', validated_data['s'], self.context.get('request'),
+            limit=validated_data['limit'], product_limit=validated_data['product_limit'],
+        ),
+        version=_catalog_version,
+        backend=get_search_result_cache,
+    )
+    def _do_search(self, validated_data):
+        """
+        查询次数固定为 4 次, 与命中数量无关; 排序同 SearchSerializer, 先按匹配档位 (ranking.match_tier_expression) 再按静态分:
+        1. 按商品命中的商户, GROUP BY merchant_id 按最高档位、最高静态分取前 limit 个
+        2. 这些商户下的命中商品, ROW_NUMBER() 每个商户最多取 product_limit 个
+        3. 第 1 步商户的详情
+        4. 名字命中但没有商品命中的商户, 同样最多 limit 个
+        """
         s = validated_data['s']
         limit = validated_data['limit']
+        product_limit = validated_data['product_limit']
 
-        qs = Product.objects.filter(search_keywords__icontains=s).values_list('id', 'merchant_id')
+        backend = get_search_backend()
 
-        ret = defaultdict(list)
+        merchant_ids = list(
+            backend.filter_products(Product.objects.all(), s)
+            .order_by()
+            .values('merchant_id')
+            .annotate(best_tier=Max(match_tier_expression(s)), best_score=Max('search_score'))
+            .order_by('-best_tier', '-best_score', 'merchant_id')
+            .values_list('merchant_id', flat=True)[:limit]
+        )
 
-        product_id_set = set()
-        for product_id, merchant_id in qs:
-            if merchant_id in ret:
-                product_id_set.add(product_id)
-                ret[merchant_id].append(product_id)
-            else:
-                if len(ret) == limit:
-                    break
-                else:
-                    product_id_set.add(product_id)
-                    ret[merchant_id].append(product_id)
+        products = []
+        merchant_dict = {}
+        if merchant_ids:
+            matched = backend.filter_products(Product.objects.filter(merchant_id__in=merchant_ids), s)
+            products = list(
+                top_n_per_group(Product.objects.select_related('img', 'tab'), matched, 'merchant_id', product_limit, s)
+                .annotate(match_tier=match_tier_expression(s))
+                .order_by('-match_tier', '-search_score', 'id')
+            )
+            merchant_dict = Merchant.objects.select_related('img').in_bulk(merchant_ids)
+
+        # 名字命中但没有商品命中的商户
+        name_hit_merchants = list(
+            backend.filter_merchants(Merchant.objects.select_related('img'), s)
+            .exclude(id__in=merchant_ids)
+            .annotate(match_tier=match_tier_expression(s))
+            .order_by('-match_tier', '-search_score', 'id')[:limit]
+        )
 
-        merchant_dict = {
-            m.id: m for m in Merchant.objects.filter(id__in=ret.keys())
-        }
+        merchants = [*name_hit_merchants, *(merchant_dict[m_id] for m_id in merchant_ids if m_id in merchant_dict)]
+        merchants_data = MerchantSerializer(instance=merchants, many=True, context=self.context).data
+        products_data = ProductSerializer(instance=products, many=True, context=self.context).data
 
-        product_dict = {
-            p.id: p for p in Product.objects.filter(id__in=product_id_set)
-        }
+        products_by_merchant = defaultdict(list)
+        for p, p_data in zip(products, products_data):
+            products_by_merchant[p.merchant_id].append(p_data)
 
         search_result = [
             {
-                "merchant": merchant_dict[merchant_id],
-                "products": [product_dict[_p_id] for _p_id in product_id_list]
-            } for merchant_id, product_id_list in ret.items()
+                "merchant": m_data,
+                "products": products_by_merchant.get(m.id, []),
+            } for m, m_data in zip(merchants, merchants_data)
         ]
 
-        # serialize
-        for item in search_result:
-            item['merchant'] = MerchantSerializer(instance=item['merchant'], context=self.context).data
-            for idx in range(len(item['products'])):
-                item['products'][idx] = ProductSerializer(instance=item['products'][idx], context=self.context).data
-
-        # search for merchant that names contains keywords and not hit by products
-        qs = Merchant.objects.filter(search_keywords__icontains=s).exclude(id__in=merchant_dict.keys()).all()
-        search_result_merchants = []
-        for m in qs:
-            search_result_merchants.append({
-                "merchant": MerchantSerializer(instance=m, context=self.context).data,
-                "products": [],
-            })
-        if len(search_result_merchants) > 0:
-            search_result = [
-                *search_result_merchants,
-                *search_result,
-            ]
-
         return {
             's': s,
             'limit': limit,
             'search_result': search_result
         }
+
+
+class SuggestSerializer(serializers.Serializer):
+    s = serializers.CharField(min_length=1, max_length=191)
+    limit = serializers.IntegerField(default=10, min_value=1, max_value=20, required=False)
+
+    def create(self, validated_data):
+        pass
+
+    def update(self, instance, validated_data):
+        pass
+
+    def do_suggest(self, validated_data):
+        s = validated_data['s']
+        return {
+            's': s,
+            'suggestions': suggest_index.suggest(s, validated_data['limit']),
+        }
@@ -0,0 +1,105 @@
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from rest_framework.authtoken.models import Token
+
+from .authentication import invalidate_token
+from .models import Merchant, Product, AppImage, MerchantProductsTab, User
+from .merchant_cache import bump_merchant_version
+from .search_cache import bump_catalog_version
+from .fuzzy import product_fuzzy_index, merchant_fuzzy_index
+from .search_engine import product_index, merchant_index
+from .suggest import suggest_index
+
+
+@receiver(post_save, sender=Product)
+def on_product_saved(sender, instance: Product, **kwargs):
+    product_index.on_saved(instance)
+    product_fuzzy_index.on_saved(instance)
+    suggest_index.on_saved('product', instance)
+
+
+@receiver(post_delete, sender=Product)
+def on_product_deleted(sender, instance: Product, **kwargs):
+    product_index.on_deleted(instance)
+    product_fuzzy_index.on_deleted(instance)
+    suggest_index.on_deleted('product', instance)
+
+
+@receiver(post_save, sender=Merchant)
+def on_merchant_saved(sender, instance: Merchant, **kwargs):
+    merchant_index.on_saved(instance)
+    merchant_fuzzy_index.on_saved(instance)
+    suggest_index.on_saved('merchant', instance)
+
+
+@receiver(post_delete, sender=Merchant)
+def on_merchant_deleted(sender, instance: Merchant, **kwargs):
+    merchant_index.on_deleted(instance)
+    merchant_fuzzy_index.on_deleted(instance)
+    suggest_index.on_deleted('merchant', instance)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Merchant)
+@receiver(post_delete, sender=Merchant)
+@receiver(post_save, sender=MerchantProductsTab)
+@receiver(post_delete, sender=MerchantProductsTab)
+def on_catalog_changed(sender, **kwargs):
+    bump_catalog_version()
+
+
+def catalog_bulk_changed(merchant_ids=()):
+    """
+    queryset.update() / bulk_update() / bulk_create() 不发 signals, 批量修改商品目录之后必须调用,
+    否则缓存和 ETag 的版本号不变, 客户端会一直拿到旧数据 (或 304). merchant_ids 为受影响的商户
+    """
+    bump_catalog_version()
+    for merchant_id in set(merchant_ids):
+        if merchant_id is not None:
+            bump_merchant_version(merchant_id)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=MerchantProductsTab)
+@receiver(post_delete, sender=MerchantProductsTab)
+def on_merchant_catalog_changed(sender, instance, **kwargs):
+    if instance.merchant_id is not None:
+        bump_merchant_version(instance.merchant_id)
+
+
+@receiver(post_save, sender=Merchant)
+@receiver(post_delete, sender=Merchant)
+def on_merchant_changed(sender, instance: Merchant, **kwargs):
+    bump_merchant_version(instance.pk)
+
+
+@receiver(post_save, sender=AppImage)
+@receiver(pre_delete, sender=AppImage)
+def on_catalog_image_changed(sender, instance: AppImage, created=False, **kwargs):
+    """
+    只有商品、商户用到的图片才算目录变更, 用户头像等其它图片的上传/修改不让目录缓存失效.
+    删除后 img 会被置空, 所以在 pre_delete 时查; 新上传的图片还没有被引用
+    """
+    if created:
+        return
+    merchant_ids = set(Product.objects.filter(img=instance).values_list('merchant_id', flat=True).distinct())
+    merchant_ids.update(Merchant.objects.filter(img=instance).values_list('pk', flat=True))
+    if merchant_ids:
+        catalog_bulk_changed(merchant_ids)
+
+
+@receiver(post_delete, sender=Token)
+def on_token_deleted(sender, instance: Token, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def on_user_saved(sender, instance: User, created=False, **kwargs):
+    # 停用、改密码及其它资料修改都让缓存的 token -> user 失效
+    if created:
+        return
+    for key in Token.objects.filter(user_id=instance.pk).values_list('key', flat=True):
+        invalidate_token(key)
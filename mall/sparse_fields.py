@@ -0,0 +1,167 @@
+"""
+稀疏字段: ?fields= / ?omit= / ?expand=
+
+    ?fields=id,name,price,img          只返回这几个字段
+    ?fields=id,name,img.img            嵌套对象只取其中几个字段, 列表 (如订单的 items) 同样用 . 分隔
+    ?omit=search_keywords,img.desc     去掉这些字段
+    ?expand=merchant                   链接换成嵌套对象, 可展开的字段见各 serializer 的 expandable_fields
+
+只对读请求生效. SparseFieldsViewMixin 把解析结果放进 serializer context 的 sparse_fieldsets,
+SparseFieldsMixin.get_fields() 按它裁剪字段. query_planner / fast_serializers 都是按裁剪后的字段生成查询,
+没有请求的嵌套对象不会 join, 不返回的列也不查. 不认识的字段名忽略, ?fields= 里全是不认识的字段名时返回全部字段,
+serializer 和 query_planner 都先经过 known_sparse_fieldsets, 两边的字段一致.
+"""
+from functools import lru_cache
+from typing import FrozenSet, NamedTuple, Optional, Set, Tuple
+
+from rest_framework import permissions, serializers
+
+Path = Tuple[str, ...]
+
+# 嵌套 / 展开的 serializer 最多解析几层
+MAX_DEPTH = 4
+
+
+class SparseFieldsets(NamedTuple):
+    fields: Tuple[str, ...] = ()
+    omit: Tuple[str, ...] = ()
+    expand: Tuple[str, ...] = ()
+
+
+def _split(value: str) -> Tuple[str, ...]:
+    return tuple(sorted({part.strip() for part in value.split(',') if part.strip()}))
+
+
+def parse_sparse_fieldsets(query_params) -> Optional[SparseFieldsets]:
+    """
+    结果可以 hash, 作为 query_planner 的缓存 key
+    """
+    ret = SparseFieldsets(*(_split(query_params.get(name, '')) for name in SparseFieldsets._fields))
+    return ret if any(ret) else None
+
+
+@lru_cache(maxsize=None)
+def known_paths(serializer_class) -> FrozenSet[Path]:
+    """
+    serializer_class 的全部字段路径, 包括嵌套对象和 expandable_fields 展开后的字段
+    """
+    ret = set()
+
+    def walk(serializer, path: Path):
+        if isinstance(serializer, serializers.ListSerializer):
+            serializer = serializer.child
+        if not isinstance(serializer, serializers.Serializer) or len(path) >= MAX_DEPTH:
+            return
+        expandable = getattr(serializer, 'expandable_fields', {})
+        for name, field in serializer.fields.items():
+            ret.add(path + (name,))
+            walk(field, path + (name,))
+            if name in expandable:
+                walk(expandable[name](), path + (name,))
+
+    walk(serializer_class(), ())
+    return frozenset(ret)
+
+
+def known_sparse_fieldsets(serializer_class, sparse: Optional[SparseFieldsets]) -> Optional[SparseFieldsets]:
+    """
+    去掉 serializer_class 里没有的字段名. 字段名来自查询参数, 作为缓存 key 之前要先过一遍, 不然 key 的数量没有上限.
+    结果只用于生成查询, 只能比 serializer 实际输出的字段多: fields 里的路径截到已知的最长前缀 (merchant.xxx -> merchant),
+    全是不认识的字段名时不裁剪
+    """
+    if sparse is None:
+        return None
+    paths = known_paths(serializer_class)
+
+    def prefix(p: str) -> Optional[str]:
+        parts = tuple(p.split('.'))
+        while parts and parts not in paths:
+            parts = parts[:-1]
+        return '.'.join(parts) or None
+
+    ret = SparseFieldsets(
+        fields=tuple(sorted({prefix(p) for p in sparse.fields} - {None})),
+        omit=tuple(p for p in sparse.omit if tuple(p.split('.')) in paths),
+        expand=tuple(p for p in sparse.expand if tuple(p.split('.')) in paths),
+    )
+    return ret if any(ret) else None
+
+
+def selected_names(paths, path: Path) -> Optional[Set[str]]:
+    """
+    fields 在 path 这一层选中的字段名; path 本身 (或它的上层) 被整体选中, 或者没有指定时返回 None, 即不裁剪
+    """
+    names = set()
+    for parts in (p.split('.') for p in paths):
+        if len(parts) <= len(path) and tuple(parts) == path[:len(parts)]:
+            return None
+        if len(parts) > len(path) and tuple(parts[:len(path)]) == path:
+            names.add(parts[len(path)])
+    return names or None
+
+
+def leaf_names(paths, path: Path) -> Set[str]:
+    """
+    omit / expand 中正好位于 path 这一层的字段名
+    """
+    return {parts[-1] for parts in (p.split('.') for p in paths) if tuple(parts[:-1]) == path}
+
+
+class SparseFieldsMixin:
+    """
+    serializer 用, 放在 ModelSerializer 之前
+    """
+    # 字段名 -> 展开时使用的 serializer
+    expandable_fields = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        sparse = known_sparse_fieldsets(self._root_serializer_class(), self.context.get('sparse_fieldsets'))
+        if sparse is None:
+            return fields
+
+        path = self._sparse_path()
+        for name in leaf_names(sparse.expand, path):
+            if name in self.expandable_fields and name in fields:
+                fields[name] = self.expandable_fields[name](read_only=True)
+        keep = selected_names(sparse.fields, path)
+        if keep is not None:
+            for name in [name for name in fields if name not in keep]:
+                del fields[name]
+        for name in leaf_names(sparse.omit, path):
+            fields.pop(name, None)
+        return fields
+
+    def _root_serializer_class(self):
+        node = self
+        while node.parent is not None:
+            node = node.parent
+        if isinstance(node, serializers.ListSerializer):
+            node = node.child
+        return type(node)
+
+    def _sparse_path(self) -> Path:
+        path = []
+        node = self
+        while node.parent is not None:
+            # ListSerializer 的 child 没有 field_name
+            if node.field_name:
+                path.append(node.field_name)
+            node = node.parent
+        return tuple(reversed(path))
+
+
+class SparseFieldsViewMixin:
+    """
+    视图用: 读请求时把 ?fields= / ?omit= / ?expand= 放进 serializer context
+    """
+
+    def get_sparse_fieldsets(self) -> Optional[SparseFieldsets]:
+        if self.request is None or self.request.method not in permissions.SAFE_METHODS:
+            return None
+        return parse_sparse_fieldsets(self.request.query_params)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['sparse_fieldsets'] = self.get_sparse_fieldsets()
+        return context
@@ -0,0 +1,51 @@
+"""
+大列表的流式 JSON 输出
+
+按 keyset 分段取数据 (WHERE pk > last ORDER BY pk LIMIT n, 多列排序同 pagination.keyset_after), 每段序列化后立即写出,
+内存占用只和 chunk_size 有关. 排序与对应的分页接口一致, 流式和分页返回的顺序相同.
+不用 qs.iterator(): MySQL 驱动会先把整个结果集读进内存, 见 init_search_keywords.
+"""
+from django.http import StreamingHttpResponse
+
+from .pagination import keyset_after
+from .renderers import dumps
+
+STREAM_CHUNK_SIZE = 500
+
+
+def is_stream_request(request) -> bool:
+    return request.query_params.get('stream', '').lower() in ('1', 'true')
+
+
+def iter_keyset_chunks(qs, chunk_size: int = STREAM_CHUNK_SIZE, ordering=('pk',)):
+    """
+    ordering 最后一个字段必须唯一
+    """
+    qs = qs.order_by(*ordering)
+    chunk = list(qs[:chunk_size])
+    while chunk:
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = [getattr(chunk[-1], name.lstrip('-')) for name in ordering]
+        chunk = list(qs.filter(keyset_after(ordering, last))[:chunk_size])
+
+
+def stream_json_list(qs, serializer_class, context, chunk_size: int = STREAM_CHUNK_SIZE,
+                     ordering=('pk',)) -> StreamingHttpResponse:
+    """
+    输出与 Response(serializer_class(qs, many=True).data) 相同的 JSON 数组, 按 ordering 排序
+    """
+    # 迭代时已经在视图之外, 在这里确定读哪个库 (只读副本)
+    qs = qs.using(qs.db)
+
+    def generate():
+        yield b'['
+        sep = b''
+        for chunk in iter_keyset_chunks(qs, chunk_size, ordering):
+            data = serializer_class(chunk, many=True, context=context).data
+            yield sep + b','.join(dumps(item) for item in data)
+            sep = b','
+        yield b']'
+
+    return StreamingHttpResponse(generate(), content_type='application/json')
@@ -0,0 +1,193 @@
+"""
+搜索框联想: 商品/商户名的前缀补全, 支持 中文前缀 / 全拼前缀 / 拼音首字母前缀, 按销量排序
+
+每个名字以 名字、全拼、首字母 三种形式插入同一棵 trie. 每个节点缓存其子树内销量最高的 TOP_K 个条目,
+写入时只把受影响路径上的缓存置空, 查询时按需由子节点的缓存合并重算, 所以查询只需走一遍前缀.
+删除条目时顺带删掉不再有条目的空节点.
+
+查询只读内存, 不访问数据库. 本进程的删除由 signals 同步; 其它进程的删除增量同步发现不了 (只能发现新增和修改),
+由定期同步时的一次主键查询对账删除 (见 CatalogSuggestIndex.load).
+"""
+import heapq
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from .models import Merchant, Product
+from .pinyin_service import name_pinyin
+from .search_engine import SyncedCatalogIndex, BUILD_CHUNK_SIZE
+
+TOP_K = 20
+
+EntryKey = Tuple[str, int]
+
+
+def normalize(s: str) -> str:
+    return s.strip().lower()
+
+
+def suggest_keys(name: str):
+    initials, full = name_pinyin(name)
+    return {k for k in (normalize(name), normalize(full), normalize(initials)) if k}
+
+
+class TrieNode:
+    __slots__ = ('children', 'entries', 'top')
+
+    # 大部分节点是叶子或只在路径上, children / entries 用到时才创建
+    def __init__(self):
+        self.children: Optional[Dict[str, TrieNode]] = None
+        self.entries: Optional[set] = None
+        self.top: Optional[List[Tuple[int, EntryKey]]] = None
+
+
+class SuggestTrie:
+    def __init__(self, top_k=TOP_K):
+        self.top_k = top_k
+        self.root = TrieNode()
+        # entry_key -> (score, keys, payload)
+        self._entries: Dict[EntryKey, Tuple[int, set, dict]] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _path(self, key: str, create=False) -> List[TrieNode]:
+        node = self.root
+        path = [node]
+        for ch in key:
+            child = node.children.get(ch) if node.children else None
+            if child is None:
+                if not create:
+                    return path
+                if node.children is None:
+                    node.children = {}
+                child = node.children[ch] = TrieNode()
+            node = child
+            path.append(node)
+        return path
+
+    def add(self, entry_key: EntryKey, keys: set, score: int, payload: dict):
+        with self._lock:
+            old = self._entries.get(entry_key)
+            if old is not None:
+                if old[0] == score and old[1] == keys and old[2] == payload:
+                    return
+                self.remove(entry_key)
+            self._entries[entry_key] = (score, keys, payload)
+            for key in keys:
+                path = self._path(key, create=True)
+                if path[-1].entries is None:
+                    path[-1].entries = set()
+                path[-1].entries.add(entry_key)
+                for node in path:
+                    node.top = None
+
+    def remove(self, entry_key: EntryKey):
+        with self._lock:
+            old = self._entries.pop(entry_key, None)
+            if old is None:
+                return
+            for key in old[1]:
+                path = self._path(key)
+                for node in path:
+                    node.top = None
+                if len(path) != len(key) + 1:
+                    continue
+                leaf = path[-1]
+                if leaf.entries:
+                    leaf.entries.discard(entry_key)
+                if not leaf.entries:
+                    leaf.entries = None
+                # 自下而上删掉空节点
+                for depth in range(len(key), 0, -1):
+                    node = path[depth]
+                    if node.entries or node.children:
+                        break
+                    parent = path[depth - 1]
+                    del parent.children[key[depth - 1]]
+                    if not parent.children:
+                        parent.children = None
+
+    def entry_keys(self) -> List[EntryKey]:
+        with self._lock:
+            return list(self._entries)
+
+    def _top(self, node: TrieNode) -> List[Tuple[int, EntryKey]]:
+        if node.top is None:
+            candidates = {entry_key: self._entries[entry_key][0] for entry_key in node.entries or ()}
+            for child in (node.children or {}).values():
+                for score, entry_key in self._top(child):
+                    candidates[entry_key] = score
+            node.top = heapq.nlargest(self.top_k, ((score, entry_key) for entry_key, score in candidates.items()))
+        return node.top
+
+    def suggest(self, prefix: str, limit: int = 10) -> List[dict]:
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            path = self._path(prefix)
+            if len(path) != len(prefix) + 1:
+                return []
+            return [self._entries[entry_key][2] for _, entry_key in self._top(path[-1])[:limit]]
+
+
+class CatalogSuggestIndex(SyncedCatalogIndex):
+    name = 'suggest'
+
+    models = (
+        ('product', Product),
+        ('merchant', Merchant),
+    )
+
+    def __init__(self):
+        super().__init__()
+        self.trie = SuggestTrie()
+
+    def _add(self, kind, pk, name, sales):
+        self.trie.add((kind, pk), suggest_keys(name), sales, {
+            'type': kind,
+            'id': pk,
+            'name': name,
+            'sales': sales,
+        })
+
+    def load(self, since=None):
+        for kind, model in self.models:
+            qs = model.objects.all()
+            if since is not None:
+                qs = qs.filter(update_at__gte=since)
+            for pk, name, sales in qs.values_list('id', 'name', 'sales').iterator(chunk_size=BUILD_CHUNK_SIZE):
+                self._add(kind, pk, name, sales)
+        if since is not None:
+            self.drop_deleted()
+
+    def drop_deleted(self):
+        """
+        删除 trie 中数据库里已经不存在的条目 (其它进程删除的), 每个 model 只查一次主键
+        """
+        by_kind = {}
+        for kind, pk in self.trie.entry_keys():
+            by_kind.setdefault(kind, set()).add(pk)
+        for kind, model in self.models:
+            pks = by_kind.get(kind)
+            if not pks:
+                continue
+            pks.difference_update(model.objects.values_list('id', flat=True).iterator(chunk_size=BUILD_CHUNK_SIZE))
+            for pk in pks:
+                self.trie.remove((kind, pk))
+
+    def on_saved(self, kind, instance):
+        if self._ready:
+            self._add(kind, instance.pk, instance.name, instance.sales)
+
+    def on_deleted(self, kind, instance):
+        if self._ready:
+            self.trie.remove((kind, instance.pk))
+
+    def suggest(self, prefix: str, limit: int = 10) -> List[dict]:
+        self.ensure_ready()
+        return self.trie.suggest(prefix, limit)
+
+
+suggest_index = CatalogSuggestIndex()
@@ -1,20 +1,27 @@
+import decimal
 import json
 import logging
 import os
 from random import shuffle
 from typing import List
+from unittest import skipUnless
+from unittest.mock import patch
 
 from django.conf import settings
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
 
 from .generate_mock_data import generate_mock_data
 from .models import AppImage, OrderStatus
 
 logger = logging.getLogger(__name__)
 
+# 测试都在同一个进程里跑, locmem 就相当于共享缓存; 不共享时的行为见 TestLocalCacheFallback
+shared_cache = override_settings(SHARED_CACHE=True)
+
 
 # Create your tests here.
 class TestGenerateMockData(TestCase):
@@ -68,6 +75,89 @@ class TestTokenLogin(MyAPITestCase):
         logger.info('resp.data=%s', resp.data)
 
 
+@shared_cache
+class TestCachedTokenAuthentication(MyAPITestCase):
+    def test_token_cache(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from rest_framework.authtoken.models import Token
+        from .models import User
+
+        resp = self.client.post(reverse('token_login'), {'username': 'aweffr', 'password': 'unsafe'})
+        token = resp.data['token']
+        url = reverse('user-about-me')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.data['username'], 'aweffr')
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url)
+        self.assertEqual(resp.data['username'], 'aweffr')
+        self.assertFalse([q for q in ctx.captured_queries if 'authtoken_token' in q['sql']])
+
+        # 共享缓存里没有密码哈希, 其它字段按需从库里取
+        from .authentication import CachedTokenAuthentication, get_token_caches, token_cache_key
+
+        cached = get_token_caches()[1].get(token_cache_key(token))
+        self.assertNotIn('password', cached)
+        self.assertNotIn(User.objects.get(username='aweffr').password, cached.values())
+        user, _ = CachedTokenAuthentication().authenticate_credentials(token)
+        db_user = User.objects.get(username='aweffr')
+        self.assertEqual((user.pk, user.username, user.is_staff, user.is_superuser),
+                         (db_user.pk, db_user.username, db_user.is_staff, db_user.is_superuser))
+        self.assertIn('password', user.get_deferred_fields())
+        self.assertTrue(user.check_password('unsafe'))
+
+        # 资料修改立即可见
+        u = User.objects.get(username='aweffr')
+        u.first_name = 'changed'
+        u.save()
+        self.assertEqual(self.client.get(url).data['first_name'], 'changed')
+
+        # 停用
+        u.is_active = False
+        u.save()
+        self.assertIn(self.client.get(url).status_code, (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN))
+        u.is_active = True
+        u.save()
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+        # token 删除
+        Token.objects.filter(key=token).delete()
+        self.assertIn(self.client.get(url).status_code, (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN))
+
+
+class TestJWTAuthentication(MyAPITestCase):
+    def test_jwt(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        resp = self.client.post(reverse('jwt_login'), {'username': 'aweffr', 'password': 'unsafe'})
+        self.assertEqual(resp.data['user']['username'], 'aweffr')
+        access, refresh = resp.data['access'], resp.data['refresh']
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        payload = _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛')
+        resp = self.client.post(reverse('order-list'), payload, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        order_id = resp.data['id']
+
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(reverse('order-list'))
+        self.assertEqual([o['id'] for o in resp.data['results']], [order_id])
+        self.assertFalse([q for q in ctx.captured_queries if '"mall_user"' in q['sql'] or 'authtoken' in q['sql']])
+
+        self.assertEqual(self.client.get(reverse('user-about-me')).data['username'], 'aweffr')
+
+        resp = self.client.post(reverse('jwt_refresh'), {'refresh': refresh})
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {resp.data["access"]}')
+        self.assertEqual(self.client.get(reverse('order-list')).status_code, status.HTTP_200_OK)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer bad')
+        self.assertIn(self.client.get(reverse('order-list')).status_code,
+                      (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN))
+
+
 class TestOrderAPI(APITestCase):
     def setUp(self) -> None:
         generate_mock_data()
@@ -100,6 +190,41 @@ class TestOrderAPI(APITestCase):
         print("POST url2 data return:", json.dumps(resp2.data, indent=2, ensure_ascii=False))
         self.assertEqual(resp2.data['status'], OrderStatus.STATUS_PAID_SUCCEED)
 
+    def test_order_create_bulk(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .models import Order, Product, User
+        from .serializers import OrderSerializer
+
+        u = User.objects.get(username='aweffr')
+        payload = _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛')
+        products = list(Product.objects.filter(merchant_id=payload['merchant_id']))
+
+        def create(item_cnt):
+            data = dict(payload, items=[
+                {'product_id': products[i % len(products)].id, 'quantity': i + 1} for i in range(item_cnt)
+            ])
+            with CaptureQueriesContext(connection) as ctx:
+                order = OrderSerializer.create_order(current_user=u, validated_data=data)
+            return order, len(ctx.captured_queries)
+
+        order, small_cnt = create(2)
+        order, large_cnt = create(30)
+        self.assertEqual(small_cnt, large_cnt)
+
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.items.count(), 30)
+        self.assertEqual(order.price_total, sum(item.price * item.quantity for item in order.items.all()))
+
+        # 与 save 链重新计算的结果一致
+        expected = order.price_total
+        order.save()
+        self.assertEqual(order.price_total, expected)
+
+        url = reverse('order-list')
+        resp = self.client.post(url, dict(payload, items=[{'product_id': -1, 'quantity': 1}]), format='json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def tearDown(self) -> None:
         for image in AppImage.objects.all():
             print(f'removing {image.img.path}')
@@ -133,6 +258,10 @@ class TestOrderCollectionAPI(APITestCase):
 
         print("POST data return:", ret_data)
         order_collection_id = resp.data['id']
+        self.assertEqual(
+            decimal.Decimal(resp.data['price_total']),
+            sum(decimal.Decimal(order['price_total']) for order in resp.data['orders']),
+        )
 
         url2 = reverse('ordercollection-update-status', kwargs={'pk': order_collection_id})
         data_update_status = {
@@ -150,6 +279,724 @@ class TestOrderCollectionAPI(APITestCase):
             os.remove(image.img.path)
 
 
+class TestOrderTotals(MyAPITestCase):
+    def test_deferred_recompute(self):
+        from .models import Order, OrderCollection, OrderItem, Product, User
+        from .order_totals import deferred_totals
+
+        u = User.objects.get(username='aweffr')
+        products = list(Product.objects.all()[:3])
+        with deferred_totals():
+            collection = OrderCollection.objects.create(user=u, status=OrderStatus.STATUS_WAITING_TO_PAY)
+            order = Order.objects.create(user=u, status=OrderStatus.STATUS_WAITING_TO_PAY, order_collection=collection)
+            with self.assertNumQueries(len(products)):
+                for idx, p in enumerate(products):
+                    OrderItem.objects.create(order=order, product=p, quantity=idx + 1)
+
+        expected = sum(p.price * (idx + 1) for idx, p in enumerate(products))
+        self.assertEqual(order.price_total, expected)
+        self.assertEqual(collection.price_total, expected)
+        self.assertEqual(Order.objects.get(pk=order.pk).price_total, expected)
+        self.assertEqual(OrderCollection.objects.get(pk=collection.pk).price_total, expected)
+
+        # 单个订单项的修改立即重算到订单和订单集合
+        item = order.items.first()
+        item.quantity += 1
+        item.save()
+        expected += item.price
+        self.assertEqual(OrderCollection.objects.get(pk=collection.pk).price_total, expected)
+
+        # 只改状态不重算
+        order.status = OrderStatus.STATUS_PAID_SUCCEED
+        with self.assertNumQueries(1):
+            order.save(update_fields=['status', 'update_at'])
+        collection.status = OrderStatus.STATUS_SENDING
+        with self.assertNumQueries(2):
+            collection.save(update_fields=['status', 'update_at'])
+        self.assertEqual(Order.objects.get(pk=order.pk).status, OrderStatus.STATUS_SENDING)
+
+    def test_rollback_discards_dirty(self):
+        from .models import Order, User
+        from .order_totals import deferred_totals, _state
+
+        u = User.objects.get(username='aweffr')
+        with self.assertRaises(ValueError):
+            with deferred_totals():
+                order = Order.objects.create(user=u, status=OrderStatus.STATUS_WAITING_TO_PAY)
+                raise ValueError
+        self.assertFalse(Order.objects.filter(pk=order.pk).exists())
+        self.assertEqual(_state().orders, {})
+        self.assertEqual(_state().depth, 0)
+
+
+def _generate_order_ids(args):
+    from concurrent.futures import ThreadPoolExecutor
+    from .order_id import get_order_id, order_id_generator
+
+    thread_cnt, id_cnt = args
+    with ThreadPoolExecutor(thread_cnt) as executor:
+        chunks = list(executor.map(lambda _: [get_order_id() for _ in range(id_cnt)], range(thread_cnt)))
+    return order_id_generator.worker_id, [order_id for chunk in chunks for order_id in chunk]
+
+
+class TestOrderId(TestCase):
+    def test_format(self):
+        from .models import get_order_id
+        from .order_id import parse_order_id, order_id_generator
+
+        ids = [get_order_id() for _ in range(500)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+        for order_id in ids:
+            self.assertEqual(len(order_id), 21)
+            self.assertTrue(order_id.isdigit())
+            self.assertEqual(parse_order_id(order_id).worker_id, order_id_generator.worker_id)
+            self.assertIsNone(parse_order_id(order_id).machine_id)
+
+    def test_machine_id(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from django.test import override_settings
+        from .order_id import get_order_id, parse_order_id, order_id_generator
+
+        with override_settings(ORDER_ID_MACHINE_ID=7):
+            order_id = get_order_id()
+        self.assertEqual(len(order_id), 23)
+        self.assertEqual(parse_order_id(order_id).machine_id, 7)
+        self.assertEqual(parse_order_id(order_id).worker_id, order_id_generator.worker_id)
+        with override_settings(ORDER_ID_MACHINE_ID=100), self.assertRaises(ImproperlyConfigured):
+            get_order_id()
+
+    def test_overflow_and_rollback(self):
+        from .order_id import MAX_SEQUENCE, OrderIdGenerator, parse_order_id
+
+        generator = OrderIdGenerator()
+        # 时钟停住: 序号用完后借用下一毫秒, 不等待
+        with patch('mall.order_id._now_ms', return_value=1_600_000_000_000), patch('time.sleep') as sleep:
+            ids = [generator.next_id() for _ in range((MAX_SEQUENCE + 1) * 3)]
+        self.assertFalse(sleep.called)
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len({parse_order_id(order_id).timestamp for order_id in ids}), 3)
+        # 时钟回拨: 沿用上一次的毫秒数
+        with patch('mall.order_id._now_ms', return_value=1_500_000_000_000):
+            rolled_back = generator.next_id()
+        self.assertGreater(rolled_back, ids[-1])
+        generator.release()
+
+    def test_multi_process_unique(self):
+        import multiprocessing
+        import tempfile
+        from django.test import override_settings
+        from .order_id import parse_order_id
+
+        process_cnt, thread_cnt, id_cnt = 4, 4, 2000
+        with tempfile.TemporaryDirectory() as lock_dir, override_settings(ORDER_ID_LOCK_DIR=lock_dir):
+            with multiprocessing.get_context('fork').Pool(process_cnt) as pool:
+                results = pool.map(_generate_order_ids, [(thread_cnt, id_cnt)] * process_cnt, chunksize=1)
+
+        worker_ids = [worker_id for worker_id, _ in results]
+        self.assertEqual(len(set(worker_ids)), process_cnt)
+        ids = [order_id for _, chunk in results for order_id in chunk]
+        self.assertEqual(len(ids), process_cnt * thread_cnt * id_cnt)
+        self.assertEqual(len(set(ids)), len(ids))
+        for worker_id, chunk in results:
+            self.assertTrue(all(parse_order_id(order_id).worker_id == worker_id for order_id in chunk))
+
+
+class TestKeysetPagination(MyAPITestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.client.login(username='aweffr', password='unsafe')
+
+    def _walk(self, url, page_size):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        pages = []
+        resp = self.client.get(url, data={'page_size': page_size})
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            pages.append(resp.data)
+            if not resp.data['next']:
+                return pages
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.get(resp.data['next'])
+            # 条件请求的校验值查询 (MAX(update_at), COUNT) 不算在内
+            self.assertFalse([q for q in ctx.captured_queries
+                              if 'COUNT(' in q['sql'].upper() and 'AS "max0"' not in q['sql']])
+
+    def test_merchant_pages(self):
+        from .models import Merchant
+
+        # rank 相同的商户也不能重复或遗漏
+        Merchant.objects.update(rank=999)
+        expected = list(Merchant.objects.order_by('-rank', '-id').values_list('id', flat=True))
+        pages = self._walk(reverse('merchant-list'), page_size=1)
+        self.assertEqual([m['id'] for page in pages for m in page['results']], expected)
+        self.assertIsNone(pages[0]['previous'])
+
+        # 从最后一页往回翻
+        ids = []
+        resp = self.client.get(pages[-1]['previous'])
+        while True:
+            ids = [m['id'] for m in resp.data['results']] + ids
+            if not resp.data['previous']:
+                break
+            resp = self.client.get(resp.data['previous'])
+        self.assertEqual(ids, expected[:-1])
+
+    def test_order_pages(self):
+        from .models import Order, User
+        from .serializers import OrderSerializer
+
+        u = User.objects.get(username='aweffr')
+        payload = _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛')
+        for _ in range(5):
+            OrderSerializer.create_order(current_user=u, validated_data=payload)
+        # create_at 相同时按 id 区分
+        Order.objects.update(create_at=Order.objects.first().create_at)
+        expected = list(Order.objects.filter(user=u).order_by('-create_at', '-id').values_list('id', flat=True))
+
+        pages = self._walk(reverse('order-list'), page_size=2)
+        self.assertEqual([o['id'] for page in pages for o in page['results']], expected)
+
+        resp = self.client.get(reverse('order-list'), data={'cursor': 'bad'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@shared_cache
+class TestMerchantProductsAPI(MyAPITestCase):
+    def test_products_paginated_and_stream(self):
+        from .models import Merchant, Product
+
+        m = Merchant.objects.get(name='沃尔玛')
+        url = reverse('merchant-products', kwargs={'pk': m.id})
+        expected = list(Product.objects.filter(merchant=m).order_by('id').values_list('id', flat=True))
+
+        ids = []
+        resp = self.client.get(url, data={'page_size': 2})
+        while True:
+            data = json.loads(resp.content)
+            ids.extend(p['id'] for p in data['results'])
+            if not data['next']:
+                break
+            resp = self.client.get(data['next'])
+        self.assertEqual(ids, expected)
+
+        from .streaming import iter_keyset_chunks
+        self.assertEqual([len(c) for c in iter_keyset_chunks(Product.objects.filter(merchant=m), chunk_size=2)],
+                         [len(expected[i:i + 2]) for i in range(0, len(expected), 2)])
+
+        resp = self.client.get(url, data={'stream': 1})
+        self.assertTrue(resp.streaming)
+        streamed = json.loads(b''.join(resp.streaming_content))
+        self.assertEqual([p['id'] for p in streamed], expected)
+        self.assertEqual(streamed[0]['name'], Product.objects.get(pk=expected[0]).name)
+
+        resp = self.client.get(reverse('merchant-tabs', kwargs={'pk': m.id}))
+        self.assertEqual(json.loads(resp.content)['results'][0]['slug'], 'all')
+        resp = self.client.get(reverse('merchant-tabs', kwargs={'pk': m.id}), data={'stream': 'true'})
+        streamed = json.loads(b''.join(resp.streaming_content))
+        self.assertEqual(len(streamed), m.tabs.count())
+        # 流式与分页的顺序一致 (rank 大的在前)
+        paged = json.loads(self.client.get(reverse('merchant-tabs', kwargs={'pk': m.id}), data={'page_size': 100}).content)
+        self.assertEqual([t['id'] for t in streamed], [t['id'] for t in paged['results']])
+        self.assertEqual(streamed[0]['slug'], 'all')
+
+        # 多列排序分段, rank 相同的也不重复、不遗漏
+        m.tabs.update(rank=1)
+        chunks = iter_keyset_chunks(m.tabs.all(), chunk_size=1, ordering=('-rank', '-id'))
+        self.assertEqual([t.id for c in chunks for t in c], list(m.tabs.order_by('-id').values_list('id', flat=True)))
+
+    def test_products_cache_and_etag(self):
+        from .models import Merchant, Product
+
+        m = Merchant.objects.get(name='沃尔玛')
+        other = Merchant.objects.get(name='山姆会员店')
+        url = reverse('merchant-products', kwargs={'pk': m.id})
+        other_url = reverse('merchant-products', kwargs={'pk': other.id})
+
+        resp1 = self.client.get(url)
+        other_resp = self.client.get(other_url)
+        etag = resp1['ETag']
+        with self.assertNumQueries(0):
+            resp2 = self.client.get(url)
+        self.assertEqual(resp2.content, resp1.content)
+        with self.assertNumQueries(0):
+            resp3 = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp3.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertNotEqual(self.client.get(url, data={'tab': 'all', 'page_size': 1})['ETag'], etag)
+
+        # 只失效被修改的商户
+        p = Product.objects.filter(merchant=m).first()
+        p.name = '改名的商品'
+        p.save()
+        resp4 = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp4.status_code, status.HTTP_200_OK)
+        self.assertIn('改名的商品', {item['name'] for item in json.loads(resp4.content)['results']})
+        self.assertEqual(self.client.get(other_url)['ETag'], other_resp['ETag'])
+
+        # 商品图片变更
+        etag = resp4['ETag']
+        p.img.desc = 'new desc'
+        p.img.save()
+        self.assertNotEqual(self.client.get(url)['ETag'], etag)
+
+        resp = self.client.get(reverse('merchant-products', kwargs={'pk': 999999}))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TestQueryPlanner(MyAPITestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.client.login(username='aweffr', password='unsafe')
+
+    def _count_queries(self, url, **params):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url, data=params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return len(ctx.captured_queries), resp
+
+    def test_plan(self):
+        from .models import Product
+        from .query_planner import plan_queryset
+        from .serializers import ProductSerializer, OrderSerializer, OrderItemSerializer
+
+        qs = plan_queryset(Product.objects.all(), ProductSerializer)
+        # get_tab_slug 里的 obj.tab.slug
+        self.assertEqual(qs.query.select_related, {'tab': {}, 'img': {}})
+        self.assertNotIn('pinyin_keywords', str(qs.query))
+
+        from .models import Order, OrderItem
+        qs = plan_queryset(Order.objects.all(), OrderSerializer)
+        self.assertEqual(qs.query.select_related, {'address': {}, 'merchant': {'img': {}}})
+        self.assertEqual([p.prefetch_through for p in qs._prefetch_related_lookups], ['items'])
+        qs = plan_queryset(OrderItem.objects.all(), OrderItemSerializer)
+        self.assertEqual(qs.query.select_related, {'product': {'merchant': {}, 'img': {}}})
+
+    def test_list_query_count_is_constant(self):
+        from .models import User
+        from .serializers import OrderSerializer
+
+        small, resp = self._count_queries(reverse('product-list'), page_size=2)
+        large, resp = self._count_queries(reverse('product-list'), page_size=50)
+        self.assertGreater(len(resp.data['results']), 2)
+        self.assertEqual(small, large)
+
+        small, _ = self._count_queries(reverse('merchant-list'), page_size=1)
+        large, _ = self._count_queries(reverse('merchant-list'), page_size=50)
+        self.assertEqual(small, large)
+
+        u = User.objects.get(username='aweffr')
+        url = reverse('ordercollection-list')
+        payload = {'orders': [
+            _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛'),
+            _generate_test_order_by_merchant(username='aweffr', merchant_name='山姆会员店'),
+        ]}
+        self.client.post(url, payload, format='json')
+        small, _ = self._count_queries(url)
+        self.client.post(url, payload, format='json')
+        OrderSerializer.create_order(current_user=u, validated_data=payload['orders'][0])
+        large, resp = self._count_queries(url)
+        self.assertEqual(len(resp.data['results']), 2)
+        self.assertEqual(small, large)
+
+        small, _ = self._count_queries(reverse('order-list'), page_size=1)
+        large, resp = self._count_queries(reverse('order-list'), page_size=50)
+        self.assertEqual(len(resp.data['results']), 5)
+        self.assertEqual(small, large)
+
+
+@shared_cache
+class TestQueryBudget(MyAPITestCase):
+    # 每个接口允许的最多查询次数, 包括 session + user 两次; 超出或出现重复查询 (N+1) 即失败
+    # 订单、地址列表多一次条件请求的校验值查询 (见 conditional)
+    BUDGETS = [
+        ('product-list', (), {}, 3),
+        ('product-detail', ('product',), {}, 3),
+        ('merchant-list', (), {}, 3),
+        ('merchant-detail', ('merchant',), {}, 3),
+        ('merchant-products', ('merchant',), {}, 4),
+        ('merchant-tabs', ('merchant',), {}, 4),
+        ('merchantproductstab-list', (), {}, 3),
+        ('merchantproductstab-detail', ('tab',), {}, 3),
+        ('order-list', (), {}, 5),
+        ('order-detail', ('order',), {}, 5),
+        ('ordercollection-list', (), {}, 5),
+        ('ordercollection-detail', ('ordercollection',), {}, 5),
+        ('userexpressaddress-list', (), {}, 4),
+        ('userexpressaddress-detail', ('address',), {}, 4),
+        ('user-about-me', (), {}, 3),
+        ('user-detail', ('user',), {}, 3),
+        ('appimage-detail', ('image',), {}, 3),
+        ('search', (), {'s': '番茄', 'type': 'product'}, 4),
+        ('search-merchant', (), {'s': '沃尔玛'}, 6),
+        ('suggest', (), {'s': 'a'}, 4),
+    ]
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.client.login(username='aweffr', password='unsafe')
+        self.client.post(reverse('ordercollection-list'), {'orders': [
+            _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛'),
+            _generate_test_order_by_merchant(username='aweffr', merchant_name='山姆会员店'),
+        ]}, format='json')
+
+    def test_budgets(self):
+        from .models import Merchant, MerchantProductsTab, Order, OrderCollection, Product, User, UserExpressAddress
+        from .query_budget import assert_query_budget
+
+        user = User.objects.get(username='aweffr')
+        objects = {
+            'merchant': Merchant.objects.first().pk,
+            'product': Product.objects.first().pk,
+            'tab': MerchantProductsTab.objects.first().pk,
+            'order': Order.objects.filter(user=user).first().pk,
+            'ordercollection': OrderCollection.objects.filter(user=user).first().pk,
+            'address': UserExpressAddress.objects.filter(creator=user).first().pk,
+            'user': user.username,
+            'image': AppImage.objects.first().pk,
+        }
+        for name, args, params, budget in self.BUDGETS:
+            url = reverse(name, args=[objects[a] for a in args])
+            with self.subTest(url=url):
+                with assert_query_budget(budget):
+                    resp = self.client.get(url, data=params)
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_write_budgets(self):
+        from .query_budget import assert_query_budget
+
+        # 合并下单按订单逐个创建, 每个订单的查询各执行一次
+        writes = [
+            ('order-list', _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛'), 11, 1),
+            ('ordercollection-list', {'orders': [
+                _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛'),
+                _generate_test_order_by_merchant(username='aweffr', merchant_name='山姆会员店'),
+            ]}, 26, 2),
+        ]
+        for name, payload, budget, repeated in writes:
+            with self.subTest(name=name):
+                with assert_query_budget(budget, repeated=repeated):
+                    resp = self.client.post(reverse(name), payload, format='json')
+                self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def test_detect_repeated_queries(self):
+        from .models import Product
+        from .query_budget import assert_query_budget, fingerprint
+
+        self.assertEqual(
+            fingerprint('SELECT * FROM "t" WHERE "t"."id" IN (%s, %s, %s) AND name = \'x\' LIMIT 21'),
+            fingerprint('SELECT * FROM "t" WHERE "t"."id" IN (%s)  AND name = \'yy\' LIMIT 1'),
+        )
+        with self.assertRaisesMessage(AssertionError, 'more than 1 time'):
+            with assert_query_budget(100):
+                for p in Product.objects.all()[:3]:
+                    str(p.merchant)
+        with assert_query_budget(1):
+            for p in Product.objects.select_related('merchant')[:3]:
+                str(p.merchant)
+
+    def test_server_timing(self):
+        from django.test import override_settings
+
+        url = reverse('product-list')
+        with override_settings(QUERY_BUDGET={'ENABLED': True, 'SERVER_TIMING': True, 'REPEAT_THRESHOLD': 3, 'MAX_QUERIES': 20}):
+            resp = self.client.get(url)
+        self.assertRegex(resp['Server-Timing'], r'^db;dur=[\d.]+;desc="3 queries", app;dur=[\d.]+$')
+        with override_settings(QUERY_BUDGET={'ENABLED': True, 'SERVER_TIMING': False, 'REPEAT_THRESHOLD': 3, 'MAX_QUERIES': 20}):
+            resp = self.client.get(url)
+        self.assertFalse(resp.has_header('Server-Timing'))
+
+    def test_log_level(self):
+        from django.test import override_settings
+
+        url = reverse('product-list')
+        conf = {'ENABLED': True, 'SERVER_TIMING': False, 'REPEAT_THRESHOLD': 3, 'MAX_QUERIES': 20}
+        # 预算之内的请求只有 DEBUG 级别的指标日志
+        with override_settings(QUERY_BUDGET=conf), self.assertLogs('mall.query_budget', 'DEBUG') as logs:
+            self.client.get(url)
+        self.assertEqual([r.levelname for r in logs.records], ['DEBUG'])
+        with override_settings(QUERY_BUDGET={**conf, 'MAX_QUERIES': 1}), self.assertLogs('mall.query_budget', 'DEBUG') as logs:
+            self.client.get(url)
+        self.assertEqual([r.levelname for r in logs.records], ['WARNING'])
+
+
+class TestFastSerializers(MyAPITestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.client.login(username='aweffr', password='unsafe')
+        self.client.post(reverse('ordercollection-list'), {'orders': [
+            _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛'),
+            _generate_test_order_by_merchant(username='aweffr', merchant_name='山姆会员店'),
+        ]}, format='json')
+
+    @staticmethod
+    def _json(data):
+        from rest_framework.utils.encoders import JSONEncoder
+        return json.dumps(data, cls=JSONEncoder, ensure_ascii=False)
+
+    def test_same_output_as_drf(self):
+        from rest_framework.request import Request
+        from rest_framework.test import APIRequestFactory
+        from .fast_serializers import compile_serializer
+        from .models import Merchant, Order, Product
+        from .serializers import MerchantSerializer, OrderSerializer, ProductSerializer, ProductWithMerchantSerializer
+
+        context = {'request': Request(APIRequestFactory().get('/', HTTP_HOST='mall.example.com'))}
+        for serializer_class, qs in (
+                (ProductSerializer, Product.objects.all()),
+                (ProductWithMerchantSerializer, Product.objects.all()),
+                (MerchantSerializer, Merchant.objects.all()),
+                (OrderSerializer, Order.objects.all()),
+        ):
+            with self.subTest(serializer=serializer_class.__name__):
+                expected = self._json(serializer_class(instance=list(qs), many=True, context=context).data)
+                compiled = compile_serializer(serializer_class, context)
+                self.assertIsNotNone(compiled)
+                self.assertEqual(self._json(compiled.to_representation(compiled.values(qs))), expected)
+                self.assertEqual(self._json(compiled.to_representation(list(qs.values_list(*compiled.columns)))), expected)
+                self.assertEqual(self._json(compiled.to_representation_instances(list(qs))), expected)
+
+    def test_views(self):
+        from .models import Merchant, Order, Product
+        from .serializers import MerchantSerializer, OrderSerializer, ProductSerializer
+
+        for name, serializer_class, qs in (
+                ('product', ProductSerializer, Product.objects.order_by('id')),
+                ('merchant', MerchantSerializer, Merchant.objects.order_by('-rank', '-id')),
+                ('order', OrderSerializer, Order.objects.order_by('-create_at', '-id')),
+        ):
+            with self.subTest(name=name):
+                resp = self.client.get(reverse(f'{name}-list'))
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                context = {'request': resp.wsgi_request}
+                expected = serializer_class(instance=list(qs[:20]), many=True, context=context).data
+                self.assertEqual(self._json(resp.data['results']), self._json(expected))
+
+                obj = qs.first()
+                resp = self.client.get(reverse(f'{name}-detail', args=[obj.pk]))
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(self._json(resp.data), self._json(serializer_class(instance=obj, context=context).data))
+
+        resp = self.client.get(reverse('product-detail', args=[0]))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_fallback(self):
+        from rest_framework import serializers
+        from .fast_serializers import compile_serializer
+        from .models import Product
+
+        class NoEquivalentSerializer(serializers.ModelSerializer):
+            desc = serializers.SerializerMethodField()
+
+            def get_desc(self, obj):
+                return str(obj)
+
+            class Meta:
+                model = Product
+                fields = ('id', 'desc')
+
+        self.assertIsNone(compile_serializer(NoEquivalentSerializer, {}))
+
+    def test_fallback_depends_on_sparse_fields(self):
+        from rest_framework import serializers
+        from .fast_serializers import compile_serializer
+        from .models import Product
+        from .sparse_fields import SparseFieldsMixin, SparseFieldsets
+
+        class PartlyCompilableSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+            desc = serializers.SerializerMethodField()
+
+            def get_desc(self, obj):
+                return str(obj)
+
+            class Meta:
+                model = Product
+                fields = ('id', 'name', 'desc')
+
+        # 不能因为完整字段编译不了, 就把去掉 desc 之后的请求也一起退回 DRF
+        self.assertIsNone(compile_serializer(PartlyCompilableSerializer, {'sparse_fieldsets': None}))
+        sparse = SparseFieldsets(fields=('id', 'name'))
+        self.assertIsNotNone(compile_serializer(PartlyCompilableSerializer, {'sparse_fieldsets': sparse}))
+        self.assertIsNone(compile_serializer(PartlyCompilableSerializer, {'sparse_fieldsets': None}))
+
+
+class TestSparseFields(MyAPITestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.client.login(username='aweffr', password='unsafe')
+        self.client.post(reverse('ordercollection-list'), {'orders': [
+            _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛'),
+        ]}, format='json')
+
+    def _get(self, url, table, **params):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url, data=params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        sql = [q['sql'] for q in ctx.captured_queries if f'FROM "{table}"' in q['sql'] and 'AS "max0"' not in q['sql']]
+        self.assertEqual(len(sql), 1)
+        data = resp.data if hasattr(resp, 'data') else json.loads(resp.content)
+        return data, sql[0]
+
+    def test_fields(self):
+        url = reverse('product-list')
+        data, sql = self._get(url, 'mall_product', fields='id,name,price,img')
+        self.assertEqual(list(data['results'][0]), ['id', 'name', 'img', 'price'])
+        self.assertNotIn('search_keywords', sql)
+        self.assertNotIn('mall_merchantproductstab', sql)
+        self.assertIn('mall_appimage', sql)
+
+        data, sql = self._get(url, 'mall_product', fields='id,img.img')
+        self.assertEqual(data['results'][0]['img'], {'img': data['results'][0]['img']['img']})
+        self.assertNotIn('"mall_appimage"."desc"', sql)
+
+        data, sql = self._get(url, 'mall_product', fields='id,name')
+        self.assertNotIn('mall_appimage', sql)
+
+        data, _ = self._get(reverse('userexpressaddress-list'), 'mall_userexpressaddress', fields='id,name')
+        self.assertEqual(list(data[0]), ['id', 'name'])
+
+        merchant_id = self.client.get(reverse('merchant-list')).data['results'][0]['id']
+        data, sql = self._get(reverse('merchant-products', args=[merchant_id]), 'mall_product', fields='id,name')
+        self.assertEqual(list(data['results'][0]), ['id', 'name'])
+        self.assertNotIn('mall_appimage', sql)
+
+    def test_omit_and_expand(self):
+        url = reverse('product-list')
+        full = self.client.get(url).data['results'][0]
+        data, sql = self._get(url, 'mall_product', omit='search_keywords,img.desc,tab_slug')
+        expected = {k: v for k, v in full.items() if k not in ('search_keywords', 'tab_slug')}
+        expected['img'] = {k: v for k, v in full['img'].items() if k != 'desc'}
+        self.assertEqual(json.loads(json.dumps(data['results'][0])), json.loads(json.dumps(expected)))
+        self.assertNotIn('mall_merchantproductstab', sql)
+
+        data, sql = self._get(url, 'mall_product', expand='merchant', fields='id,merchant.name')
+        self.assertEqual(list(data['results'][0]['merchant']), ['name'])
+        self.assertIn('"mall_merchant"."name"', sql)
+
+    def test_nested_list(self):
+        data, sql = self._get(reverse('order-list'), 'mall_order', fields='id,items.quantity')
+        self.assertEqual(list(data['results'][0]), ['id', 'items'])
+        self.assertEqual({tuple(item) for item in data['results'][0]['items']}, {('quantity',)})
+        self.assertNotIn('mall_merchant', sql)
+
+    def test_unknown_fields_not_cached(self):
+        from .query_planner import build_plan
+
+        url = reverse('product-list')
+        self._get(url, 'mall_product', fields='id,name,merchant', omit='junk0')
+        size = build_plan.cache_info().currsize
+        for i in range(1, 20):
+            data, sql = self._get(url, 'mall_product', fields=f'id,name,junk{i},merchant.junk{i}', omit=f'junk{i}')
+            self.assertEqual(list(data['results'][0]), ['id', 'name', 'merchant'])
+            self.assertIn('"mall_product"."merchant_id"', sql)
+        self.assertEqual(build_plan.cache_info().currsize, size)
+
+    def test_only_unknown_fields(self):
+        # 全是不认识的字段名时返回全部字段, 而不是每行一个空对象
+        for url in (reverse('product-list'), reverse('order-list')):
+            with self.subTest(url=url):
+                full = self.client.get(url).data['results'][0]
+                data = self.client.get(url, data={'fields': 'nonexistent'}).data['results'][0]
+                self.assertEqual(list(data), list(full))
+                data = self.client.get(url, data={'fields': 'nonexistent,id'}).data['results'][0]
+                self.assertEqual(list(data), ['id'])
+
+    def test_write_requests_ignore_sparse_fields(self):
+        url = reverse('userexpressaddress-list') + '?fields=id'
+        resp = self.client.post(url, {'name': 'x', 'phone_number': '1', 'address_full_txt': 'y'}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.data['name'], 'x')
+
+
+class TestRenderers(MyAPITestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.client.login(username='aweffr', password='unsafe')
+
+    def test_same_output_as_drf(self):
+        import datetime
+        import uuid
+        from unittest import mock
+        from django.utils import timezone
+        from rest_framework.renderers import JSONRenderer
+        from rest_framework.utils.serializer_helpers import ReturnDict
+        from . import renderers
+
+        now = timezone.now()
+        data = ReturnDict({
+            'price': decimal.Decimal('12.30'),
+            'id': uuid.uuid1(),
+            'utc': now,
+            'local': timezone.localtime(now),
+            'date': now.date(),
+            'time': datetime.time(8, 30),
+            'text': '番茄\u2028\u2029"',
+            'big': 2 ** 70,
+            1: [None, True, 1.5, ()],
+        }, serializer=None)
+        expected = JSONRenderer().render(data)
+        self.assertEqual(renderers.FastJSONRenderer().render(data), expected)
+        with mock.patch.object(renderers, 'orjson', None):
+            self.assertEqual(renderers.FastJSONRenderer().render(data), expected)
+        del data['big']
+        self.assertEqual(renderers.FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+        context = {'indent': 2}
+        self.assertEqual(renderers.FastJSONRenderer().render(data, renderer_context=context),
+                         JSONRenderer().render(data, renderer_context=context))
+
+    def test_json_parser(self):
+        from io import BytesIO
+        from rest_framework.exceptions import ParseError
+        from .renderers import FastJSONParser
+
+        self.assertEqual(FastJSONParser().parse(BytesIO('{"name": "番茄", "n": [1, 2.5]}'.encode())),
+                         {'name': '番茄', 'n': [1, 2.5]})
+        for raw in (b'{"a":', b'[NaN]'):
+            with self.assertRaises(ParseError):
+                FastJSONParser().parse(BytesIO(raw))
+
+        resp = self.client.post(reverse('userexpressaddress-list'), data=json.dumps({
+            'name': '张三', 'phone_number': '1', 'address_full_txt': '上海',
+        }), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.data['name'], '张三')
+
+    def test_msgpack(self):
+        from . import renderers
+
+        if renderers.msgpack is None:
+            self.skipTest('msgpack is not installed')
+        msgpack = renderers.msgpack
+
+        url = reverse('product-list')
+        expected = json.loads(self.client.get(url).content)
+        resp = self.client.get(url, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(resp['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(resp.content), expected)
+
+        merchant_id = expected['results'][0]['merchant'].rstrip('/').rsplit('/', 1)[-1]
+        url = reverse('merchant-products', args=[merchant_id])
+        for _ in range(2):
+            resp = self.client.get(url, HTTP_ACCEPT='application/msgpack')
+            self.assertEqual(resp['Content-Type'], 'application/msgpack')
+            self.assertEqual(msgpack.unpackb(resp.content), json.loads(self.client.get(url).content))
+
+        resp = self.client.post(reverse('userexpressaddress-list'), data=msgpack.packb({
+            'name': '李四', 'phone_number': '1', 'address_full_txt': '北京',
+        }), content_type='application/msgpack', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(msgpack.unpackb(resp.content)['name'], '李四')
+
+
 class TestAddressAPI(APITestCase):
     def setUp(self) -> None:
         generate_mock_data()
@@ -226,6 +1073,43 @@ class TestPinYinGenerate(TestCase):
         print(p.name, p.search_keywords)
 
 
+class TestPinyinService(TestCase):
+    def test_same_as_lazy_pinyin(self):
+        import pypinyin
+        from .pinyin_service import generate_keywords, batch_generate_keywords
+
+        names = ['任天堂Switch日版游戏机续航加强版', '索尼ps5国行版游戏机主机', '番茄', '车厘子', '重庆银行', '山姆会员店', 'abc']
+        for name in names:
+            expected = ','.join(filter(None, (
+                ''.join(pypinyin.lazy_pinyin(name, style=pypinyin.STYLE_INITIALS)),
+                ''.join(pypinyin.lazy_pinyin(name, style=pypinyin.STYLE_NORMAL)),
+            )))
+            self.assertEqual(generate_keywords(name), expected)
+        self.assertEqual(batch_generate_keywords(names + names), [generate_keywords(n) for n in names + names])
+
+    def test_init_search_keywords_command(self):
+        from django.core.management import call_command
+        from .models import Product
+        from .pinyin_service import generate_keywords
+
+        generate_mock_data()
+        Product.objects.update(pinyin_keywords=None, search_keywords='')
+        call_command('init_search_keywords', '--chunk-size', '3', '--workers', '2', stdout=open(os.devnull, 'w'))
+        for p in Product.objects.all():
+            self.assertEqual(p.pinyin_keywords, generate_keywords(p.name))
+            self.assertEqual(p.search_keywords, f'{p.name},{p.pinyin_keywords}')
+
+        Product.objects.update(search_keywords='stale')
+        call_command('init_search_keywords', '--workers', '1', stdout=open(os.devnull, 'w'))
+        self.assertEqual(Product.objects.filter(search_keywords='stale').count(), Product.objects.count())
+        call_command('init_search_keywords', '--force', '--workers', '1', stdout=open(os.devnull, 'w'))
+        self.assertEqual(Product.objects.filter(search_keywords='stale').count(), 0)
+
+    def tearDown(self) -> None:
+        for image in AppImage.objects.all():
+            os.remove(image.img.path)
+
+
 class TestSearchAPI(APITestCase):
     def setUp(self) -> None:
         generate_mock_data()
@@ -240,6 +1124,9 @@ class TestSearchAPI(APITestCase):
         }
         resp = self.client.get(url, data=query_params, format='json')
         print("GET %s data return:\n" % resp.wsgi_request.get_raw_uri(), json.dumps(resp.data, indent=2, ensure_ascii=False))
+        self.assertEqual(len(resp.data['products']), 2)
+        for p in resp.data['products']:
+            self.assertEqual(p['merchant']['id'], 2)
 
     def test_merchant_search(self):
         url = reverse('search-merchant')
@@ -248,6 +1135,31 @@ class TestSearchAPI(APITestCase):
         }
         resp = self.client.get(url, data=data, format='json')
         print("GET %s data return:\n" % resp.wsgi_request.get_raw_uri(), json.dumps(resp.data, indent=2, ensure_ascii=False))
+        self.assertEqual(len(resp.data['search_result']), 2)
+
+    def test_merchant_search_query_count(self):
+        from .models import Merchant, Product
+        from .serializers import MerchantSearchSerializer
+
+        m = Merchant.objects.get(name='沃尔玛')
+        tab = m.tabs.get(slug='fruit')
+        for i in range(20):
+            Product.objects.create(merchant=m, tab=tab, name=f'番茄{i}号', price=1, old_price=1, sales=i)
+
+        serializer = MerchantSearchSerializer(data={'s': '番茄', 'product_limit': 3}, context={'request': None})
+        serializer.is_valid(raise_exception=True)
+        with self.assertNumQueries(4):
+            result = serializer._do_search(serializer.validated_data)
+        products = {item['merchant']['name']: [p['name'] for p in item['products']] for item in result['search_result']}
+        # 完全匹配优先, 其余按销量
+        self.assertEqual(products['沃尔玛'], ['番茄', '番茄19号', '番茄18号'])
+        self.assertEqual(products['山姆会员店'], ['番茄'])
+
+        serializer = MerchantSearchSerializer(data={'s': 'shanmu', 'limit': 1}, context={'request': None})
+        serializer.is_valid(raise_exception=True)
+        result = serializer._do_search(serializer.validated_data)
+        self.assertEqual([item['merchant']['name'] for item in result['search_result']], ['山姆会员店'])
+        self.assertEqual(result['search_result'][0]['products'], [])
 
     def tearDown(self) -> None:
         for image in AppImage.objects.all():
@@ -255,6 +1167,707 @@ class TestSearchAPI(APITestCase):
             os.remove(image.img.path)
 
 
+class TestNGramIndex(TestCase):
+    def test_search(self):
+        from .search_engine import NGramIndex
+
+        index = NGramIndex()
+        index.add(1, '番茄,fq,fanqie', group=1)
+        index.add(2, '车厘子,clz,chelizi', group=1)
+        index.add(3, '番茄炒蛋,fqcd,fanqiechaodan', group=2)
+
+        self.assertEqual(sorted(index.search('番茄')), [1, 3])
+        self.assertEqual(sorted(index.search('FanQie')), [1, 3])
+        self.assertEqual(index.search('fanqie', group=2), [3])
+        self.assertEqual(sorted(index.search('c')), [2, 3])
+        # 每个 2-gram 都命中但并非子串
+        self.assertEqual(index.search('qief'), [])
+        self.assertEqual(dict(index.search_grouped('fq')), {1: [1], 2: [3]})
+        self.assertEqual(len(index.search('番茄', limit=1)), 1)
+        # 先按匹配档位 (完全匹配 > 前缀 > 子串), 再按静态分
+        index.add(4, '新鲜番茄,xxfq,xinxianfanqie', group=2, score=10)
+        self.assertEqual(index.top('番茄', 3), [1, 3, 4])
+        self.assertEqual(index.top('番茄', 1, group=2), [3])
+        index.remove(4)
+
+        index.add(3, '鸡蛋,jd,jidan', group=2)
+        self.assertEqual(index.search('番茄'), [1])
+        index.remove(1)
+        self.assertEqual(index.search('番茄'), [])
+
+        index2 = NGramIndex()
+        index2.load_snapshot(index.snapshot())
+        self.assertEqual(index2.search('jidan'), [3])
+
+
+class TestSearchBackends(MyAPITestCase):
+    def test_backends_agree(self):
+        from .models import Merchant, Product
+        from .search_backends import IContainsSearchBackend, NGramIndexSearchBackend
+
+        for s in ('youxi', '番茄', 'S', 'shanmu'):
+            expected = set(IContainsSearchBackend().filter_products(Product.objects.all(), s).values_list('id', flat=True))
+            got = set(NGramIndexSearchBackend().filter_products(Product.objects.all(), s).values_list('id', flat=True))
+            self.assertEqual(expected, got, s)
+            expected = set(IContainsSearchBackend().filter_merchants(Merchant.objects.all(), s).values_list('id', flat=True))
+            got = set(NGramIndexSearchBackend().filter_merchants(Merchant.objects.all(), s).values_list('id', flat=True))
+            self.assertEqual(expected, got, s)
+
+    def test_fulltext_lookup_sql(self):
+        from .models import Product
+
+        sql = str(Product.objects.filter(search_keywords__ngram_match='fanqie').query)
+        self.assertIn('MATCH ("mall_product"."search_keywords") AGAINST ("fanqie" IN BOOLEAN MODE)', sql)
+
+    def test_search_backend_setting(self):
+        from django.test import override_settings
+        from .search_backends import get_search_backend, IContainsSearchBackend, NGramIndexSearchBackend
+
+        self.assertIsInstance(get_search_backend(), IContainsSearchBackend)
+        with override_settings(SEARCH_BACKEND='mall.search_backends.NGramIndexSearchBackend'):
+            self.assertIsInstance(get_search_backend(), NGramIndexSearchBackend)
+        self.assertIsInstance(get_search_backend(), IContainsSearchBackend)
+
+
+@skipUnless(connection.vendor == 'mysql', 'FULLTEXT ngram 只有 MySQL 支持')
+class TestMySQLFulltextSearch(TransactionTestCase):
+    """
+    FULLTEXT 索引在事务提交后才更新, 所以用 TransactionTestCase
+    """
+
+    def setUp(self) -> None:
+        generate_mock_data()
+
+    def tearDown(self) -> None:
+        for image in AppImage.objects.all():
+            os.remove(image.img.path)
+
+    def test_pinyin(self):
+        from .models import Merchant, Product
+        from .search_backends import IContainsSearchBackend, MySQLFulltextSearchBackend
+
+        # 含停用词 a / i 的 gram: fa an qi ie ai
+        for s in ('ai', 'fanqie', 'fq', 'shanmu', 'youxi', '番茄'):
+            with self.subTest(s=s):
+                for method, qs in (('filter_products', Product.objects.all()), ('filter_merchants', Merchant.objects.all())):
+                    expected = set(getattr(IContainsSearchBackend(), method)(qs, s).values_list('id', flat=True))
+                    got = set(getattr(MySQLFulltextSearchBackend(), method)(qs, s).values_list('id', flat=True))
+                    # ngram 的 AND 匹配可能比子串多, 但不能少
+                    self.assertLessEqual(expected, got)
+        self.assertTrue(MySQLFulltextSearchBackend().filter_products(Product.objects.all(), 'fanqie').exists())
+
+
+@shared_cache
+class TestSearchResultCache(MyAPITestCase):
+    def test_cache_hit_and_invalidate(self):
+        from .models import Product
+        from .search_cache import get_search_result_cache, get_catalog_version
+
+        url = reverse('search')
+        cache = get_search_result_cache()
+        hits, misses = cache.hits, cache.misses
+
+        resp1 = self.client.get(url, data={'s': 'fanqie', 'type': 'product'})
+        resp2 = self.client.get(url, data={'s': 'FanQie', 'type': 'product'})
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (1, 1))
+        self.assertEqual(resp1.data['products'], resp2.data['products'])
+        self.assertEqual(resp2.data['s'], 'FanQie')
+
+        version = get_catalog_version()
+        p = Product.objects.filter(name='番茄').first()
+        p.name = '圣女果'
+        p.pinyin_keywords = p.search_keywords = None
+        p.save()
+        self.assertGreater(get_catalog_version(), version)
+
+        resp3 = self.client.get(url, data={'s': 'fanqie', 'type': 'product'})
+        self.assertEqual(cache.misses - misses, 2)
+        self.assertEqual(len(resp3.data['products']), len(resp1.data['products']) - 1)
+
+    def test_lru_eviction(self):
+        from .search_cache import LocMemLRUResultCache
+
+        cache = LocMemLRUResultCache(timeout=60, max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get_or_set('c', lambda: 4), 3)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+
+class TestTieredCache(TestCase):
+    def setUp(self) -> None:
+        from django.core.cache import caches
+        caches['default'].clear()
+
+    def _cache(self, **kwargs):
+        from .tiered_cache import TieredCache
+        return TieredCache(**{'timeout': 60, 'local_timeout': 60, 'stale_timeout': 30, 'wait_timeout': 5, **kwargs})
+
+    def test_two_tiers_and_version(self):
+        cache = self._cache()
+        self.assertEqual(cache.get_or_set('k', lambda: 1, version=1), 1)
+        self.assertEqual(cache.get_or_set('k', lambda: 2, version=1), 1)
+        # 另一个进程: 进程内 LRU 为空, 从共享缓存读
+        other = self._cache()
+        self.assertEqual(other.get_or_set('k', lambda: 3, version=1), 1)
+        self.assertEqual((other.hits, other.shared_hits, other.misses), (1, 1, 0))
+        # 版本号递增后重算
+        self.assertEqual(other.get_or_set('k', lambda: 4, version=2), 4)
+        self.assertEqual(cache.get_or_set('k', lambda: 5, version=2), 4)
+        self.assertEqual(cache.get('k', version=3), None)
+
+    def test_stale_while_revalidate(self):
+        from django.core.cache import caches
+
+        cache = self._cache()
+        cache.get_or_set('k', lambda: 'old', version=1)
+        # 其它进程正在重算
+        caches['default'].add('k:lock', 1)
+        self.assertEqual(cache.get_or_set('k', lambda: 'new', version=2), 'old')
+        self.assertEqual(cache.stale_hits, 1)
+        caches['default'].delete('k:lock')
+        self.assertEqual(cache.get_or_set('k', lambda: 'new', version=2), 'new')
+
+        no_stale = self._cache(stale_timeout=0, wait_timeout=0)
+        caches['default'].add('k:lock', 1)
+        self.assertEqual(no_stale.get_or_set('k', lambda: 'newer', version=3), 'newer')
+
+    def test_single_flight(self):
+        import threading
+        import time
+
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        # 两个 "进程" 各 4 个线程同时请求同一个 key, 只算一次
+        caches = [self._cache(), self._cache()]
+        results = []
+        threads = [threading.Thread(target=lambda c=c: results.append(c.get_or_set('hot', compute)))
+                   for c in caches for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['value'] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_cached_decorator(self):
+        from .tiered_cache import cached
+
+        cache = self._cache()
+        calls = []
+
+        @cached(key=lambda x, skip=False: None if skip else f'square:{x}', version=lambda *args, **kwargs: 1, backend=cache)
+        def square(x, skip=False):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual([square(3), square(3), square(4), square(3, skip=True)], [9, 9, 16, 9])
+        self.assertEqual(calls, [3, 4, 3])
+
+
+class TestSuggest(MyAPITestCase):
+    def test_trie(self):
+        from .suggest import SuggestTrie, suggest_keys
+
+        trie = SuggestTrie(top_k=3)
+        for pk, (name, sales) in enumerate([('番茄', 10), ('番石榴', 30), ('饭团', 20), ('车厘子', 5)]):
+            trie.add(('product', pk), suggest_keys(name), sales, {'id': pk, 'name': name})
+
+        self.assertEqual([e['name'] for e in trie.suggest('fan')], ['番石榴', '饭团', '番茄'])
+        self.assertEqual([e['name'] for e in trie.suggest('番')], ['番石榴', '番茄'])
+        self.assertEqual([e['name'] for e in trie.suggest('FQ')], ['番茄'])
+        self.assertEqual([e['name'] for e in trie.suggest('f', limit=1)], ['番石榴'])
+        self.assertEqual(trie.suggest('x'), [])
+
+        trie.add(('product', 0), suggest_keys('番茄'), 100, {'id': 0, 'name': '番茄'})
+        self.assertEqual([e['name'] for e in trie.suggest('fan')], ['番茄', '番石榴', '饭团'])
+        trie.remove(('product', 1))
+        self.assertEqual([e['name'] for e in trie.suggest('fan')], ['番茄', '饭团'])
+
+        # 删除后不留空节点
+        for pk in (0, 2, 3):
+            trie.remove(('product', pk))
+        self.assertIsNone(trie.root.children)
+
+    def test_suggest_api(self):
+        from .models import Product
+
+        url = reverse('suggest')
+        resp = self.client.get(url, data={'s': 'chel'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual({s['name'] for s in resp.data['suggestions']}, {'车厘子'})
+
+        p = Product.objects.filter(name='车厘子').first()
+        p.sales = 999
+        p.save()
+        resp = self.client.get(url, data={'s': 'c'})
+        self.assertEqual(resp.data['suggestions'][0], {'type': 'product', 'id': p.id, 'name': '车厘子', 'sales': 999})
+
+    def test_deleted_by_other_worker(self):
+        from .models import Product
+        from .suggest import suggest_index
+
+        url = reverse('suggest')
+        self.assertEqual({s['name'] for s in self.client.get(url, data={'s': 'chel'}).data['suggestions']}, {'车厘子'})
+        # 其它进程的删除不会触发本进程的 signals
+        with patch.object(suggest_index, 'on_deleted'):
+            Product.objects.filter(name='车厘子').delete()
+        # 查询只读内存, 定期同步时才对账删除
+        with override_settings(SEARCH_INDEX_REFRESH_SECONDS=3600), self.assertNumQueries(0):
+            self.assertTrue(suggest_index.suggest('chel'))
+        with override_settings(SEARCH_INDEX_REFRESH_SECONDS=0):
+            self.assertEqual(self.client.get(url, data={'s': 'chel'}).data['suggestions'], [])
+        self.assertEqual(suggest_index.trie.suggest('chel'), [])
+
+    def test_warm_up(self):
+        from .search_engine import CatalogSearchIndex, warm_up_indexes
+        from .suggest import suggest_index
+
+        with patch.object(CatalogSearchIndex, 'ensure_ready') as ensure_ready:
+            with override_settings(SEARCH_BACKEND='mall.search_backends.IContainsSearchBackend'):
+                warm_up_indexes()
+            # 默认 backend 不用 n-gram 索引, 不预热
+            self.assertFalse(ensure_ready.called)
+            with override_settings(SEARCH_BACKEND='mall.search_backends.NGramIndexSearchBackend'):
+                warm_up_indexes()
+            self.assertEqual(ensure_ready.call_count, 2)
+        self.assertTrue(suggest_index.ready)
+
+
+class TestRankedSearch(MyAPITestCase):
+    def test_match_tier(self):
+        from .ranking import match_tier, MATCH_EXACT, MATCH_PREFIX, MATCH_INITIALS, MATCH_SUBSTRING
+
+        self.assertEqual(match_tier('番茄', '番茄'), MATCH_EXACT)
+        self.assertEqual(match_tier('fanqie', '番茄'), MATCH_EXACT)
+        self.assertEqual(match_tier('番茄', '番茄炒蛋'), MATCH_PREFIX)
+        self.assertEqual(match_tier('fq', '番茄炒蛋'), MATCH_INITIALS)
+        self.assertEqual(match_tier('炒蛋', '番茄炒蛋'), MATCH_SUBSTRING)
+
+    def test_search_order(self):
+        from .models import Merchant, Product
+
+        m = Merchant.objects.get(name='沃尔玛')
+        tomato = Product.objects.get(merchant=m, name='番茄')
+        Product.objects.create(merchant=m, tab=tomato.tab, name='番茄炒蛋', price=1, old_price=1, sales=100000)
+        Product.objects.create(merchant=m, tab=tomato.tab, name='新鲜番茄', price=1, old_price=1, sales=500)
+        tomato.sales = 10
+        tomato.save(update_fields=['sales'])
+        tomato.refresh_from_db()
+        self.assertGreater(tomato.search_score, 0)
+
+        resp = self.client.get(reverse('search'), data={'s': '番茄', 'type': 'product', 'merchant_id': m.id})
+        self.assertEqual([p['name'] for p in resp.data['products']], ['番茄', '番茄炒蛋', '新鲜番茄'])
+
+    def test_exact_match_beyond_candidates(self):
+        from django.test import override_settings
+        from .models import Merchant, Product
+        from .ranking import RANK_CANDIDATES
+        from .search_backends import NGramIndexSearchBackend
+
+        m = Merchant.objects.get(name='沃尔玛')
+        tomato = Product.objects.get(merchant=m, name='番茄')
+        tomato.sales = 0
+        tomato.save(update_fields=['sales'])
+        Product.objects.bulk_create([
+            Product(merchant=m, name=f'新鲜番茄{i}', price=1, old_price=1, sales=1000 + i, search_score=7 + i / 1000,
+                    pinyin_keywords=f'xxfq{i},xinxianfanqie{i}', search_keywords=f'新鲜番茄{i},xxfq{i},xinxianfanqie{i}')
+            for i in range(RANK_CANDIDATES + 100)
+        ])
+        for backend in ('mall.search_backends.IContainsSearchBackend', 'mall.search_backends.NGramIndexSearchBackend'):
+            with self.subTest(backend=backend), override_settings(SEARCH_BACKEND=backend), \
+                    patch.object(NGramIndexSearchBackend, 'max_candidates', 100):
+                for s in ('番茄', 'fanqie'):
+                    resp = self.client.get(reverse('search'), data={'s': s, 'type': 'product', 'limit': 5})
+                    self.assertEqual(resp.data['products'][0]['name'], '番茄', s)
+
+    def test_score_expression(self):
+        from .models import Merchant, Product
+        from .ranking import product_search_score_expression, merchant_search_score_expression, \
+            product_search_score, merchant_search_score
+
+        Product.objects.update(sales=42)
+        Product.objects.update(search_score=product_search_score_expression())
+        Merchant.objects.update(search_score=merchant_search_score_expression())
+        for p in Product.objects.all():
+            self.assertAlmostEqual(p.search_score, product_search_score(42))
+        for m in Merchant.objects.all():
+            self.assertAlmostEqual(m.search_score, merchant_search_score(m.sales, m.rank))
+
+
+class TestFuzzySearch(MyAPITestCase):
+    def test_distance(self):
+        from .fuzzy import osa_distance, name_tokens, normalize_query
+
+        self.assertEqual(osa_distance('fanqei', 'fanqie', 2), 1)
+        self.assertEqual(osa_distance('fanqi', 'fanqie', 2), 1)
+        self.assertEqual(osa_distance('abcdef', 'uvwxyz', 2), 3)
+        self.assertIn('fanqie', name_tokens('新鲜番茄'))
+        self.assertIn('switch', name_tokens('任天堂Switch日版'))
+        self.assertEqual(normalize_query('蕃茄'), 'fanqie')
+
+    def test_fuzzy_fallback(self):
+        url = reverse('search')
+        resp = self.client.get(url, data={'s': 'fanqei', 'type': 'product'})
+        self.assertTrue(resp.data['fuzzy'])
+        self.assertEqual({p['name'] for p in resp.data['products']}, {'番茄'})
+        self.assertEqual(len(resp.data['products']), 2)
+
+        resp = self.client.get(url, data={'s': 'fanqei', 'type': 'product', 'fuzzy': 'false'})
+        self.assertFalse(resp.data['fuzzy'])
+        self.assertEqual(resp.data['products'], [])
+
+        resp = self.client.get(url, data={'s': 'fanqie', 'type': 'product'})
+        self.assertFalse(resp.data['fuzzy'])
+
+        resp = self.client.get(url, data={'s': 'wo er ma', 'type': 'merchant'})
+        self.assertTrue(resp.data['fuzzy'])
+        self.assertEqual([m['name'] for m in resp.data['merchants']], ['沃尔玛'])
+
+
+class TestBenchSearch(TestCase):
+    def test_bench_search_report(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from .models import Product
+
+        out = StringIO()
+        call_command('bench_search', '--size', '300', '--rounds', '1', '--current-db', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(Product.objects.count(), 300)
+        self.assertEqual(report['size'], 300)
+        for kind in ('search', 'search_merchant'):
+            self.assertGreater(report[kind]['requests'], 0)
+            self.assertLessEqual(report[kind]['p50_ms'], report[kind]['p99_ms'])
+            self.assertGreater(report[kind]['queries_per_request'], 0)
+        self.assertGreater(report['peak_rss_mb'], 0)
+
+
+class TestBenchSerializers(TestCase):
+    def test_bench_serializers_report(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command('bench_serializers', '--size', '200', '--orders', '20', '--page-size', '10', '--rounds', '2',
+                     '--current-db', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report['results']), {
+            'ProductSerializer', 'ProductWithMerchantSerializer', 'MerchantSerializer', 'OrderSerializer',
+        })
+        for result in report['results'].values():
+            self.assertGreater(result['drf']['rows_per_second'], 0)
+            self.assertGreater(result['fast']['rows_per_second'], 0)
+
+
+class TestBenchRenderers(TestCase):
+    def test_bench_renderers_report(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command('bench_renderers', '--orders', '20', '--page-sizes', '5,20', '--rounds', '2', '--current-db', stdout=out)
+        report = json.loads(out.getvalue())
+        for result in report['results'].values():
+            self.assertTrue(result['fast_json_identical'])
+            self.assertEqual(result['fast_json']['bytes'], result['drf_json']['bytes'])
+
+
+@shared_cache
+class TestConditionalGet(MyAPITestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.client.login(username='aweffr', password='unsafe')
+        self.client.post(reverse('ordercollection-list'), {'orders': [
+            _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛'),
+        ]}, format='json')
+
+    def _etag(self, url, **params):
+        resp = self.client.get(url, data=params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return resp['ETag']
+
+    def test_catalog_not_modified(self):
+        from .models import Product
+        from .query_budget import assert_query_budget
+
+        url = reverse('product-list')
+        resp = self.client.get(url)
+        self.assertTrue(resp.has_header('ETag'))
+        self.assertFalse(resp.has_header('Last-Modified'))
+        # 只剩 session + user, 不查商品表
+        with assert_query_budget(2):
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.content, b'')
+
+        self.assertNotEqual(self._etag(url), self._etag(url, fields='id'))
+        product = Product.objects.first()
+        detail = reverse('product-detail', args=[product.pk])
+        etag = self._etag(detail)
+        self.assertEqual(self.client.get(detail, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        product.name = product.name + '!'
+        product.save()
+        self.assertNotEqual(self._etag(detail), etag)
+        self.assertEqual(self.client.get(reverse('merchant-detail', args=[0])).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_nested_catalog_change(self):
+        from .models import MerchantProductsTab
+
+        url = reverse('product-list')
+        etag = self._etag(url)
+        tab = MerchantProductsTab.objects.exclude(products=None).first()
+        tab.slug = tab.slug + '-new'
+        tab.save()
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn(tab.slug, {p['tab_slug'] for p in resp.data['results']})
+
+        # 类目列表只用版本号, 不查库
+        from .query_budget import assert_query_budget
+
+        url = reverse('merchantproductstab-list')
+        etag = self._etag(url)
+        with assert_query_budget(2):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        tab.name = tab.name + '!'
+        tab.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_bulk_update(self):
+        from django.core.management import call_command
+        from .models import Merchant
+
+        merchant = Merchant.objects.exclude(products=None).first()
+        urls = [reverse('product-list'), reverse('merchant-products', args=[merchant.pk])]
+        etags = [self._etag(url) for url in urls]
+        call_command('init_search_keywords', '--force', '--workers', '1', stdout=open(os.devnull, 'w'))
+        for url, etag in zip(urls, etags):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_update_at(self):
+        from .models import Order, UserExpressAddress
+
+        url = reverse('order-list')
+        resp = self.client.get(url)
+        self.assertTrue(resp.has_header('Last-Modified'))
+        etag = resp['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        # 订单自己没变, 嵌套输出的收货地址变了
+        address = Order.objects.first().address
+        address.name = address.name + '!'
+        address.save()
+        self.assertNotEqual(self._etag(url), etag)
+
+        url = reverse('userexpressaddress-list')
+        resp = self.client.get(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=resp['Last-Modified']).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        etag = resp['ETag']
+        new = UserExpressAddress.objects.create(
+            creator=address.creator, name='new', phone_number='13800000000', address_full_txt='new',
+        )
+        self.assertNotEqual(self._etag(url), etag)
+        new.delete()
+        self.assertEqual(self._etag(url), etag)
+        self.assertEqual(self.client.get(reverse('order-detail', args=['nope'])).status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(SHARED_CACHE=False)
+class TestLocalCacheFallback(MyAPITestCase):
+    """
+    缓存不跨进程共享时, 版本号看不到其它 worker 的写入
+    """
+
+    def test_etag_from_data(self):
+        from django.utils import timezone
+        from .models import Product
+
+        url = reverse('product-list')
+        resp = self.client.get(url)
+        self.assertTrue(resp.has_header('Last-Modified'))
+        etag = resp['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        # 其它 worker 的写入: 本进程的 signals 和版本号都不知道
+        Product.objects.filter(pk=Product.objects.first().pk).update(name='其它进程改的', update_at=timezone.now())
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('其它进程改的', {p['name'] for p in resp.data['results']})
+
+    def test_version_caches_disabled(self):
+        from .search_cache import make_search_cache_key
+
+        self.assertIsNone(make_search_cache_key('search', '番茄'))
+        resp = self.client.post(reverse('token_login'), {'username': 'aweffr', 'password': 'unsafe'})
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {resp.data["token"]}')
+        url = reverse('user-about-me')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self.assertTrue([q for q in ctx.captured_queries if 'authtoken_token' in q['sql']])
+
+
+@shared_cache
+class TestReplicaRouter(APITransactionTestCase):
+    """
+    两个 SQLite 库: 测试主库 + 临时文件做副本; 事务提交后才能复制, 所以用 TransactionTestCase
+    """
+    replica = 'replica_test'
+
+    def setUp(self) -> None:
+        import tempfile
+        from django.db import connections
+        from .db_router import copy_sqlite_database
+
+        generate_mock_data()
+        fd, self.replica_path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        connections.databases[self.replica] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.replica_path}
+        copy_sqlite_database('default', self.replica)
+        self.override = override_settings(DATABASE_REPLICAS=[self.replica])
+        self.override.enable()
+
+    def tearDown(self) -> None:
+        from django.db import connections
+
+        self.override.disable()
+        connections[self.replica].close()
+        del connections[self.replica]
+        del connections.databases[self.replica]
+        os.remove(self.replica_path)
+        for image in AppImage.objects.all():
+            os.remove(image.img.path)
+
+    def _product_name(self, pk):
+        resp = self.client.get(reverse('product-detail', args=[pk]))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return json.loads(resp.content)['name']
+
+    def test_read_your_writes(self):
+        from .models import Product
+
+        p = Product.objects.first()
+        # update() 不触发 signals, 模拟副本还没同步到的写入
+        Product.objects.filter(pk=p.pk).update(name='主库上的新名字')
+        self.assertEqual(self._product_name(p.pk), p.name)
+        resp = self.client.get(reverse('merchant-products', args=[p.merchant_id]), data={'page_size': 100})
+        self.assertIn(p.name, {item['name'] for item in json.loads(resp.content)['results']})
+
+        # 写入之后这个用户读主库, 其它用户仍读副本
+        self.client.login(username='aweffr', password='unsafe')
+        resp = self.client.post(reverse('userexpressaddress-list'), data={
+            'name': '张三', 'phone_number': '1', 'address_full_txt': '上海',
+        }, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._product_name(p.pk), '主库上的新名字')
+        self.client.logout()
+        self.assertEqual(self._product_name(p.pk), p.name)
+
+        # 目录变更 (不是这个用户写的) 之后仍读副本; 副本可能还没同步, 不返回 ETag
+        from django.core.management import call_command
+
+        original = p.name
+        p.refresh_from_db()
+        p.name = '再改一次'
+        p.save()
+        resp = self.client.get(reverse('product-detail', args=[p.pk]))
+        self.assertEqual(json.loads(resp.content)['name'], original)
+        self.assertFalse(resp.has_header('ETag'))
+        # 副本同步之后, 超过副本的最大延迟
+        call_command('sync_sqlite_replicas', stdout=open(os.devnull, 'w'))
+        with self.settings(REPLICA_ROUTING={**settings.REPLICA_ROUTING, 'PIN_SECONDS': 0}):
+            resp = self.client.get(reverse('product-detail', args=[p.pk]))
+        self.assertEqual(json.loads(resp.content)['name'], '再改一次')
+        self.assertTrue(resp.has_header('ETag'))
+
+    def test_one_replica_per_request(self):
+        from django.db import connections
+        from .db_router import ReplicaRouter
+        from .models import Merchant
+
+        # 第二个副本用同一个文件
+        second = f'{self.replica}_2'
+        connections.databases[second] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.replica_path}
+        used = []
+        db_for_read = ReplicaRouter.db_for_read
+
+        def spy(router, model, **hints):
+            db = db_for_read(router, model, **hints)
+            used.append(db)
+            return db
+
+        merchant = Merchant.objects.exclude(products=None).first()
+        try:
+            with self.settings(DATABASE_REPLICAS=[self.replica, second]), patch.object(ReplicaRouter, 'db_for_read', spy):
+                for page_size in range(1, 11):
+                    used.clear()
+                    resp = self.client.get(reverse('merchant-products', args=[merchant.pk]), data={'page_size': page_size})
+                    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                    # 商户 + 商品至少两次读, 都在同一个副本上
+                    self.assertGreaterEqual(len(used), 2)
+                    self.assertEqual(len(set(used)), 1)
+                    self.assertIn(used[0], (self.replica, second))
+        finally:
+            connections[second].close()
+            del connections[second]
+            del connections.databases[second]
+
+    def test_create_order_on_primary(self):
+        from .models import Order
+
+        self.client.login(username='aweffr', password='unsafe')
+        # 只在主库上的地址
+        resp = self.client.post(reverse('userexpressaddress-list'), data={
+            'name': '张三', 'phone_number': '1', 'address_full_txt': '上海',
+        }, format='json')
+        payload = _generate_test_order_by_merchant(username='aweffr', merchant_name='沃尔玛')
+        payload['address_id'] = resp.data['id']
+        resp = self.client.post(reverse('order-list'), payload, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(Order.objects.using(self.replica).exists())
+        self.assertEqual(len(self.client.get(reverse('order-list')).data['results']), 1)
+
+    def test_router(self):
+        from django.core.management import call_command
+        from django.db import transaction
+        from .db_router import ReplicaRouter, replica_reads
+        from .models import Product
+
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Product), 'default')
+        with replica_reads():
+            self.assertEqual(router.db_for_read(Product), self.replica)
+            p = Product.objects.first()
+            self.assertEqual(p._state.db, self.replica)
+            self.assertEqual(router.db_for_read(Product, instance=p), self.replica)
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Product), 'default')
+            self.assertEqual(router.db_for_write(Product), 'default')
+            self.assertEqual(router.db_for_read(Product), 'default')
+        self.assertFalse(router.allow_migrate(self.replica, 'mall'))
+
+        with self.settings(DATABASE_REPLICAS=[self.replica, 'default']):
+            with replica_reads():
+                chosen = router.db_for_read(Product)
+                self.assertEqual({router.db_for_read(Product) for _ in range(20)}, {chosen})
+
+        Product.objects.filter(pk=p.pk).update(name='同步')
+        call_command('sync_sqlite_replicas', stdout=open(os.devnull, 'w'))
+        self.assertEqual(Product.objects.using(self.replica).get(pk=p.pk).name, '同步')
+
+
 class TestAppImageAPI(APITestCase):
     def setUp(self) -> None:
         generate_mock_data()
@@ -273,3 +1886,24 @@ class TestAppImageAPI(APITestCase):
         }
         resp = self.client.post(url, data=data)
         print("GET %s data return:\n" % resp.wsgi_request.get_raw_uri(), json.dumps(resp.data, indent=2, ensure_ascii=False))
+
+    def test_catalog_version(self):
+        from .models import Product
+        from .search_cache import get_catalog_version
+
+        # 头像等没有被目录引用的图片不影响目录版本号
+        version = get_catalog_version()
+        resp = self.client.post(reverse('appimage-list'), data={
+            'img': open(settings.BASE_DIR / 'doc' / 'imgs' / 'heibei.png', 'rb'), 'desc': '头像',
+        })
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        image = AppImage.objects.get(pk=resp.data['id'])
+        image.desc = '改了'
+        image.save()
+        self.assertEqual(get_catalog_version(), version)
+
+        # 商品用到的图片
+        image = Product.objects.exclude(img=None).first().img
+        image.desc = '改了'
+        image.save()
+        self.assertGreater(get_catalog_version(), version)
@@ -0,0 +1,277 @@
+"""
+两级缓存: 进程内 LRU + 共享缓存 (django cache, 生产环境配置成 redis), 带防击穿
+
+gunicorn 多个 worker 各自多线程, 热门的商户页、搜索结果过期 (或版本号递增) 时所有请求会同时重算.
+TieredCache.get_or_set() 依次:
+
+1. 进程内 LRU 命中且未过期: 直接返回
+2. 共享缓存命中且未过期: 写回进程内 LRU 后返回
+3. 否则同一个 key 只有一个请求重算 (single-flight):
+   - 同一进程内按 key 排队, 只有第一个线程继续, 其余线程等它算完后读进程内 LRU
+   - 跨进程用 cache.add() 抢 lock key, 抢到的重算并写回两级缓存
+   - 没抢到时, 有过期 (或版本号已落后) 的旧值就直接返回旧值 (stale-while-revalidate), 没有就轮询共享缓存,
+     wait_timeout 秒后仍没有结果时自己算
+
+缓存项是 (版本号, 过期时间, 值). 版本号不放在 key 里, 版本号递增后旧值视为过期而不是未命中, 重算期间其它请求仍可拿到旧值.
+共享缓存中的缓存项保留 timeout + stale_timeout 秒, stale_timeout 为 0 时不返回旧值.
+进程内 LRU 无法跨进程失效, 不带版本号使用时其它进程最多滞后 local_timeout 秒.
+
+- cached: 函数返回值走两级缓存
+- cached_response: viewset action 用, 缓存渲染好的 body 并带 ETag
+"""
+import functools
+import hashlib
+import threading
+import time
+from typing import Callable, Dict, Optional, Union
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .renderers import MessagePackRenderer
+from .search_cache import BaseResultCache, LocMemLRUResultCache
+
+# 等待其它进程重算时轮询共享缓存的间隔 (秒)
+POLL_INTERVAL = 0.05
+
+
+class TieredCache(BaseResultCache):
+    """
+    可以作为 SEARCH_RESULT_CACHE 的 BACKEND; 未指定的参数取 settings.TIERED_CACHE
+    """
+
+    def __init__(self, timeout=None, max_entries=None, cache_alias=None, local_timeout=None, stale_timeout=None,
+                 lock_timeout=None, wait_timeout=None, **kwargs):
+        conf = settings.TIERED_CACHE
+        super().__init__(conf['TIMEOUT'] if timeout is None else timeout, **kwargs)
+        self.cache_alias = conf['CACHE_ALIAS'] if cache_alias is None else cache_alias
+        self.local_timeout = min(self.timeout, conf['LOCAL_TIMEOUT'] if local_timeout is None else local_timeout)
+        self.stale_timeout = conf['STALE_TIMEOUT'] if stale_timeout is None else stale_timeout
+        # 要大于重算耗时, 否则锁过期后会有第二个进程开始重算
+        self.lock_timeout = conf['LOCK_TIMEOUT'] if lock_timeout is None else lock_timeout
+        self.wait_timeout = conf['WAIT_TIMEOUT'] if wait_timeout is None else wait_timeout
+        self.local = LocMemLRUResultCache(
+            timeout=self.local_timeout,
+            max_entries=conf['LOCAL_MAX_ENTRIES'] if max_entries is None else max_entries,
+        )
+        self.shared_hits = 0
+        self.stale_hits = 0
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, threading.Event] = {}
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def _is_fresh(entry, version) -> bool:
+        return entry is not None and entry[0] == version and entry[1] > time.time()
+
+    def get(self, key, version=None):
+        entry = self.local.get(key)
+        if not self._is_fresh(entry, version):
+            entry = self.shared.get(key)
+            if not self._is_fresh(entry, version):
+                return None
+            self.local.set(key, entry)
+        return entry[2]
+
+    def set(self, key, value, version=None):
+        entry = (version, time.time() + self.timeout, value)
+        self.shared.set(key, entry, timeout=self.timeout + self.stale_timeout)
+        self.local.set(key, entry)
+
+    def delete(self, key):
+        """
+        其它进程的进程内 LRU 删不掉, 需要立即失效的数据用版本号
+        """
+        self.shared.delete(key)
+        self.local.delete(key)
+
+    def clear(self):
+        self.shared.clear()
+        self.local.clear()
+
+    def get_or_set(self, key, compute: Callable, version=None):
+        entry = self.local.get(key)
+        if self._is_fresh(entry, version):
+            self.hits += 1
+            return entry[2]
+        shared = self.shared.get(key)
+        if self._is_fresh(shared, version):
+            self.hits += 1
+            self.shared_hits += 1
+            self.local.set(key, shared)
+            return shared[2]
+        stale = (shared or entry) if self.stale_timeout else None
+
+        with self._lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+        if not leader:
+            if stale is not None:
+                self.stale_hits += 1
+                return stale[2]
+            event.wait(self.wait_timeout)
+            entry = self.local.get(key)
+            if self._is_fresh(entry, version):
+                self.hits += 1
+                return entry[2]
+            # 等待超时, 或者重算的线程出错
+            return self._compute(key, compute, version)
+        try:
+            return self._refresh(key, compute, version, stale)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def _refresh(self, key, compute: Callable, version, stale):
+        lock_key = f'{key}:lock'
+        if self.shared.add(lock_key, 1, timeout=self.lock_timeout):
+            try:
+                return self._compute(key, compute, version)
+            finally:
+                self.shared.delete(lock_key)
+
+        # 其它进程正在重算
+        if stale is not None:
+            self.stale_hits += 1
+            return stale[2]
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            entry = self.shared.get(key)
+            if self._is_fresh(entry, version):
+                self.hits += 1
+                self.shared_hits += 1
+                self.local.set(key, entry)
+                return entry[2]
+        return self._compute(key, compute, version)
+
+    def _compute(self, key, compute: Callable, version):
+        self.misses += 1
+        value = compute()
+        self.set(key, value, version)
+        return value
+
+    def stats(self):
+        ret = super().stats()
+        ret.update(shared_hits=self.shared_hits, stale_hits=self.stale_hits, size=len(self.local._data))
+        return ret
+
+
+_tiered_cache: Optional[TieredCache] = None
+
+
+def get_tiered_cache() -> TieredCache:
+    global _tiered_cache
+    if _tiered_cache is None:
+        _tiered_cache = TieredCache()
+    return _tiered_cache
+
+
+@receiver(setting_changed)
+def reset_tiered_cache(setting=None, **kwargs):
+    global _tiered_cache
+    if setting in (None, 'TIERED_CACHE'):
+        _tiered_cache = None
+
+
+Backend = Union[BaseResultCache, Callable[[], BaseResultCache], None]
+
+
+def _get_backend(backend: Backend) -> BaseResultCache:
+    if backend is None:
+        return get_tiered_cache()
+    if isinstance(backend, BaseResultCache):
+        return backend
+    return backend()
+
+
+def cached(key: Callable[..., Optional[str]], version: Optional[Callable] = None, backend: Backend = None):
+    """
+    函数返回值走两级缓存. key / version 接收被装饰函数的参数, key 返回 None 时不走缓存;
+    backend 为缓存对象或者返回缓存对象的函数, 默认 get_tiered_cache()
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_key = key(*args, **kwargs)
+            if cache_key is None:
+                return func(*args, **kwargs)
+            return _get_backend(backend).get_or_set(
+                cache_key,
+                lambda: func(*args, **kwargs),
+                version=version(*args, **kwargs) if version is not None else None,
+            )
+        return wrapper
+    return decorator
+
+
+def request_cache_key(prefix: str, request) -> str:
+    """
+    prefix + 影响返回值的请求参数: 查询参数、返回格式、host (返回值里的链接是绝对地址)
+    """
+    raw = '|'.join([
+        *(f'{k}={v}' for k, v in sorted(request.query_params.lists())),
+        request.accepted_media_type,
+        request.build_absolute_uri('/'),
+    ])
+    return f'{prefix}:{hashlib.md5(raw.encode("utf-8")).hexdigest()}'
+
+
+class _Uncacheable(Exception):
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+
+
+def cached_response(key: Callable[..., Optional[str]], version: Optional[Callable] = None, backend: Backend = None):
+    """
+    viewset action 用, 放在 @action 之下: 缓存渲染好的 JSON / MessagePack body, ETag 由 (key, 版本号) 算出,
+    带 If-None-Match 命中时直接返回 304. key / version 接收 (view, request, *args, **kwargs), key 一般用 request_cache_key.
+    可浏览 API 等其它渲染、key 返回 None、action 返回的不是 200 的 Response 时都不缓存
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(view, request, *args, **kwargs):
+            renderer = request.accepted_renderer
+            cache_key = key(view, request, *args, **kwargs)
+            if cache_key is None or not isinstance(renderer, (JSONRenderer, MessagePackRenderer)):
+                return func(view, request, *args, **kwargs)
+            current = version(view, request, *args, **kwargs) if version is not None else None
+
+            def make_etag(v):
+                return '"%s"' % hashlib.md5(f'{cache_key}|{v}'.encode('utf-8')).hexdigest()
+
+            if make_etag(current) in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                response = HttpResponseNotModified()
+                response['ETag'] = make_etag(current)
+                return response
+
+            def build():
+                response = func(view, request, *args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200:
+                    raise _Uncacheable(response)
+                body = renderer.render(response.data, request.accepted_media_type, view.get_renderer_context())
+                # 返回旧值时 ETag 也要是旧的
+                return make_etag(current), body
+
+            try:
+                etag, body = _get_backend(backend).get_or_set(cache_key, build, version=current)
+            except _Uncacheable as e:
+                return e.response
+            response = HttpResponse(body, content_type=renderer.media_type)
+            response['ETag'] = etag
+            return response
+        return wrapper
+    return decorator
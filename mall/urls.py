@@ -4,8 +4,9 @@ from django.urls import include, path
 from rest_framework.authtoken import views as authtoken_views
 
 from rest_framework import routers
+from rest_framework_simplejwt.views import TokenRefreshView
 from . import views
-from .views import SearchAPI, MyObtainAuthTokenAPI, SearchMerchantAPI
+from .views import SearchAPI, MyObtainAuthTokenAPI, SearchMerchantAPI, SuggestAPI, MyObtainJWTAPI
 
 router = routers.DefaultRouter()
 router.register(r'merchants', views.MerchantViewSet)
@@ -23,6 +24,9 @@ urlpatterns = [
     path('', include(router.urls)),
     path('search/', SearchAPI.as_view(), name="search"),
     path('search-merchant/', SearchMerchantAPI.as_view(), name="search-merchant"),
+    path('suggest/', SuggestAPI.as_view(), name="suggest"),
     path('api-token-auth/', MyObtainAuthTokenAPI.as_view(), name="token_login"),
+    path('api-jwt-auth/', MyObtainJWTAPI.as_view(), name="jwt_login"),
+    path('api-jwt-refresh/', TokenRefreshView.as_view(), name="jwt_refresh"),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework'))
 ]
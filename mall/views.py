@@ -1,7 +1,8 @@
-from rest_framework import authentication
 from rest_framework import permissions
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework.decorators import action
 from rest_framework.request import Request
 from rest_framework.response import Response
@@ -9,17 +10,26 @@ from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework import mixins
 from rest_framework import exceptions
-from .authentication import MySessionAuthentication
+from .authentication import MySessionAuthentication, CachedTokenAuthentication, StatelessJWTAuthentication
+from .pagination import CreateAtKeysetPagination, RankKeysetPagination, IdKeysetPagination
+from .streaming import is_stream_request, stream_json_list
+from .merchant_cache import cached_merchant_action
+from .query_planner import QueryPlannerMixin, plan_queryset
+from .conditional import ConditionalGetMixin
+from .db_router import ReplicaReadMixin
+from .fast_serializers import FastReadMixin, compile_serializer
+from .sparse_fields import SparseFieldsViewMixin
 from .models import Merchant, MerchantProductsTab, Product, Order, UserExpressAddress, OrderCollection, User, AppImage
 from .serializers import MerchantSerializer, MerchantProductsTabSerializer, ProductSerializer, OrderSerializer, OrderUpdateStatusSerializer, \
     UserExpressAddressSerializer, OrderCollectionSerializer, OrderCollectionUpdateStatusSerializer, UserSerializer, SearchSerializer, \
-    AppImageSerializer, MerchantSearchSerializer
+    AppImageSerializer, MerchantSearchSerializer, SuggestSerializer, MyTokenObtainPairSerializer
 
 
-class MerchantViewSet(ModelViewSet):
+class MerchantViewSet(ReplicaReadMixin, ConditionalGetMixin, FastReadMixin, QueryPlannerMixin, SparseFieldsViewMixin, ModelViewSet):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         permissions.IsAuthenticatedOrReadOnly,
@@ -27,6 +37,9 @@ class MerchantViewSet(ModelViewSet):
 
     queryset = Merchant.objects.all()
     serializer_class = MerchantSerializer
+    pagination_class = RankKeysetPagination
+    conditional_catalog_version = True
+    conditional_version_only = True
 
     def get_serializer_class(self):
         if self.action == 'products':
@@ -36,31 +49,63 @@ class MerchantViewSet(ModelViewSet):
         return super(MerchantViewSet, self).get_serializer_class()
 
     @action(detail=True, methods=['get', ])
+    @cached_merchant_action('tabs')
     def tabs(self, request: Request, pk=None):
         merchant = self.get_object()
-        qs = MerchantProductsTab.objects.filter(merchant=merchant).all()
-        return Response(
+        context = self.get_serializer_context()
+        if is_stream_request(request):
+            qs = MerchantProductsTab.objects.filter(merchant=merchant).all()
+            return stream_json_list(qs, MerchantProductsTabSerializer, context=context, ordering=RankKeysetPagination.ordering)
+
+        qs = plan_queryset(
+            MerchantProductsTab.objects.filter(merchant=merchant), MerchantProductsTabSerializer,
+            extra_fields=[o.lstrip('-') for o in RankKeysetPagination.ordering], sparse_fieldsets=context['sparse_fieldsets'],
+        )
+        paginator = RankKeysetPagination()
+        page = paginator.paginate_queryset(qs, request, view=self)
+        return paginator.get_paginated_response(
             MerchantProductsTabSerializer(
-                instance=qs.all(),
+                instance=page,
                 many=True,
-                context={'request': request}
+                context=context
             ).data
         )
 
-    @action(detail=True, methods=['get', ])
-    def products(self, request: Request, pk=None):
+    def get_products_queryset(self, request: Request):
         merchant = self.get_object()
-        qs = Product.objects.select_related('merchant', 'tab').filter(merchant=merchant)
+        qs = plan_queryset(
+            Product.objects.filter(merchant=merchant), ProductSerializer,
+            sparse_fieldsets=self.get_serializer_context()['sparse_fieldsets'],
+        )
         tab_param = request.query_params.get('tab')
         if tab_param and tab_param != 'all':
             qs = qs.filter(tab__slug__iexact=tab_param)
-        return Response(ProductSerializer(instance=qs.all(), many=True, context={'request': request}).data)
-
+        return qs
 
-class MerchantProductsTabViewSet(ModelViewSet):
+    @action(detail=True, methods=['get', ])
+    @cached_merchant_action('products')
+    def products(self, request: Request, pk=None):
+        """
+        分页返回, 按商户版本号缓存并支持 ETag; ?stream=1 时不分页, 以流的方式输出全部商品
+        """
+        if is_stream_request(request):
+            return stream_json_list(self.get_products_queryset(request), ProductSerializer, context=self.get_serializer_context())
+
+        paginator = IdKeysetPagination()
+        context = self.get_serializer_context()
+        compiled = compile_serializer(ProductSerializer, context)
+        if compiled is None:
+            page = paginator.paginate_queryset(self.get_products_queryset(request), request, view=self)
+            return paginator.get_paginated_response(ProductSerializer(instance=page, many=True, context=context).data)
+        page = paginator.paginate_queryset(compiled.values(self.get_products_queryset(request)), request, view=self)
+        return paginator.get_paginated_response(compiled.to_representation(page))
+
+
+class MerchantProductsTabViewSet(ConditionalGetMixin, QueryPlannerMixin, SparseFieldsViewMixin, ModelViewSet):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         permissions.IsAuthenticatedOrReadOnly,
@@ -68,12 +113,15 @@ class MerchantProductsTabViewSet(ModelViewSet):
 
     queryset = MerchantProductsTab.objects.all()
     serializer_class = MerchantProductsTabSerializer
+    conditional_catalog_version = True
+    conditional_version_only = True
 
 
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(ReplicaReadMixin, ConditionalGetMixin, FastReadMixin, QueryPlannerMixin, SparseFieldsViewMixin, ModelViewSet):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         permissions.IsAuthenticatedOrReadOnly,
@@ -83,44 +131,54 @@ class ProductViewSet(ModelViewSet):
 
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    pagination_class = IdKeysetPagination
+    # 共享缓存不可用时的校验值: 嵌套输出的类目 slug
+    conditional_related_timestamps = ('tab__update_at',)
+    conditional_catalog_version = True
+    conditional_version_only = True
 
 
-class OrderViewSet(ModelViewSet):
+class OrderViewSet(ConditionalGetMixin, FastReadMixin, QueryPlannerMixin, SparseFieldsViewMixin, ModelViewSet):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         permissions.IsAuthenticated,
     )
 
-    queryset = Order.objects.prefetch_related(
-        'items',
-        'items__product',
-        'items__product__merchant',
-        'items__product__img'
-    ).all()
+    queryset = Order.objects.all()
     serializer_class = OrderSerializer
+    pagination_class = CreateAtKeysetPagination
+    # 商户、订单项里的商品信息走目录版本号; 订单项增删会重算总价, 订单自己的 update_at 会变
+    conditional_related_timestamps = ('address__update_at',)
+    conditional_catalog_version = True
 
     def get_queryset(self):
         qs = super().get_queryset()
-        qs = qs.filter(user=self.request.user)
+        qs = qs.filter(user_id=self.request.user.id)
         return qs
 
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        serializer.instance = self.get_planned_object(serializer.instance)
+
     @action(methods=['POST', ], detail=True)
     def update_status(self, request: Request, pk=None):
         order: Order = self.get_object()
         serializer = OrderUpdateStatusSerializer(data=request.data, context={'request': request})
         if serializer.is_valid(raise_exception=True):
             order.status = serializer.validated_data['status']
-            order.save()
+            order.save(update_fields=['status', 'update_at'])
         return Response(OrderSerializer(instance=order, context={'request': request}).data)
 
 
-class UserExpressAddressViewSet(ModelViewSet):
+class UserExpressAddressViewSet(ConditionalGetMixin, QueryPlannerMixin, SparseFieldsViewMixin, ModelViewSet):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         permissions.IsAuthenticated,
@@ -131,14 +189,15 @@ class UserExpressAddressViewSet(ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset()
-        qs = qs.filter(creator=self.request.user)
+        qs = qs.filter(creator_id=self.request.user.id)
         return qs
 
 
-class OrderCollectionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin, GenericViewSet):
+class OrderCollectionViewSet(QueryPlannerMixin, SparseFieldsViewMixin, mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin, GenericViewSet):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         permissions.IsAuthenticated,
@@ -146,6 +205,11 @@ class OrderCollectionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
 
     queryset = OrderCollection.objects.all()
     serializer_class = OrderCollectionSerializer
+    pagination_class = CreateAtKeysetPagination
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        serializer.instance = self.get_planned_object(serializer.instance)
 
     @action(methods=['POST', ], detail=True)
     def update_status(self, request: Request, pk=None):
@@ -153,7 +217,7 @@ class OrderCollectionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
         serializer = OrderCollectionUpdateStatusSerializer(data=request.data, context={'request': request})
         if serializer.is_valid(raise_exception=True):
             order_collection.status = serializer.validated_data['status']
-            order_collection.save()
+            order_collection.save(update_fields=['status', 'update_at'])
         return Response(OrderCollectionSerializer(instance=order_collection, context={'request': request}).data)
 
 
@@ -165,10 +229,11 @@ class AllowPostByAnyOne(permissions.BasePermission):
             return bool(request.user and request.user.is_authenticated)
 
 
-class UserViewSet(mixins.RetrieveModelMixin, mixins.CreateModelMixin, mixins.UpdateModelMixin, GenericViewSet):
+class UserViewSet(QueryPlannerMixin, SparseFieldsViewMixin, mixins.RetrieveModelMixin, mixins.CreateModelMixin, mixins.UpdateModelMixin, GenericViewSet):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         AllowPostByAnyOne,
@@ -187,19 +252,24 @@ class UserViewSet(mixins.RetrieveModelMixin, mixins.CreateModelMixin, mixins.Upd
         if user_obj.id != request.user.id:
             raise exceptions.PermissionDenied
 
-        return super().retrieve(request, *args, **kwargs)
+        return Response(self.get_serializer(user_obj).data)
 
     @action(methods=['GET', ], detail=False)
     def about_me(self, request: Request, **kwargs):
         if request.user.is_anonymous:
             raise exceptions.PermissionDenied
-        return Response(UserSerializer(instance=request.user, context={'request': request}).data)
+        user = request.user
+        if not isinstance(user, User) or user.get_deferred_fields():
+            # JWT 模式下 request.user 只是 TokenUser; token 缓存里的 User 只有认证用到的字段
+            user = User.objects.get(pk=user.id)
+        return Response(UserSerializer(instance=user, context={'request': request}).data)
 
 
-class AppImageViewSet(mixins.RetrieveModelMixin, mixins.CreateModelMixin, GenericViewSet):
+class AppImageViewSet(QueryPlannerMixin, SparseFieldsViewMixin, mixins.RetrieveModelMixin, mixins.CreateModelMixin, GenericViewSet):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         permissions.IsAuthenticated,
@@ -209,10 +279,11 @@ class AppImageViewSet(mixins.RetrieveModelMixin, mixins.CreateModelMixin, Generi
     serializer_class = AppImageSerializer
 
 
-class SearchAPI(APIView):
+class SearchAPI(ReplicaReadMixin, APIView):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         permissions.IsAuthenticatedOrReadOnly,
@@ -225,10 +296,11 @@ class SearchAPI(APIView):
             return Response(search_result)
 
 
-class SearchMerchantAPI(APIView):
+class SearchMerchantAPI(ReplicaReadMixin, APIView):
     authentication_classes = (
         MySessionAuthentication,
-        authentication.TokenAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
     )
     permission_classes = (
         permissions.IsAuthenticatedOrReadOnly,
@@ -241,6 +313,22 @@ class SearchMerchantAPI(APIView):
             return Response(search_result)
 
 
+class SuggestAPI(ReplicaReadMixin, APIView):
+    authentication_classes = (
+        MySessionAuthentication,
+        CachedTokenAuthentication,
+        StatelessJWTAuthentication,
+    )
+    permission_classes = (
+        permissions.IsAuthenticatedOrReadOnly,
+    )
+
+    def get(self, request: Request):
+        serializer = SuggestSerializer(data=request.query_params, context={'request': request})
+        if serializer.is_valid(raise_exception=True):
+            return Response(serializer.do_suggest(serializer.validated_data))
+
+
 class MyObtainAuthTokenAPI(ObtainAuthToken):
     authentication_classes = ()
 
@@ -253,3 +341,18 @@ class MyObtainAuthTokenAPI(ObtainAuthToken):
             'token': token.key,
             'user': UserSerializer(instance=user, context={'request': request}).data,
         })
+
+
+class MyObtainJWTAPI(TokenObtainPairView):
+    serializer_class = MyTokenObtainPairSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        try:
+            serializer.is_valid(raise_exception=True)
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+        return Response({
+            **serializer.validated_data,
+            'user': UserSerializer(instance=serializer.user, context={'request': request}).data,
+        })